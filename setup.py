@@ -43,6 +43,14 @@ else:
         'initdb':           scripts.InitDatabaseCommand,
         'reset':            scripts.ResetDatabaseCommand,
         'make_testdata':    scripts.MakeTestDataCommand,
+        'collect_sessions': scripts.CollectSessionsCommand,
+        'award_badges':     scripts.AwardBadgesCommand,
+        'backfill_badges':  scripts.BackfillBadgesCommand,
+        'backfill_slugs':   scripts.BackfillSlugsCommand,
+        'send_mails':       scripts.SendMailsCommand,
+        'export':           scripts.ExportCommand,
+        'compile_templates': scripts.CompileTemplatesCommand,
+        'profile_imports':  scripts.ProfileImportsCommand,
         'compile_catalog':  scripts.CompileCatalogExCommand,
         'compress_deps':    scripts.CompressDependenciesCommand
     }
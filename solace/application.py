@@ -14,20 +14,25 @@ from fnmatch import fnmatch
 from functools import update_wrapper
 from simplejson import dumps
 
-from babel import UnknownLocaleError, Locale
+from babel import UnknownLocaleError
 from werkzeug import Request as RequestBase, Response, cached_property, \
      import_string, redirect, SharedDataMiddleware, url_quote, \
-     url_decode
+     url_decode, ClosingIterator
 from werkzeug.exceptions import HTTPException, NotFound, BadRequest, Forbidden
 from werkzeug.routing import BuildError, RequestRedirect
-from werkzeug.contrib.securecookie import SecureCookie
+from sqlalchemy.orm import compile_mappers
 
 from solace.utils.ctxlocal import local, LocalProperty
+from solace.utils.profiling import ProfilerMiddleware
 
 
 # already resolved and imported views
 _resolved_views = {}
 
+# the build plans for url_for, see _build_url
+_build_plans = {}
+_build_plans_limit = 256
+
 
 class Request(RequestBase):
     """The request class."""
@@ -37,6 +42,10 @@ class Request(RequestBase):
     _locale = None
     _pulled_flash_messages = None
 
+    #: the :class:`~solace.utils.timing.RequestTimings` if server timing
+    #: is enabled.
+    timings = None
+
     #: each request might transmit up to four megs of payload that
     #: is stored in memory.  If more is transmitted, Werkzeug will
     #: abort the request with an appropriate status code.  This should
@@ -53,7 +62,7 @@ class Request(RequestBase):
             view_lang = self.view_arguments.pop('lang_code', None)
             if view_lang is not None:
                 try:
-                    self.view_lang = Locale.parse(view_lang)
+                    self.view_lang = intern_locale(view_lang)
                     if not has_section(self.view_lang):
                         raise UnknownLocaleError(str(self.view_lang))
                 except UnknownLocaleError:
@@ -105,7 +114,7 @@ class Request(RequestBase):
             return self._locale
         rv = self.session.get('locale')
         if rv is not None:
-            rv = Locale.parse(rv)
+            rv = intern_locale(rv)
             # we could trust the cookie here because it's signed, but we do not
             # because the configuration could have changed in the meantime.
             if not has_section(rv):
@@ -115,12 +124,18 @@ class Request(RequestBase):
         self._locale = rv
         return rv
     def _set_locale(self, locale):
-        self._locale = Locale.parse(locale)
+        self._locale = intern_locale(locale)
         self.__dict__.pop('translations', None)
+        self.__dict__.pop('url_lang_code', None)
         self.session['locale'] = str(self._locale)
     locale = property(_get_locale, _set_locale)
     del _get_locale, _set_locale
 
+    @cached_property
+    def url_lang_code(self):
+        """The language code that is added to URLs that expect one."""
+        return self.view_lang or str(self.locale)
+
     @cached_property
     def translations(self):
         """The translations for this request."""
@@ -138,7 +153,7 @@ class Request(RequestBase):
         """The timezone information."""
         offset = self.session.get('timezone')
         if offset is not None:
-            return Timezone(offset)
+            return get_timezone(offset)
 
     @cached_property
     def next_url(self):
@@ -243,7 +258,8 @@ class Request(RequestBase):
     @cached_property
     def user(self):
         """The current user."""
-        return get_auth_system().get_user(self)
+        with timed('user'):
+            return get_auth_system().get_user(self)
 
     @property
     def is_logged_in(self):
@@ -258,8 +274,8 @@ class Request(RequestBase):
     @cached_property
     def session(self):
         """The active session."""
-        return SecureCookie.load_cookie(self, settings.COOKIE_NAME,
-                                        settings.SECRET_KEY)
+        with timed('session'):
+            return get_session_interface().open_session(self)
 
     @property
     def is_behind_proxy(self):
@@ -287,14 +303,18 @@ class Request(RequestBase):
         the database that are queued for the user.
         """
         msgs = self._pulled_flash_messages or []
-        if self.user is not None:
+        if self.user is not None and self.user.pending_messages:
             to_delete = set()
             for msg in UserMessage.query.filter_by(user=self.user).all():
                 msgs.append((msg.type, msg.text))
                 to_delete.add(msg.id)
             if to_delete:
                 UserMessage.query.filter(UserMessage.id.in_(to_delete)).delete(synchronize_session='fetch')
-                session.commit()
+            # if the counter is off for some reason, reset it so that we
+            # do not query for messages on every request.
+            atomic_add(self.user, 'pending_messages',
+                       -(len(to_delete) or self.user.pending_messages))
+            session.commit()
         if 'flashes' in self.session:
             msgs += self.session.pop('flashes')
             self._pulled_flash_messages = msgs
@@ -317,6 +337,25 @@ def get_view(endpoint):
     return view
 
 
+def warmup():
+    """Loads everything that is otherwise loaded on the first request
+    that needs it: the views of all endpoints, the templates of the
+    active theme and the translations for the language sections.  It
+    also configures the database mappers.  Call this after the
+    configuration was loaded so that a process is ready before it
+    accepts requests.
+    """
+    compile_mappers()
+    for rule in url_map.iter_rules():
+        if not rule.build_only:
+            get_view(rule.endpoint)
+    for template in list_theme_templates(get_theme()):
+        jinja_env.get_template(template)
+    for language in settings.LANGUAGE_SECTIONS:
+        load_translations(language)
+        get_js_translations(language)
+
+
 def json_response(message=None, html=None, error=False, login_could_fix=False,
                   **extra):
     """Returns a JSON response for the JavaScript code.  The "wire protocoll"
@@ -387,7 +426,7 @@ def inject_lang_code(request, endpoint, values):
             if request.url_adapter.map.is_endpoint_expecting(
                     endpoint, 'lang_code'):
                 rv = values.copy()
-                rv['lang_code'] = request.view_lang or str(request.locale)
+                rv['lang_code'] = request.url_lang_code
         except KeyError:
             return
     return rv
@@ -399,49 +438,111 @@ def url_for(endpoint, **values):
     if hasattr(endpoint, 'get_url_values'):
         endpoint, values = endpoint.get_url_values(**values)
     request = Request.current
-    anchor = values.pop('_anchor', None)
     assert request is not None, 'no active request'
-    for endpoint_choice in iter_endpoint_choices(endpoint, request.endpoint):
-        real_values = inject_lang_code(request, endpoint_choice, values)
-        if real_values is None:
-            continue
+    return _build_url(request, endpoint, values, external)
+
+
+def urls_for(objects, **values):
+    """Returns a list of ``(obj, url)`` tuples for a list of objects that
+    provide `get_url_values` (topics, posts, users, tags etc.).  The
+    values are passed to `get_url_values` of each object.  This is
+    useful for list views::
+
+        {% for topic, url in urls_for(topics) %}
+    """
+    external = values.pop('_external', False)
+    request = Request.current
+    assert request is not None, 'no active request'
+    rv = []
+    for obj in objects:
+        endpoint, obj_values = obj.get_url_values(**values)
+        rv.append((obj, _build_url(request, endpoint, obj_values, external)))
+    return rv
+
+
+def _build_url(request, endpoint, values, external):
+    """Builds the URL for `url_for`.  Which endpoint to use, if a language
+    code has to be added and if the view is exchange token protected
+    depends only on the endpoint, the current endpoint and the names of
+    the values, so this is remembered in `_build_plans`.  The URL itself
+    is always built by the URL adapter.
+    """
+    anchor = values.pop('_anchor', None)
+    key = (endpoint, request.endpoint, frozenset(values))
+    # werkzeug ignores values that are `None` which might change the rule
+    if None in values.itervalues():
+        key = None
+    plan = key is not None and _build_plans.get(key) or None
+    url = None
+    if plan is not None:
+        endpoint_choice, add_lang_code, protected = plan
+        real_values = values
+        if add_lang_code:
+            real_values = values.copy()
+            real_values['lang_code'] = request.url_lang_code
         try:
             url = request.url_adapter.build(endpoint_choice, real_values,
                                             force_external=external)
         except BuildError:
-            continue
-        view = get_view(endpoint)
-        if is_exchange_token_protected(view):
-            xt = get_exchange_token(request)
-            url = '%s%s_xt=%s' % (url, '?' in url and '&' or '?', xt)
-        if anchor is not None:
-            url += '#' + url_quote(anchor)
-        return url
-    raise BuildError(endpoint, values, 'GET')
+            pass
+    if url is None:
+        for endpoint_choice in iter_endpoint_choices(endpoint,
+                                                     request.endpoint):
+            real_values = inject_lang_code(request, endpoint_choice, values)
+            if real_values is None:
+                continue
+            try:
+                url = request.url_adapter.build(endpoint_choice,
+                                                real_values,
+                                                force_external=external)
+            except BuildError:
+                # if the endpoint exists but could not be built with these
+                # values, the next choice might only work for these values
+                key = None
+                continue
+            protected = is_exchange_token_protected(get_view(endpoint))
+            if key is not None:
+                # the keys depend on the calling code, keep the number of
+                # plans bounded in long running processes
+                if len(_build_plans) >= _build_plans_limit:
+                    _build_plans.clear()
+                _build_plans[key] = (endpoint_choice,
+                                     real_values is not values, protected)
+            break
+        else:
+            raise BuildError(endpoint, values, 'GET')
+    if protected:
+        xt = get_exchange_token(request)
+        url = '%s%s_xt=%s' % (url, '?' in url and '&' or '?', xt)
+    if anchor is not None:
+        url += '#' + url_quote(anchor)
+    return url
 
 
 def save_session(request, response):
     """Saves the session to the response.  Called automatically at
     the end of a request.
     """
-    if not request.in_api and request.session.should_save:
-        request.session.save_cookie(response, settings.COOKIE_NAME)
+    if not request.in_api and 'session' in request.__dict__:
+        get_session_interface().save_session(request, request.session,
+                                             response)
 
 
 def finalize_response(request, response):
     """Finalizes the response.  Applies common response processors."""
     if not isinstance(response, Response):
         response = Response.force_type(response, request.environ)
-    if response.status == 200:
-        response.add_etag()
-        response = response.make_conditional(request)
+    if response.status == 200 and not response.is_streamed:
+        with timed('etag'):
+            response.add_etag()
+            response = response.make_conditional(request)
     before_response_sent.emit(request=request, response=response)
     return response
 
 
 @Request.application
-def application(request):
-    """The WSGI application.  The majority of the handling here happens
+def dispatch_request(request):
+    """Dispatches the request.  The majority of the handling here happens
     in the :meth:`Request.dispatch` method and the functions that are
     connected to the request signals.
     """
@@ -455,6 +556,20 @@ def application(request):
         after_request_shutdown.emit()
 
 
+def application(environ, start_response):
+    """The WSGI application.  Signal handlers connected with the
+    ``'after_response'`` mode are called once the response was sent.
+    """
+    begin_deferred_handlers()
+    try:
+        app_iter = dispatch_request(environ, start_response)
+    except:
+        run_deferred_handlers()
+        raise
+    return ClosingIterator(app_iter, run_deferred_handlers)
+
+
+application = ProfilerMiddleware(application)
 application = SharedDataMiddleware(application, {
     '/_static':     os.path.join(os.path.dirname(__file__), 'static')
 })
@@ -463,15 +578,19 @@ application = SharedDataMiddleware(application, {
 # imported here because of possible circular dependencies
 from solace import settings
 from solace.urls import url_map
-from solace.i18n import select_locale, load_translations, Timezone, _, \
-     list_languages, has_section
+from solace.i18n import select_locale, load_translations, get_timezone, _, \
+     list_languages, has_section, get_js_translations, intern_locale
 from solace.auth import get_auth_system
-from solace.database import session
+from solace.sessions import get_session_interface
+from solace.database import session, atomic_add
 from solace.models import UserMessage
+from solace.templating import jinja_env, get_theme, list_theme_templates
 from solace.signals import before_request_init, after_request_init, \
      before_request_dispatch, after_request_dispatch, \
-     after_request_shutdown, before_response_sent
+     after_request_shutdown, before_response_sent, begin_deferred_handlers, \
+     run_deferred_handlers
 from solace.utils.remoting import remote_export_primitive
+from solace.utils.timing import timed
 from solace.utils.csrf import get_exchange_token, is_exchange_token_protected
 
 # remember to save the session
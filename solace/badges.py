@@ -8,35 +8,197 @@
     :copyright: (c) 2010 by the Solace Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
-from operator import attrgetter
+import logging
+from datetime import datetime
+from sqlalchemy import select, func, null
+from sqlalchemy.orm.interfaces import SessionExtension, EXT_CONTINUE
 
 from solace.i18n import lazy_gettext, _
 from solace.utils.remoting import RemoteObject
 
 
+logger = logging.getLogger('solace.badges')
+
+
 def try_award(event, *args):
     """Tries to avard a badge for the given event.  The events correspond
     to the `on_X` callbacks on the badges, just without the `on_` prefix.
+
+    If the badge queue is enabled, the event is only remembered and
+    written into the queue when the session is committed.
+    """
+    if settings.BADGE_QUEUE_ENABLED:
+        session()._badge_events.append((event, args))
+    else:
+        _award(event, args)
+
+
+def award_queued_badges(batch_size=100):
+    """Awards the badges for the events in the queue in batches of
+    `batch_size` and returns the number of processed events.  Processing
+    is idempotent and the events are removed in the same transaction as
+    the badges are awarded, so multiple workers can run at once.
+
+    If a badge callback fails for an event, the batch is processed again
+    one event per transaction and the failing event is logged and
+    removed from the queue, so that it does not block the events after
+    it.
+    """
+    e = badge_events.c
+    processed = 0
+    while 1:
+        rows = session.execute(select([e.event_id, e.event, e.arguments])
+            .order_by(e.event_id).limit(batch_size)).fetchall()
+        if not rows:
+            break
+        try:
+            if not _award_events(rows):
+                # another worker was faster, try again with the next batch
+                continue
+        except Exception:
+            session.rollback()
+            for row in rows:
+                try:
+                    _award_events([row])
+                except Exception:
+                    session.rollback()
+                    logger.exception('Awarding the badges for event %d '
+                                     '(%s) failed, dropping it',
+                                     row.event_id, row.event)
+                    session.execute(badge_events.delete(
+                        e.event_id == row.event_id))
+                    session.commit()
+        processed += len(rows)
+        if len(rows) < batch_size:
+            break
+    return processed
+
+
+def _award_events(rows):
+    """Awards the badges for the queued events and removes them from the
+    queue in one transaction.  If another worker processed any of the
+    events already, the transaction is rolled back and `False` returned.
+    """
+    for row in rows:
+        args = _load_event_args(row.arguments)
+        # one of the objects was deleted in the meantime
+        if args is not None:
+            _award(row.event, args)
+    ids = [row.event_id for row in rows]
+    if session.execute(badge_events.delete(badge_events.c.event_id
+                                           .in_(ids))).rowcount != len(ids):
+        session.rollback()
+        return False
+    session.commit()
+    return True
+
+
+def backfill_badges(badges=None):
+    """Awards the badges in `badges` (defaults to all badges) to all
+    users that earned them but were not awarded them yet, for example
+    because the badge is new or a rule was fixed.  The rules are checked
+    set-wise with the `backfill` selects of the badges and the counters
+    of all users are recalculated afterwards.  No messages are sent.
+    Returns the number of awarded badges.
     """
-    lookup = attrgetter('on_' + event)
-    for badge in badge_list:
-        cb = lookup(badge)
-        if cb is None:
+    ub = user_badges.c
+    now = datetime.utcnow()
+    awarded = 0
+    for badge in badges or badge_list:
+        if badge.backfill is None:
             continue
+        have = set(tuple(row) for row in session.execute(
+            select([ub.user_id, ub.payload], ub.badge == badge)))
+        if badge.single_awarded:
+            have = set(user_id for user_id, payload in have)
+        missing = []
+        for user_id, post_id in session.execute(badge.backfill()):
+            payload = post_id is not None and str(post_id) or None
+            if badge.single_awarded:
+                key = user_id
+            else:
+                key = (user_id, payload)
+            if key not in have:
+                have.add(key)
+                missing.append(dict(user_id=user_id, badge=badge,
+                                    awarded=now, payload=payload))
+        if missing:
+            session.execute(user_badges.insert(), missing)
+            awarded += len(missing)
+
+    def count(level):
+        return select([func.count(ub.badge_id)],
+                      (ub.user_id == users.c.user_id) &
+                      ub.badge.in_([x for x in badge_list
+                                    if x.level == level])).as_scalar()
+    session.execute(users.update(values=dict(
+        (level + '_badges', count(level)) for level in _numeric_levels)))
+    session.commit()
+    get_cache().namespace('users').invalidate()
+    return awarded
+
+
+def _award(event, args):
+    for badge, cb in badges_by_event.get(event, ()):
         user = cb(*args)
         if user is not None:
             if isinstance(user, tuple):
                 user, payload = user
             else:
                 payload = None
-            if badge.single_awarded and badge in user.badges:
+            if badge.single_awarded and user.has_badge(badge):
                 continue
-            user._badges.append(UserBadge(badge, payload))
+            UserBadge(badge, payload, user)
             # inactive or banned users don't get messages.
             if user.is_active and not user.is_banned:
                 UserMessage(user, _(u'You earned the “%s” badge') % badge.name)
 
 
+def _dump_event_args(args):
+    rv = []
+    for arg in args:
+        model = _queued_model_names.get(type(arg))
+        if model is not None:
+            arg = arg.id
+        rv.append((model, arg))
+    return rv
+
+
+def _load_event_args(args):
+    rv = []
+    for model, value in args:
+        if model is not None:
+            value = _queued_models[model].query.get(value)
+            if value is None:
+                return
+        rv.append(value)
+    return rv
+
+
+class BadgeQueueSessionExtension(SessionExtension):
+    """Writes the badge events of a session into the queue when the
+    session is committed.
+    """
+
+    def before_commit(self, session):
+        events = session._badge_events
+        if events:
+            # the models need their ids for the references
+            session.flush()
+            now = datetime.utcnow()
+            session.execute(badge_events.insert(), [dict(
+                event=event,
+                arguments=_dump_event_args(args),
+                created=now
+            ) for event, args in events])
+            del events[:]
+        return EXT_CONTINUE
+
+    def after_rollback(self, session):
+        del session._badge_events[:]
+        return EXT_CONTINUE
+
+
 _numeric_levels = dict(zip(('bronce', 'silver', 'gold', 'platin'),
                            range(4)))
 
@@ -44,22 +206,30 @@ _numeric_levels = dict(zip(('bronce', 'silver', 'gold', 'platin'),
 class Badge(RemoteObject):
     """Represents a badge.
 
-    It can react to the following events::
+    It can react to the following events (see `events`)::
 
         on_vote = lambda user, post, delta
         on_accept = lambda user, post, answer
         on_reply = lambda user, post
         on_new_topic = lambda user, topic
         on_edit = lambda user, post
+
+    For awarding badges retroactively a badge can provide a `backfill`
+    function that returns a select for ``(user_id, post_id)`` rows of the
+    users that earned it.  The post id is the payload of the badge and
+    `None` for badges without payload.
     """
 
+    #: the events a badge can react to
+    events = ('vote', 'accept', 'reply', 'new_topic', 'edit')
+
     remote_object_type = 'solace.badge'
     public_fields = ('level', 'identifier', 'name', 'description')
 
     def __init__(self, level, identifier, name, description=None,
                  single_awarded=False,
                  on_vote=None, on_accept=None, on_reply=None,
-                 on_new_topic=None, on_edit=None):
+                 on_new_topic=None, on_edit=None, backfill=None):
         assert level in ('bronce', 'silver', 'gold', 'platin')
         assert len(identifier) <= 30
         self.level = level
@@ -72,6 +242,7 @@ class Badge(RemoteObject):
         self.on_reply = on_reply
         self.on_new_topic = on_new_topic
         self.on_edit = on_edit
+        self.backfill = backfill
 
     @property
     def numeric_level(self):
@@ -88,14 +259,19 @@ class Badge(RemoteObject):
         )
 
 
+def _backfill_special_answer(votes_required):
+    """Backfill helper for the answer badges."""
+    p = posts.c
+    return select([p.author_id, p.post_id],
+                  p.is_answer & (p.votes >= votes_required))
+
+
 def _try_award_special_answer(post, badge, votes_required):
     """Helper for nice and good answer."""
     pid = str(post.id)
     user = post.author
-    for user_badge in user._badges:
-        if user_badge.badge == badge and \
-           user_badge.payload == pid:
-            return
+    if user.has_badge(badge, pid):
+        return
     if post.is_answer and post.votes >= votes_required:
         return user, pid
 
@@ -104,23 +280,49 @@ def _try_award_self_learner(post):
     """Helper for the self learner badge."""
     pid = str(post.id)
     user = post.author
-    for user_badge in user._badges:
-        if user_badge.badge == SELF_LEARNER and \
-           user_badge.payload == pid:
-            return
+    if user.has_badge(SELF_LEARNER, pid):
+        return
     if post.is_answer and post.author == post.topic.author \
        and post.votes >= 3:
         return user, pid
 
 
+def _backfill_self_learner():
+    """Backfill helper for the self learner badge."""
+    p = posts.c
+    t = topics.c
+    return select([p.author_id, p.post_id],
+                  (t.topic_id == p.topic_id) & p.is_answer &
+                  (p.author_id == t.author_id) & (p.votes >= 3))
+
+
+def _backfill_reversal():
+    """Backfill helper for the reversal badge."""
+    p = posts.c
+    t = topics.c
+    return select([p.author_id, p.post_id],
+                  (t.topic_id == p.topic_id) & p.is_answer &
+                  (p.votes >= 20) & (t.votes <= -5))
+
+
+def _backfill_vote(critic_of_self):
+    """Backfill helper for critic and self critic."""
+    v = votes.c
+    p = posts.c
+    if critic_of_self:
+        cond = p.author_id == v.user_id
+    else:
+        cond = p.author_id != v.user_id
+    return select([v.user_id, null()], (p.post_id == v.post_id) &
+                  (v.delta < 0) & cond, distinct=True)
+
+
 def _try_award_reversal(post):
     """Helper for the reversal badge."""
     pid = str(post.id)
     user = post.author
-    for user_badge in user._badges:
-        if user_badge.badge == REVERSAL and \
-           user_badge.payload == pid:
-            return
+    if user.has_badge(REVERSAL, pid):
+        return
     if post.is_answer and post.votes >= 20 and \
        post.topic.votes <= -5:
         return user, pid
@@ -130,33 +332,40 @@ CRITIC = Badge('bronce', 'critic', lazy_gettext(u'Critic'),
     lazy_gettext(u'First down vote'),
     single_awarded=True,
     on_vote=lambda user, post, delta:
-        user if delta < 0 and user != post.author else None
+        user if delta < 0 and user != post.author else None,
+    backfill=lambda: _backfill_vote(False)
 )
 
 SELF_CRITIC = Badge('silver', 'self-critic', lazy_gettext(u'Self-Critic'),
     lazy_gettext(u'First downvote on own reply or question'),
     single_awarded=True,
     on_vote=lambda user, post, delta:
-        user if delta < 0 and user == post.author else None
+        user if delta < 0 and user == post.author else None,
+    backfill=lambda: _backfill_vote(True)
 )
 
 EDITOR = Badge('bronce', 'editor', lazy_gettext(u'Editor'),
     lazy_gettext(u'First edited post'),
     single_awarded=True,
-    on_edit=lambda user, post: user
+    on_edit=lambda user, post: user,
+    backfill=lambda: select([posts.c.editor_id, null()],
+                            posts.c.editor_id != None, distinct=True)
 )
 
 INQUIRER = Badge('bronce', 'inquirer', lazy_gettext(u'Inquirer'),
     lazy_gettext(u'First asked question'),
     single_awarded=True,
-    on_new_topic=lambda user, topic: user
+    on_new_topic=lambda user, topic: user,
+    backfill=lambda: select([topics.c.author_id, null()], distinct=True)
 )
 
 TROUBLESHOOTER = Badge('silver', 'troubleshooter',
     lazy_gettext(u'Troubleshooter'),
     lazy_gettext(u'First answered question'),
     single_awarded=True,
-    on_accept=lambda user, topic, post: post.author if post else None
+    on_accept=lambda user, topic, post: post.author if post else None,
+    backfill=lambda: select([posts.c.author_id, null()],
+                            posts.c.is_answer, distinct=True)
 )
 
 NICE_ANSWER = Badge('bronce', 'nice-answer', lazy_gettext(u'Nice Answer'),
@@ -164,7 +373,8 @@ NICE_ANSWER = Badge('bronce', 'nice-answer', lazy_gettext(u'Nice Answer'),
     on_accept=lambda user, topic, post: _try_award_special_answer(post,
         NICE_ANSWER, 10) if post else None,
     on_vote=lambda user, post, delta: _try_award_special_answer(post,
-        NICE_ANSWER, 10)
+        NICE_ANSWER, 10),
+    backfill=lambda: _backfill_special_answer(10)
 )
 
 GOOD_ANSWER = Badge('silver', 'good-answer', lazy_gettext(u'Good Answer'),
@@ -172,35 +382,40 @@ GOOD_ANSWER = Badge('silver', 'good-answer', lazy_gettext(u'Good Answer'),
     on_accept=lambda user, topic, post: _try_award_special_answer(post,
         GOOD_ANSWER, 25) if post else None,
     on_vote=lambda user, post, delta: _try_award_special_answer(post,
-        GOOD_ANSWER, 25)
+        GOOD_ANSWER, 25),
+    backfill=lambda: _backfill_special_answer(25)
 )
 
 GREAT_ANSWER = Badge('gold', 'great-answer', lazy_gettext(u'Great Answer'),
     lazy_gettext(u'Answer was upvoted 75 times'),
     on_accept=lambda user, topic, post: _try_award_special_answer(post,
-        GOOD_ANSWER, 75) if post else None,
+        GREAT_ANSWER, 75) if post else None,
     on_vote=lambda user, post, delta: _try_award_special_answer(post,
-        GOOD_ANSWER, 75)
+        GREAT_ANSWER, 75),
+    backfill=lambda: _backfill_special_answer(75)
 )
 
 UNIQUE_ANSWER = Badge('platin', 'unique-answer', lazy_gettext(u'Unique Answer'),
     lazy_gettext(u'Answer was upvoted 150 times'),
     on_accept=lambda user, topic, post: _try_award_special_answer(post,
-        GOOD_ANSWER, 150) if post else None,
+        UNIQUE_ANSWER, 150) if post else None,
     on_vote=lambda user, post, delta: _try_award_special_answer(post,
-        GOOD_ANSWER, 150)
+        UNIQUE_ANSWER, 150),
+    backfill=lambda: _backfill_special_answer(150)
 )
 
 REVERSAL = Badge('gold', 'reversal', lazy_gettext(u'Reversal'),
     lazy_gettext(u'Provided answer of +20 score to a question of -5 score'),
     on_accept=lambda user, topic, post: _try_award_reversal(post) if post else None,
-    on_vote=lambda user, post, delta: _try_award_reversal(post)
+    on_vote=lambda user, post, delta: _try_award_reversal(post),
+    backfill=_backfill_reversal
 )
 
 SELF_LEARNER = Badge('silver', 'self-learner', lazy_gettext(u'Self-Learner'),
     lazy_gettext(u'Answered your own question with at least 4 upvotes'),
     on_accept=lambda user, topic, post: _try_award_self_learner(post) if post else None,
-    on_vote=lambda user, post, delta: _try_award_self_learner(post)
+    on_vote=lambda user, post, delta: _try_award_self_learner(post),
+    backfill=_backfill_self_learner
 )
 
 
@@ -212,6 +427,24 @@ badge_list = [CRITIC, EDITOR, INQUIRER, TROUBLESHOOTER, NICE_ANSWER,
 #: all the badges by key
 badges_by_id = dict((x.identifier, x) for x in badge_list)
 
+#: the badges with their callbacks by event
+badges_by_event = {}
+for _badge in badge_list:
+    for _event in Badge.events:
+        _cb = getattr(_badge, 'on_' + _event)
+        if _cb is not None:
+            badges_by_event.setdefault(_event, []).append((_badge, _cb))
+del _badge, _event, _cb
+
 
 # circular dependencies
-from solace.models import UserBadge, UserMessage
+from solace import settings
+from solace.database import session
+from solace.schema import badge_events, user_badges, users, posts, \
+     topics, votes
+from solace.utils.caching import get_cache
+from solace.models import User, Topic, Post, UserBadge, UserMessage
+
+#: the models that are stored as references in the badge queue
+_queued_models = {'user': User, 'topic': Topic, 'post': Post}
+_queued_model_names = dict((v, k) for k, v in _queued_models.iteritems())
@@ -13,9 +13,9 @@ import sys
 import time
 from threading import Lock
 from datetime import datetime
-from babel import Locale
 from sqlalchemy.types import TypeDecorator
 from sqlalchemy.engine.url import make_url
+from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy.interfaces import ConnectionProxy
 from sqlalchemy.orm.session import Session
 from sqlalchemy.orm.interfaces import SessionExtension, MapperExtension, \
@@ -101,6 +101,15 @@ def atomic_add(obj, column, delta, expire=False):
     })
     sess.execute(stmt)
 
+    # the change bypasses the unit of work, so the mapper extension never
+    # sees it.  Record it for the signals unless the object is pending, in
+    # which case the insert is recorded anyways.
+    obj_sess = orm.object_session(obj)
+    if obj_sess is not None and \
+       orm.attributes.instance_state(obj).key is not None:
+        obj_sess._model_changes.setdefault((type(obj),) + tuple(pk),
+                                           (obj, 'update'))
+
 
 def mapper(model, table, **options):
     """A mapper that hooks in standard extensions."""
@@ -140,7 +149,8 @@ class SignalTrackingMapperExtension(MapperExtension):
 
     def _record(self, model, operation):
         pk = tuple(orm.object_mapper(model).primary_key_from_instance(model))
-        orm.object_session(model)._model_changes[pk] = (model, operation)
+        key = (type(model),) + pk
+        orm.object_session(model)._model_changes[key] = (model, operation)
         return EXT_CONTINUE
 
 
@@ -154,6 +164,7 @@ class SignalEmittingSessionExtension(SessionExtension):
         return EXT_CONTINUE
 
     def after_commit(self, session):
+        session.memos.clear()
         d = session._model_changes
         if d:
             after_models_committed.emit(changes=d.values())
@@ -161,6 +172,7 @@ class SignalEmittingSessionExtension(SessionExtension):
         return EXT_CONTINUE
 
     def after_rollback(self, session):
+        session.memos.clear()
         session._model_changes.clear()
         return EXT_CONTINUE
 
@@ -169,10 +181,16 @@ class SignalTrackingSession(Session):
     """A session that tracks signals for later"""
 
     def __init__(self):
-        extension = [SignalEmittingSessionExtension()]
+        from solace.badges import BadgeQueueSessionExtension
+        extension = [SignalEmittingSessionExtension(),
+                     BadgeQueueSessionExtension()]
         Session.__init__(self, get_engine(), autoflush=True,
                          autocommit=False, extension=extension)
         self._model_changes = {}
+        self._badge_events = []
+        #: values models computed from the database.  They are only valid
+        #: for the current transaction and cleared on commit and rollback.
+        self.memos = {}
 
 
 class LocaleType(TypeDecorator):
@@ -190,7 +208,7 @@ class LocaleType(TypeDecorator):
 
     def process_result_value(self, value, dialect):
         if value is not None:
-            return Locale.parse(value)
+            return intern_locale(value)
 
     def is_mutable(self):
         return False
@@ -239,6 +257,32 @@ def drop_tables():
     metadata.drop_all(bind=get_engine())
 
 
+def add_missing_columns(table):
+    """Adds the columns of the table that do not exist in the database yet
+    and returns the names of the added and the skipped columns as tuple.
+    Only nullable columns without defaults and foreign keys can be added
+    that way, all other columns are skipped and have to be added by hand
+    (see SCHEMA_CHANGES).
+    """
+    engine = get_engine()
+    existing = set(x['name'] for x in
+                   Inspector.from_engine(engine).get_columns(table.name))
+    added = []
+    skipped = []
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        if not column.nullable or column.default is not None or \
+           column.server_default is not None or column.foreign_keys:
+            skipped.append(column.name)
+            continue
+        engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+            table.name, column.name, column.type.compile(
+                dialect=engine.dialect)))
+        added.append(column.name)
+    return added, skipped
+
+
 def add_query_debug_headers(request, response):
     """Add headers with the SQL info."""
     if settings.TRACK_QUERIES:
@@ -271,3 +315,4 @@ after_cursor_executed.connect(request_track_query)
 
 # circular dependencies
 from solace import settings
+from solace.i18n import intern_locale
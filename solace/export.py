@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+    solace.export
+    ~~~~~~~~~~~~~
+
+    Exports the knowledge base as newline delimited JSON (one JSON object
+    per line and row), optionally gzip compressed.  The rows are selected
+    in chunks ordered by their keys and every chunk continues after the
+    key of the last row, so the memory needed does not grow with the
+    size of the database.  Private user data (email addresses, password
+    hashes etc.), deleted topics and posts and the individual votes are
+    never exported.
+
+    :copyright: (c) 2010 by the Solace Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+import zlib
+from datetime import datetime
+from simplejson import JSONEncoder
+from babel import Locale
+from sqlalchemy import select, and_, or_
+
+from solace.database import get_engine
+from solace.schema import users, topics, posts, comments, tags, \
+     topic_tags
+from solace.utils.remoting import format_utc_datetime
+
+
+# the joins for the rows of topics and posts that are not deleted.  The
+# posts of a deleted topic are not marked as deleted themselves.
+_topic_tags_source = topic_tags.join(topics,
+    topic_tags.c.topic_id == topics.c.topic_id)
+_posts_source = posts.join(topics, posts.c.topic_id == topics.c.topic_id)
+_comments_source = comments.join(posts,
+    comments.c.post_id == posts.c.post_id).join(topics,
+    posts.c.topic_id == topics.c.topic_id)
+_visible_topics = topics.c.is_deleted == False
+_visible_posts = and_(posts.c.is_deleted == False, _visible_topics)
+
+
+#: the exported tables in the order they are exported with the exported
+#: columns, the columns the rows are ordered by, the table or join the
+#: rows are selected from and the filter for the exported rows.  Tables
+#: without primary key are ordered by a combination of columns that is
+#: unique.  Votes are only exported as the totals of the posts.
+EXPORTS = [
+    ('users', users, [users.c.user_id, users.c.username, users.c.real_name,
+                      users.c.reputation, users.c.upvotes, users.c.downvotes,
+                      users.c.bronce_badges, users.c.silver_badges,
+                      users.c.gold_badges, users.c.platin_badges,
+                      users.c.is_admin], [users.c.user_id], users, None),
+    ('tags', tags, list(tags.c), [tags.c.tag_id], tags, None),
+    ('topics', topics, list(topics.c), [topics.c.topic_id], topics,
+     _visible_topics),
+    ('topic_tags', topic_tags, list(topic_tags.c),
+     [topic_tags.c.topic_id, topic_tags.c.tag_id], _topic_tags_source,
+     _visible_topics),
+    ('posts', posts, list(posts.c), [posts.c.post_id], _posts_source,
+     _visible_posts),
+    ('comments', comments, list(comments.c), [comments.c.comment_id],
+     _comments_source, _visible_posts)
+]
+_exports_by_name = dict((x[0], x) for x in EXPORTS)
+
+# flush the output after this many bytes
+_chunk_size = 64 * 1024
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        return format_utc_datetime(obj)
+    if isinstance(obj, Locale):
+        return str(obj)
+    raise TypeError(repr(obj) + ' is not JSON serializable')
+
+
+_encoder = JSONEncoder(default=_default, separators=(',', ':'))
+
+
+def get_export_names(value=None):
+    """Returns the names of the tables to export from a comma separated
+    string.  If the value is `None` all tables are exported.  Unknown
+    names raise a `ValueError`.
+    """
+    if value is None:
+        return [x[0] for x in EXPORTS]
+    rv = []
+    for name in value.split(','):
+        name = name.strip()
+        if name not in _exports_by_name:
+            raise ValueError('unknown table %r' % name)
+        if name not in rv:
+            rv.append(name)
+    return rv
+
+
+def _after_key(key, values):
+    """The filter for the rows after the given key values."""
+    rv = key[0] > values[0]
+    if len(key) > 1:
+        rv = or_(rv, and_(key[0] == values[0],
+                          _after_key(key[1:], values[1:])))
+    return rv
+
+
+def iter_rows(connection, name, chunk_size=1000):
+    """Iterates over the exported rows of a table, `chunk_size` rows are
+    selected at once.
+    """
+    name, table, columns, key, source, filter = _exports_by_name[name]
+    last = None
+    while 1:
+        query = select(columns, filter, from_obj=[source], order_by=key,
+                       limit=chunk_size)
+        if last is not None:
+            query = query.where(_after_key(key, last))
+        rows = connection.execute(query).fetchall()
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            break
+        last = [rows[-1][column] for column in key]
+        del rows
+
+
+def iter_records(names=None, chunk_size=1000, engine=None):
+    """Iterates over the lines of the export.  Each line is a JSON object
+    with the columns of the row and the name of the table as ``#table``.
+    `names` is a list of the table names to export, defaults to all.
+    """
+    if engine is None:
+        engine = get_engine()
+    if names is None:
+        names = get_export_names()
+    connection = engine.connect()
+    try:
+        for name in names:
+            columns = [x.name for x in _exports_by_name[name][2]]
+            for row in iter_rows(connection, name, chunk_size):
+                record = dict(zip(columns, row))
+                record['#table'] = name
+                yield _encoder.encode(record) + '\n'
+    finally:
+        connection.close()
+
+
+def iter_chunks(lines, size=_chunk_size):
+    """Joins lines into chunks of about `size` bytes."""
+    buffer = []
+    length = 0
+    for line in lines:
+        buffer.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(buffer)
+            del buffer[:]
+            length = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def iter_gzip(chunks, level=6):
+    """Compresses the chunks into a gzip stream."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def iter_export(names=None, compress=False, chunk_size=1000, engine=None):
+    """Iterates over the chunks of the export, see :func:`iter_records`."""
+    rv = iter_chunks(iter_records(names, chunk_size, engine))
+    if compress:
+        rv = iter_gzip(rv)
+    return rv
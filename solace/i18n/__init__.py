@@ -22,17 +22,18 @@ from __future__ import with_statement
 import os
 import cPickle as pickle
 import struct
-from gettext import NullTranslations
+from gettext import NullTranslations, c2py
 from datetime import datetime, tzinfo, timedelta
 from time import strptime
 from weakref import WeakKeyDictionary
 
-from babel import Locale, dates, numbers, UnknownLocaleError
+from babel import Locale, dates, numbers, UnknownLocaleError, \
+     __version__ as babel_version
 from babel.support import Translations
 from werkzeug.exceptions import NotFound
 
 # these imports are designed to be safe to import from this point
-from solace.utils.lazystring import make_lazy_string, is_lazy_string
+from solace.utils.lazystring import is_lazy_string, _LazyString
 from solace.utils.ctxlocal import local
 
 __all__ = ['_', 'gettext', 'ngettext', 'lazy_gettext']
@@ -49,9 +50,36 @@ Locale.__ne__ = _Locale__ne__
 
 
 _translations = {}
+_catalogs = {}
+_locales = {}
 _js_translations = {'en': ''}
 
 
+def intern_locale(locale, sep='_'):
+    """Like `Locale.parse` but returns shared instances for the locales of
+    the language sections, so that rows and requests do not have to parse
+    the same identifiers over and over.  Other locales are parsed on each
+    call so that arbitrary identifiers from clients do not fill the table.
+    Raises the same exceptions as `Locale.parse`.
+    """
+    if isinstance(locale, Locale):
+        return locale
+    rv = _locales.get(locale)
+    if rv is not None:
+        return rv
+    if sep != '_':
+        rv = _locales.get(locale.replace(sep, '_'))
+        if rv is not None:
+            return rv
+    rv = Locale.parse(locale, sep=sep)
+    key = str(rv)
+    if key in settings.LANGUAGE_SECTIONS or \
+       key == settings.DEFAULT_LANGUAGE:
+        rv = _locales.setdefault(key, rv)
+        _locales[locale] = rv
+    return rv
+
+
 def get_translations():
     """Get the active translations or `None` if there are none."""
     request = getattr(local, 'request', None)
@@ -65,7 +93,7 @@ def get_js_translations(locale):
     If no such translation exists, `None` is returned.
     """
     try:
-        key = str(Locale.parse(locale))
+        key = str(intern_locale(locale))
     except UnknownLocaleError:
         return None
     rv = _js_translations.get(key)
@@ -87,18 +115,20 @@ def select_locale(choices):
     enabled = set(settings.LANGUAGE_SECTIONS)
     for locale, quality in choices:
         try:
-            locale = Locale.parse(locale, sep='-')
+            locale = intern_locale(locale, sep='-')
         except UnknownLocaleError:
             continue
         if str(locale) in enabled and \
            find_catalog(locale) is not None:
             return locale
-    return Locale.parse(settings.DEFAULT_LANGUAGE)
+    return intern_locale(settings.DEFAULT_LANGUAGE)
 
 
 def load_translations(locale):
-    """Return the translations for the locale."""
-    locale = Locale.parse(locale)
+    """Return the translations for the locale.  If an up to date
+    precompiled catalog exists next to the .mo file it is loaded instead.
+    """
+    locale = intern_locale(locale)
     key = str(locale)
     rv = _translations.get(key)
     if rv is None:
@@ -106,8 +136,11 @@ def load_translations(locale):
         if catalog is None:
             rv = NullTranslations()
         else:
-            with open(catalog, 'rb') as f:
-                rv = Translations(fileobj=f, domain=LOCALE_DOMAIN)
+            rv = load_precompiled_catalog(get_precompiled_filename(catalog),
+                                          catalog)
+            if rv is None:
+                with open(catalog, 'rb') as f:
+                    rv = Translations(fileobj=f, domain=LOCALE_DOMAIN)
         _translations[key] = rv
     return rv
 
@@ -115,13 +148,87 @@ def load_translations(locale):
 def find_catalog(locale):
     """Finds the catalog for the given locale on the path.  Return sthe
     filename of the .mo file if found, otherwise `None` is returned.
+    The result is remembered, so catalogs added at runtime are not found
+    before :func:`refresh_translations` is called.
     """
-    catalog = os.path.join(*[LOCALE_PATH, str(Locale.parse(locale)),
-                             'LC_MESSAGES', LOCALE_DOMAIN + '.mo'])
-    if os.path.isfile(catalog):
+    key = str(intern_locale(locale))
+    try:
+        return _catalogs[key]
+    except KeyError:
+        catalog = os.path.join(*[LOCALE_PATH, key, 'LC_MESSAGES',
+                                 LOCALE_DOMAIN + '.mo'])
+        if not os.path.isfile(catalog):
+            catalog = None
+        _catalogs[key] = catalog
         return catalog
 
 
+def refresh_translations():
+    """Forgets the loaded translations, known catalogs and interned
+    locales.
+    """
+    _translations.clear()
+    _catalogs.clear()
+    _locales.clear()
+
+
+def get_precompiled_filename(catalog):
+    """Returns the filename of the precompiled version of a .mo file."""
+    return os.path.splitext(catalog)[0] + '.catalog'
+
+
+def precompile_catalog(catalog):
+    """Parses the .mo file and stores the messages in the precompiled
+    form next to it.  The precompiled catalog is a pickle of the parsed
+    messages, so loading it does not have to decode the messages again.
+    Because it contains internals of the translations object it is only
+    valid for the Babel version that wrote it.  Returns the filename of
+    the precompiled catalog.
+    """
+    with open(catalog, 'rb') as f:
+        translations = Translations(fileobj=f, domain=LOCALE_DOMAIN)
+    filename = get_precompiled_filename(catalog)
+    with open(filename, 'wb') as f:
+        pickle.dump({
+            'babel':        babel_version,
+            'messages':     translations._catalog,
+            'info':         translations._info,
+            'charset':      translations._charset
+        }, f, pickle.HIGHEST_PROTOCOL)
+    return filename
+
+
+def load_precompiled_catalog(filename, catalog=None):
+    """Loads the translations from a precompiled catalog.  `None` is
+    returned if the precompiled catalog does not exist, cannot be loaded,
+    was written by a different Babel version or is older than the .mo
+    file `catalog` it was created from.
+    """
+    try:
+        if catalog is not None and \
+           os.path.getmtime(filename) < os.path.getmtime(catalog):
+            return None
+        with open(filename, 'rb') as f:
+            data = pickle.load(f)
+    except Exception:
+        # missing files as well as pickles referring to things that do
+        # not exist any longer.  The .mo file is the fallback anyways.
+        return None
+    if not isinstance(data, dict) or data.get('babel') != babel_version:
+        return None
+    rv = Translations(domain=LOCALE_DOMAIN)
+    rv.files = [filename]
+    rv._catalog = data['messages']
+    rv._info = data['info']
+    rv._charset = data['charset']
+    plural_forms = rv._info.get('plural-forms')
+    if plural_forms and 'plural=' in plural_forms:
+        rv.plural = c2py(plural_forms.split(';')[1].split('plural=')[1])
+    else:
+        rv.plural = lambda n: int(n != 1)
+    return rv
+
+
 def gettext(string):
     """Translate a given string to the language of the application."""
     translations = get_translations()
@@ -142,11 +249,41 @@ def ngettext(singular, plural, n):
     return translations.ungettext(singular, plural, n)
 
 
+class _LazyTranslation(_LazyString):
+    """The lazy string returned by `lazy_gettext`.  It remembers the
+    translated string for each translations object it was resolved with,
+    so that strings that are used over and over (such as the title of the
+    website or the names of the badges) are only looked up once per
+    locale.  The translations objects are referenced weakly so that
+    reloaded catalogs are not kept alive by the strings.
+    """
+    __slots__ = ('_memo',)
+
+    def __init__(self, string):
+        _LazyString.__init__(self, gettext, (string,))
+        self._memo = WeakKeyDictionary()
+
+    @property
+    def value(self):
+        translations = get_translations()
+        if translations is None:
+            return unicode(self._args[0])
+        rv = self._memo.get(translations)
+        if rv is None:
+            rv = self._memo[translations] = \
+                translations.ugettext(self._args[0])
+        return rv
+
+    def __setstate__(self, tup):
+        _LazyString.__setstate__(self, tup)
+        self._memo = WeakKeyDictionary()
+
+
 def lazy_gettext(string):
     """A lazy version of `gettext`."""
     if is_lazy_string(string):
         return string
-    return make_lazy_string(gettext, string)
+    return _LazyTranslation(string)
 
 
 def format_timedelta(datetime_or_timedelta, granularity='second'):
@@ -160,16 +297,19 @@ def format_timedelta(datetime_or_timedelta, granularity='second'):
 
 
 class Timezone(tzinfo):
-    """Helper for the timezone support."""
+    """Helper for the timezone support.  Use :func:`get_timezone` to get
+    a shared instance for an offset.
+    """
 
     def __init__(self, offset):
         self._offset = offset
+        self._utcoffset = timedelta(seconds=offset)
 
     def dst(self, dt):
         return timedelta(0)
 
     def utcoffset(self, dt):
-        return timedelta(seconds=self._offset)
+        return self._utcoffset
 
     def tzname(self, dt):
         return 'UTC%+d' % round(self._offset / 3600)
@@ -179,6 +319,23 @@ class Timezone(tzinfo):
 
 
 UTC = Timezone(0)
+_timezones = {0: UTC}
+_datetime_formatters = {}
+
+# the offsets come from the clients, so the caches are emptied if they
+# grow larger than this
+_cache_limit = 256
+
+
+def get_timezone(offset):
+    """Returns the timezone for the offset in seconds."""
+    rv = _timezones.get(offset)
+    if rv is None:
+        if len(_timezones) >= _cache_limit:
+            _timezones.clear()
+            _timezones[0] = UTC
+        rv = _timezones[offset] = Timezone(offset)
+    return rv
 
 
 def to_local_time(datetime):
@@ -187,12 +344,75 @@ def to_local_time(datetime):
     tzinfo = getattr(request, 'tzinfo', None)
     if tzinfo is None:
         return datetime
-    return datetime.replace(tzinfo=UTC).astimezone(tzinfo).replace(tzinfo=None)
+    return datetime + tzinfo.utcoffset(datetime)
+
+
+class DateTimeFormatter(object):
+    """Formats naive UTC datetimes for a locale, format and timezone
+    offset.  The Babel patterns are looked up once when the formatter is
+    created, calling the formatter only applies them.  Formatters are
+    shared, use :func:`get_datetime_formatter` to get one.
+    """
+
+    def __init__(self, locale, format='medium', offset=0):
+        self.locale = intern_locale(locale)
+        self.format = format
+        self.offset = timedelta(seconds=offset)
+        if format in ('full', 'long', 'medium', 'short'):
+            self.pattern = None
+            self.template = dates.get_datetime_format(format, self.locale)
+            self.date_pattern = dates.parse_pattern(
+                dates.get_date_format(format, self.locale))
+            self.time_pattern = dates.parse_pattern(
+                dates.get_time_format(format, self.locale))
+        else:
+            self.pattern = dates.parse_pattern(format)
+
+    def __call__(self, datetime):
+        datetime = (datetime + self.offset).replace(tzinfo=dates.UTC)
+        if self.pattern is not None:
+            return self.pattern.apply(datetime, self.locale)
+        return self.template \
+            .replace('{0}', self.time_pattern.apply(datetime.timetz(),
+                                                    self.locale)) \
+            .replace('{1}', self.date_pattern.apply(datetime.date(),
+                                                    self.locale))
+
+
+def get_datetime_formatter(format='medium', locale=None, offset=None):
+    """Returns the formatter for the format.  The locale and the timezone
+    offset default to the ones of the current request.
+    """
+    if locale is None or offset is None:
+        request = getattr(local, 'request', None)
+        if locale is None:
+            locale = get_locale()
+        if offset is None:
+            tzinfo = getattr(request, 'tzinfo', None)
+            offset = tzinfo is not None and tzinfo._offset or 0
+    key = (str(locale), format, offset)
+    rv = _datetime_formatters.get(key)
+    if rv is None:
+        if len(_datetime_formatters) >= _cache_limit:
+            _datetime_formatters.clear()
+        rv = _datetime_formatters[key] = DateTimeFormatter(locale, format,
+                                                            offset)
+    return rv
 
 
 def format_datetime(datetime, format='medium'):
-    datetime = to_local_time(datetime)
-    return dates.format_datetime(datetime, format, locale=get_locale())
+    """Formats a naive UTC datetime in the timezone and locale of the
+    current request.
+    """
+    return get_datetime_formatter(format)(datetime)
+
+
+def format_datetimes(datetimes, format='medium'):
+    """Like :func:`format_datetime` but formats a list of datetimes, for
+    example for list views.  The formatter is only looked up once.
+    """
+    formatter = get_datetime_formatter(format)
+    return [formatter(x) for x in datetimes]
 
 
 def format_number(number):
@@ -210,7 +430,7 @@ def list_languages():
 
     for locale in os.listdir(LOCALE_PATH):
         try:
-            l = Locale.parse(locale)
+            l = intern_locale(locale)
         except (ValueError, UnknownLocaleError):
             continue
         key = str(l)
@@ -225,7 +445,7 @@ def list_languages():
 
 def list_sections(sorted=True):
     """Like `list_languages` but returns the sections."""
-    rv = [(x, Locale.parse(x)) for x in settings.LANGUAGE_SECTIONS]
+    rv = [(x, intern_locale(x)) for x in settings.LANGUAGE_SECTIONS]
     if sorted:
         rv.sort(key=lambda x: x[1].display_name.lower())
     return rv
@@ -234,7 +454,7 @@ def list_sections(sorted=True):
 def has_section(language):
     """Does this language have a section?"""
     try:
-        language = str(Locale.parse(language))
+        language = str(intern_locale(language))
     except UnknownLocaleError:
         return False
     return language in settings.LANGUAGE_SECTIONS
@@ -245,7 +465,7 @@ def get_locale():
     request = getattr(local, 'request', None)
     if request is not None:
         return request.locale
-    return Locale.parse(settings.DEFAULT_LANGUAGE)
+    return intern_locale(settings.DEFAULT_LANGUAGE)
 
 
 _ = gettext
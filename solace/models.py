@@ -15,19 +15,20 @@ import hmac
 from math import log
 from random import randrange, choice
 from hashlib import sha1, md5
-from itertools import chain
 from datetime import datetime
-from sqlalchemy import select
+from sqlalchemy import select, bindparam
 from sqlalchemy.orm import relation, backref, synonym, Query, \
-     dynamic_loader, synonym, eagerload
+     dynamic_loader, synonym, eagerload, object_session
 from sqlalchemy.orm.interfaces import AttributeExtension
+from sqlalchemy.orm.attributes import instance_state, instance_dict, \
+     set_committed_value
 from sqlalchemy.ext.associationproxy import association_proxy
 from werkzeug import escape, ImmutableList, ImmutableDict, cached_property
-from babel import Locale
 
 from solace import settings
 from solace.database import atomic_add, mapper
 from solace.utils.formatting import format_creole
+from solace.i18n import intern_locale
 from solace.utils.remoting import RemoteObject
 from solace.database import session
 from solace.schema import users, topics, posts, votes, comments, \
@@ -36,6 +37,14 @@ from solace.schema import users, topics, posts, votes, comments, \
 
 
 _paragraph_re = re.compile(r'(?:\r?\n){2,}')
+#: the user attributes that are stored in the identity cache.  The
+#: password hash and the activation key are loaded on demand.
+_cached_user_attributes = ('id', 'username', 'email', 'real_name',
+                           'reputation', 'upvotes', 'downvotes',
+                           'bronce_badges', 'silver_badges', 'gold_badges',
+                           'platin_badges', 'is_admin', 'is_banned',
+                           'pending_messages', 'last_login')
+_uncached_user_attributes = ('pw_hash', 'activation_key')
 _key_chars = unicode(string.letters + string.digits)
 
 
@@ -100,6 +109,37 @@ class UserQuery(Query):
         return self.filter(User.id.in_(select([ua.user_id],
                                               ua.locale == str(locale))))
 
+    def get_cached(self, user_id):
+        """Like `get` but looks up the user in the identity cache first.
+        The cache only stores the columns needed for the layout and the
+        permission checks for `USER_CACHE_TIMEOUT` seconds and is
+        invalidated whenever a user is committed.
+        """
+        mapper = self._mapper_zero()
+        key = mapper.identity_key_from_primary_key([user_id])
+        user = self.session.identity_map.get(key)
+        if user is not None or not settings.USER_CACHE_TIMEOUT:
+            return user or self.get(user_id)
+
+        cache = get_cache().namespace('users')
+        values = cache.get(user_id)
+        if values is None:
+            user = self.get(user_id)
+            if user is not None:
+                cache.set(user_id, [getattr(user, attr) for attr
+                                    in _cached_user_attributes],
+                          settings.USER_CACHE_TIMEOUT)
+            return user
+
+        user = mapper.class_manager.new_instance()
+        for attr, value in zip(_cached_user_attributes, values):
+            set_committed_value(user, attr, value)
+        instance_state(user).key = key
+        user = self.session.merge(user, load=False)
+        instance_state(user).expire_attributes(instance_dict(user),
+                                               _uncached_user_attributes)
+        return user
+
 
 class User(RemoteObject):
     """Represents a user on the system."""
@@ -109,6 +149,7 @@ class User(RemoteObject):
     public_fields = ('id', 'username', 'upvotes', 'downvotes',
                      'reputation', 'real_name', 'is_admin', 'active_in',
                      'is_moderator', ('badges', 'get_badges_with_count'))
+    remote_relations = {'badges': ('_badges',)}
 
     def __init__(self, username, email, password=None, is_admin=False):
         self.username = username
@@ -116,7 +157,8 @@ class User(RemoteObject):
         self.pw_hash = None
         self.upvotes = self.downvotes = self.reputation = \
             self.bronce_badges = self.silver_badges = \
-            self.gold_badges = self.platin_badges = 0
+            self.gold_badges = self.platin_badges = \
+            self.pending_messages = 0
         self.real_name = u''
         self.is_admin = is_admin
         self.is_active = True
@@ -320,6 +362,35 @@ class User(RemoteObject):
         return ImmutableList(x[0] for x in sorted(self.activities.items(),
                                                   key=lambda x: -x[1].counter))
 
+    def get_awarded_badges(self):
+        """Returns a dict that maps the badges the user was awarded to
+        the set of payloads they were awarded with.  This is loaded with
+        one query and remembered until the transaction ends, so it's a lot
+        cheaper than the `badges` collection for lookups.
+        """
+        memos = _get_memos(self)
+        rv = memos.get((self, 'awarded_badges'))
+        if rv is None:
+            if self.id is None:
+                rows = [(x.badge, x.payload) for x in self._badges]
+            else:
+                rows = session.query(UserBadge.badge, UserBadge.payload) \
+                    .filter(UserBadge.user_id == self.id).all()
+            rv = {}
+            for badge, payload in rows:
+                rv.setdefault(badge, set()).add(payload)
+            memos[self, 'awarded_badges'] = rv
+        return rv
+
+    def has_badge(self, badge, payload=None):
+        """Checks if the user was awarded the badge.  If a payload is
+        given, it also has to match.
+        """
+        payloads = self.get_awarded_badges().get(badge)
+        if payloads is None:
+            return False
+        return payload is None or payload in payloads
+
     def get_badges_with_count(self):
         """Returns the badges with the count in a list.  The keys of the
         dict are the badge identifiers, not the badge objects.
@@ -329,6 +400,11 @@ class User(RemoteObject):
             result[badge.identifier] = result.get(badge.identifier, 0) + 1
         return result
 
+    @classmethod
+    def remote_prepare(cls, users, fields=None):
+        if fields is None or 'active_in' in fields:
+            load_user_activities(users)
+
     @simple_repr
     def __repr__(self):
         return repr(self.username)
@@ -343,6 +419,7 @@ class UserMessage(object):
         self.user = user
         self.text = text
         self.type = type
+        atomic_add(user, 'pending_messages', 1)
         session.add(self)
 
     @simple_repr
@@ -357,7 +434,7 @@ class TopicQuery(Query):
 
     def language(self, locale):
         """Filters by language."""
-        return self.filter_by(locale=Locale.parse(locale))
+        return self.filter_by(locale=intern_locale(locale))
 
     def unanswered(self):
         """Only return unanswered topics."""
@@ -383,7 +460,7 @@ class Topic(RemoteObject):
                      'question.text', 'question.rendered_text')
 
     def __init__(self, locale, title, text, user, date=None):
-        self.locale = Locale.parse(locale)
+        self.locale = intern_locale(locale)
         self.title = title
         # start with -1, when the question post is created the code will
         # increment it to zero automatically.
@@ -403,19 +480,38 @@ class Topic(RemoteObject):
     @property
     def guid(self):
         """The global unique ID for the topic."""
+        # the denormalized post ID avoids loading the question
+        post_id = self.question_post_id
+        if post_id is None:
+            post_id = self.question.id
         return u'tag:%s,%s:topic/%s' % (
             settings.TAG_AUTHORITY,
             self.date.strftime('%Y-%m-%d'),
-            self.question.id
+            post_id
         )
 
     @property
     def replies(self):
         return ImmutableList([x for x in self.posts if not x.is_question])
 
+    def _get_title(self):
+        return self._title
+
+    def _set_title(self, value):
+        self._title = value
+        self._slug = slugify(value)
+
+    title = property(_get_title, _set_title)
+    del _get_title, _set_title
+
     @property
     def slug(self):
-        return slugify(self.title) or None
+        """The slug for the URL, stored when the title is set."""
+        slug = self._slug
+        if slug is None:
+            # topics from before the slug column that were not backfilled
+            slug = slugify(self.title)
+        return slug or None
 
     def delete(self):
         """Just forward the call to the question."""
@@ -771,7 +867,7 @@ class _UserActivity(object):
 
     def __init__(self, user, locale):
         self.user = user
-        self.locale = Locale.parse(locale)
+        self.locale = intern_locale(locale)
         self.counter = 0
         self.first_activity = self.last_activity = datetime.utcnow()
         session.add(self)
@@ -829,7 +925,7 @@ class Tag(object):
 
     def __init__(self, name, locale):
         self.name = name
-        self.locale = Locale.parse(locale)
+        self.locale = intern_locale(locale)
         self.tagged = 0
         session.add(self)
 
@@ -853,33 +949,47 @@ class UserBadge(object):
 
     query = session.query_property()
 
-    def __init__(self, badge, payload=None):
+    def __init__(self, badge, payload=None, user=None):
         self.badge = badge
         self.awarded = datetime.utcnow()
         self.payload = payload
+        if user is not None:
+            # setting the user instead of appending to the badges of the
+            # user does not load all the badges of the user.
+            self.user = user
+            session.add(self)
 
 
-class BadgeExtension(AttributeExtension):
-    """Recounts badges on appening."""
+def _get_memos(obj):
+    """Returns the memos of the session of the object, see
+    :attr:`solace.database.SignalTrackingSession.memos`.  Objects without
+    session get a new dict, so nothing is remembered for them.
+    """
+    memos = getattr(object_session(obj), 'memos', None)
+    if memos is None:
+        memos = {}
+    return memos
 
-    def count_badges(self, user, badgeiter):
-        user.bronce_badges = user.silver_badges = \
-        user.gold_badges = user.platin_badges = 0
-        for badge in badgeiter:
-            if badge:
-                attr = badge.level + '_badges'
-                setattr(user, attr, getattr(user, attr, 0) + 1)
+
+class BadgeExtension(AttributeExtension):
+    """Counts badges on appending and removing.  This never has to
+    look at the other badges of the user.
+    """
 
     def append(self, state, value, initiator):
         user = state.obj()
-        self.count_badges(user, chain(user.badges, [value.badge]))
+        if value.badge:
+            atomic_add(user, value.badge.level + '_badges', 1)
+        awarded = _get_memos(user).get((user, 'awarded_badges'))
+        if awarded is not None:
+            awarded.setdefault(value.badge, set()).add(value.payload)
         return value
 
     def remove(self, state, value, initiator):
         user = state.obj()
-        badges = set(user.badges)
-        badges.discard(value.badge)
-        self.count_badges(user, badges)
+        if value.badge:
+            atomic_add(user, value.badge.level + '_badges', -1)
+        _get_memos(user).pop((user, 'awarded_badges'), None)
         return value
 
 
@@ -947,6 +1057,8 @@ mapper(Post, posts, properties=dict(
 ))
 mapper(Topic, topics, properties=dict(
     id=topics.c.topic_id,
+    title=synonym('_title', map_column=True),
+    _slug=topics.c.slug,
     author=relation(User, primaryjoin=
         topics.c.author_id == users.c.user_id),
     answer_author=relation(User, primaryjoin=
@@ -990,6 +1102,61 @@ mapper(PostRevision, post_revisions, properties=dict(
 ))
 
 
+def load_user_activities(users):
+    """Loads the activities of all the users that do not have them loaded
+    yet with one query instead of one query per user.
+    """
+    missing = dict((user.id, user) for user in users
+                   if not hasattr(user, '_activity_cache'))
+    if not missing:
+        return
+    for user in missing.itervalues():
+        user._activity_cache = {}
+    for activity in _UserActivity.query.filter(
+            _UserActivity.user_id.in_(missing.keys())):
+        missing[activity.user_id]._activity_cache[activity.locale] = activity
+
+
+def invalidate_cached_user(user_id):
+    """Removes a user from the identity cache."""
+    get_cache().namespace('users').delete(user_id)
+
+
+def _invalidate_cached_users(changes):
+    for model, operation in changes:
+        if isinstance(model, User):
+            invalidate_cached_user(model.id)
+
+
+def backfill_topic_slugs(chunk_size=500):
+    """Stores the slugs of topics that were created before the slug column
+    existed.  The topics are updated in chunks of `chunk_size` rows, each
+    chunk in its own transaction.  Returns the number of updated topics.
+    """
+    t = topics.c
+    update = topics.update(t.topic_id == bindparam('id'),
+                           values={t.slug: bindparam('new_slug')})
+    last_id = updated = 0
+    while 1:
+        rows = session.execute(select([t.topic_id, t.title],
+                                      (t.slug == None) &
+                                      (t.topic_id > last_id),
+                                      order_by=[t.topic_id],
+                                      limit=chunk_size)).fetchall()
+        if not rows:
+            break
+        session.execute(update, [dict(id=topic_id,
+                                      new_slug=slugify(title or u''))
+                                 for topic_id, title in rows])
+        session.commit()
+        last_id = rows[-1][0]
+        updated += len(rows)
+    return updated
+
+
 # circular dependencies
 from solace.utils.support import slugify
+from solace.utils.caching import get_cache
 from solace.badges import try_award
+from solace.signals import after_models_committed
+after_models_committed.connect(_invalidate_cached_users)
@@ -11,7 +11,7 @@
     :license: BSD, see LICENSE for more details.
 """
 from sqlalchemy import Table, Column, Integer, String, Text, DateTime, \
-     ForeignKey, Boolean, Float
+     ForeignKey, Boolean, Float, PickleType
 from solace.database import LocaleType, BadgeType, metadata
 
 
@@ -50,6 +50,9 @@ users = Table('users', metadata,
     Column('is_admin', Boolean, nullable=False),
     # true if the user is banned
     Column('is_banned', Boolean, nullable=False),
+    # the number of user messages not yet shown to the user.  This is
+    # checked before the messages are queried.
+    Column('pending_messages', Integer, nullable=False),
     # the date of the last login
     Column('last_login', DateTime),
     # the user's activation key.  If this is NULL, the user is already
@@ -78,7 +81,7 @@ user_badges = Table('user_badges', metadata,
     # the internal id
     Column('badge_id', Integer, primary_key=True),
     # who was the badge awarded to?
-    Column('user_id', Integer, ForeignKey('users.user_id')),
+    Column('user_id', Integer, ForeignKey('users.user_id'), index=True),
     # which badge?
     Column('badge', BadgeType(), index=True),
     # when was the badge awarded?
@@ -98,6 +101,41 @@ user_messages = Table('user_messages', metadata,
     Column('type', String(10))
 )
 
+badge_events = Table('badge_events', metadata,
+    # the internal id.  Events are processed in this order
+    Column('event_id', Integer, primary_key=True),
+    # the name of the event (vote, accept, reply, new_topic, edit)
+    Column('event', String(20), nullable=False),
+    # the arguments for the badge callbacks.  Models are stored as
+    # references and loaded again when the event is processed.
+    Column('arguments', PickleType(mutable=False), nullable=False),
+    # when did the event happen?
+    Column('created', DateTime, nullable=False)
+)
+
+mail_queue = Table('mail_queue', metadata,
+    # the internal id.  Mails are sent in this order
+    Column('mail_id', Integer, primary_key=True),
+    # the sender address
+    Column('from_addr', String(200), nullable=False),
+    # the recipient addresses, one per line
+    Column('to_addrs', Text, nullable=False),
+    # the formatted message
+    Column('message', Text, nullable=False),
+    # pending, sent or failed
+    Column('status', String(10), nullable=False),
+    # the number of failed attempts
+    Column('attempts', Integer, nullable=False),
+    # pending mails are not sent before this date
+    Column('next_attempt', DateTime, index=True),
+    # the error of the last failed attempt
+    Column('last_error', String(255)),
+    # when was the mail queued?
+    Column('created', DateTime, nullable=False),
+    # when was the mail sent?
+    Column('sent', DateTime)
+)
+
 topics = Table('topics', metadata,
     # each topic has an internal ID.  This ID is also displayed in the
     # URL next to an automatically slugified version of the title.
@@ -109,7 +147,12 @@ topics = Table('topics', metadata,
     # the title for the topic (actually, the title of the question, just
     # that posts do not have titles, so it's only stored here)
     Column('title', String(100)),
+    # the slugified title for the URL.  Updated when the title changes,
+    # rows created before the column existed are filled by the
+    # backfill_slugs command.
+    Column('slug', String(200)),
     # the ID of the first post, the post that is the actual question.
+    # Also used for the GUID so that the post does not have to be loaded.
     Column('question_post_id', Integer, ForeignKey('posts.post_id')),
     # the ID of the post that is accepted as answer.  If no answer is
     # accepted, this is None.
@@ -217,6 +260,16 @@ post_revisions = Table('post_revisions', metadata,
     Column('text', Text)
 )
 
+sessions = Table('sessions', metadata,
+    # the opaque session key that is stored in the cookie
+    Column('session_key', String(40), primary_key=True),
+    # the pickled session data
+    Column('data', PickleType(mutable=False)),
+    # the expiration date of the session.  Expired sessions are removed
+    # by the session collector.
+    Column('expires', DateTime, index=True)
+)
+
 
 # openid support
 openid_association = Table('openid_association', metadata,
@@ -120,6 +120,246 @@ class ResetDatabaseCommand(Command):
                                       self.email)
 
 
+class CollectSessionsCommand(Command):
+    description = 'removes expired server side sessions'
+    user_options = [
+        ('batch-size=', 'b',
+         'the number of sessions removed at once, defaults to 500')
+    ]
+
+    def initialize_options(self):
+        self.batch_size = 500
+
+    def finalize_options(self):
+        if not str(self.batch_size).isdigit():
+            raise DistutilsOptionError('batch size has to be numeric')
+
+    def run(self):
+        from solace.sessions import collect_expired_sessions
+        removed = collect_expired_sessions(int(self.batch_size))
+        print 'Removed %d expired sessions' % removed
+
+
+class AwardBadgesCommand(Command):
+    description = 'awards the badges for the events in the badge queue'
+    user_options = [
+        ('batch-size=', 'b',
+         'the number of events processed at once, defaults to 100'),
+        ('interval=', 'i',
+         'if given, keep running and check the queue every N seconds')
+    ]
+
+    def initialize_options(self):
+        self.batch_size = 100
+        self.interval = None
+
+    def finalize_options(self):
+        if not str(self.batch_size).isdigit():
+            raise DistutilsOptionError('batch size has to be numeric')
+        if self.interval is not None and not str(self.interval).isdigit():
+            raise DistutilsOptionError('interval has to be numeric')
+
+    def run(self):
+        from time import sleep
+        from solace.badges import award_queued_badges
+        while 1:
+            processed = award_queued_badges(int(self.batch_size))
+            print 'Processed %d badge events' % processed
+            if self.interval is None:
+                break
+            sleep(int(self.interval))
+
+
+class BackfillBadgesCommand(Command):
+    description = 'awards badges retroactively and recounts the badges'
+    user_options = [
+        ('badges=', 'b',
+         'comma separated identifiers of the badges to award, '
+         'defaults to all')
+    ]
+
+    def initialize_options(self):
+        self.badges = None
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        from solace.badges import backfill_badges, badges_by_id
+        badges = None
+        if self.badges is not None:
+            badges = []
+            for identifier in self.badges.split(','):
+                badge = badges_by_id.get(identifier.strip())
+                if badge is None:
+                    raise DistutilsOptionError('unknown badge %r' %
+                                               identifier.strip())
+                badges.append(badge)
+        awarded = backfill_badges(badges)
+        print 'Awarded %d badges' % awarded
+
+
+class BackfillSlugsCommand(Command):
+    description = 'adds and fills the slug column of existing topics'
+    user_options = [
+        ('chunk-size=', 'c',
+         'the number of topics updated per transaction, defaults to 500')
+    ]
+
+    def initialize_options(self):
+        self.chunk_size = 500
+
+    def finalize_options(self):
+        try:
+            self.chunk_size = int(self.chunk_size)
+        except ValueError:
+            raise DistutilsOptionError('chunk size must be an integer')
+
+    def run(self):
+        from solace.database import add_missing_columns
+        from solace.models import backfill_topic_slugs
+        from solace.schema import topics
+        added, skipped = add_missing_columns(topics)
+        for column in added:
+            print 'Added column %s.%s' % (topics.name, column)
+        for column in skipped:
+            print 'Skipped column %s.%s, add it by hand (see ' \
+                  'SCHEMA_CHANGES)' % (topics.name, column)
+        updated = backfill_topic_slugs(self.chunk_size)
+        print 'Stored the slugs of %d topics' % updated
+
+
+class ExportCommand(Command):
+    description = 'exports the knowledge base as newline delimited JSON'
+    user_options = [
+        ('output=', 'o',
+         'the file to write the export to, defaults to stdout'),
+        ('tables=', 't',
+         'comma separated names of the tables to export, defaults to all'),
+        ('gzip', 'z',
+         'compress the export with gzip'),
+        ('chunk-size=', 'c',
+         'the number of rows selected at once, defaults to 1000')
+    ]
+    boolean_options = ['gzip']
+
+    def initialize_options(self):
+        self.output = None
+        self.tables = None
+        self.gzip = False
+        self.chunk_size = 1000
+
+    def finalize_options(self):
+        from solace.export import get_export_names
+        try:
+            self.tables = get_export_names(self.tables)
+        except ValueError, e:
+            raise DistutilsOptionError(str(e))
+        try:
+            self.chunk_size = int(self.chunk_size)
+        except ValueError:
+            raise DistutilsOptionError('chunk size must be an integer')
+
+    def run(self):
+        from solace.export import iter_export
+        if self.output is None or self.output == '-':
+            f = sys.stdout
+        else:
+            f = open(self.output, 'wb')
+        try:
+            for chunk in iter_export(self.tables, self.gzip,
+                                     self.chunk_size):
+                f.write(chunk)
+        finally:
+            if f is not sys.stdout:
+                f.close()
+
+
+class SendMailsCommand(Command):
+    description = 'sends the mails from the mail queue'
+    user_options = [
+        ('batch-size=', 'b',
+         'the number of mails sent over one connection, defaults to 50'),
+        ('interval=', 'i',
+         'if given, keep running and check the queue every N seconds')
+    ]
+
+    def initialize_options(self):
+        self.batch_size = 50
+        self.interval = None
+
+    def finalize_options(self):
+        if not str(self.batch_size).isdigit():
+            raise DistutilsOptionError('batch size has to be numeric')
+        if self.interval is not None and not str(self.interval).isdigit():
+            raise DistutilsOptionError('interval has to be numeric')
+
+    def run(self):
+        from time import sleep
+        from solace.utils.mail import send_queued_mails
+        while 1:
+            sent, failed = send_queued_mails(int(self.batch_size))
+            print 'Sent %d mails, %d failed' % (sent, failed)
+            if self.interval is None:
+                break
+            sleep(int(self.interval))
+
+
+class CompileTemplatesCommand(Command):
+    description = 'compiles the templates into the template cache'
+    user_options = [
+        ('themes=', 't',
+         'comma separated names of the themes to compile, '
+         'defaults to all')
+    ]
+
+    def initialize_options(self):
+        self.themes = None
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        from solace import settings
+        from solace.templating import precompile_templates
+        if not settings.TEMPLATE_CACHE_DIR:
+            raise DistutilsSetupError('TEMPLATE_CACHE_DIR is not configured')
+        themes = None
+        if self.themes is not None:
+            themes = [x.strip() for x in self.themes.split(',')]
+        try:
+            compiled = precompile_templates(themes)
+        except RuntimeError, e:
+            raise DistutilsOptionError(str(e))
+        print 'Compiled %d templates' % compiled
+
+
+class ProfileImportsCommand(Command):
+    description = 'lists the modules that slow down the startup'
+    user_options = [
+        ('module=', 'm',
+         'the module to import, defaults to solace.application'),
+        ('limit=', 'l', 'the number of modules to list, defaults to 30')
+    ]
+
+    def initialize_options(self):
+        self.module = 'solace.application'
+        self.limit = 30
+
+    def finalize_options(self):
+        if not str(self.limit).isdigit():
+            raise DistutilsOptionError('limit has to be numeric')
+
+    def run(self):
+        from solace.utils.profiling import profile_imports
+        result = profile_imports(self.module)
+        print '%-50s %10s %10s' % ('Module', 'Self (ms)', 'Total (ms)')
+        for name, own, total in result[:int(self.limit)]:
+            print '%-50s %10.1f %10.1f' % (name, own * 1000, total * 1000)
+        print '%d imports took %.1f ms' % (
+            len(result), sum(x[1] for x in result) * 1000)
+
+
 class MakeTestDataCommand(Command):
     description = 'adds tons of test data into the database'
     user_options = [
@@ -313,7 +553,8 @@ class MakeTestDataCommand(Command):
 
 class CompileCatalogExCommand(compile_catalog):
     """Extends the standard catalog compiler to one that also creates
-    .js files for the strings that are needed in JavaScript.
+    .js files for the strings that are needed in JavaScript and the
+    precompiled catalogs that are loaded instead of the .mo files.
     """
 
     def run(self):
@@ -384,6 +625,22 @@ class CompileCatalogExCommand(compile_catalog):
             finally:
                 outfile.close()
 
+        # precompile the catalogs so that the processes do not have to
+        # parse the .mo files on startup
+        from solace.i18n import precompile_catalog
+        if self.output_file:
+            mo_files = [self.output_file]
+        else:
+            locales = self.locale and [self.locale] or \
+                      os.listdir(self.directory)
+            mo_files = [os.path.join(self.directory, locale, 'LC_MESSAGES',
+                                     self.domain + '.mo')
+                        for locale in locales]
+        for mo_file in mo_files:
+            if os.path.isfile(mo_file):
+                log.info('precompiling catalog %r', mo_file)
+                precompile_catalog(mo_file)
+
 
 class CompressDependenciesCommand(Command):
     """A distutils command for dep compression."""
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+    solace.sessions
+    ~~~~~~~~~~~~~~~
+
+    Implements the pluggable session interfaces.  By default the session
+    is stored in a signed cookie, but this means that the whole session
+    (CSRF tokens, flashes, locale, timezone) is re-sent with every modified
+    response and on every request.  The server side interfaces only store
+    an opaque session key in the cookie and keep the data in the database
+    or the cache.
+
+    Server side sessions are only written if they were modified or if the
+    expiration date has to be pushed forward.
+
+    :copyright: (c) 2010 by the Solace Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import with_statement
+from datetime import datetime, timedelta
+from threading import Lock
+from werkzeug import import_string
+from werkzeug.contrib.securecookie import SecureCookie
+from werkzeug.contrib.sessions import Session, generate_key
+from sqlalchemy import select
+
+
+_session_interface = None
+_session_interface_lock = Lock()
+
+
+def get_session_interface():
+    """Returns the session interface from the configuration."""
+    global _session_interface
+    with _session_interface_lock:
+        if _session_interface is None:
+            store = settings.SESSION_STORE
+            cls = _session_interfaces.get(store)
+            if cls is None:
+                cls = import_string(store)
+            _session_interface = cls()
+        return _session_interface
+
+
+def refresh_session_interface():
+    """Drops the session interface after a config change."""
+    global _session_interface
+    with _session_interface_lock:
+        _session_interface = None
+
+
+def collect_expired_sessions(batch_size=500):
+    """Removes expired sessions in batches of `batch_size` from the
+    store.  Returns the number of removed sessions.  Only the database
+    store has to be collected, the cache expires the sessions itself.
+    """
+    interface = get_session_interface()
+    if not hasattr(interface, 'collect_expired'):
+        return 0
+    return interface.collect_expired(batch_size)
+
+
+class SessionInterface(object):
+    """Baseclass for session interfaces."""
+
+    def open_session(self, request):
+        """Returns the session for the request.  The return value has to
+        be a dict that provides a `should_save` attribute.
+        """
+        raise NotImplementedError()
+
+    def save_session(self, request, session, response):
+        """Saves the session if necessary and updates the cookie on the
+        response.
+        """
+        raise NotImplementedError()
+
+    def regenerate_session(self, session):
+        """Called when the user logs in.  Interfaces that identify the
+        session by a key have to give the session a new one, so that a
+        key planted before the login cannot be used to take it over.
+        """
+
+
+class CookieSessionInterface(SessionInterface):
+    """Stores the pickled session in a signed cookie."""
+
+    def open_session(self, request):
+        return SecureCookie.load_cookie(request, settings.COOKIE_NAME,
+                                        settings.SECRET_KEY)
+
+    def save_session(self, request, session, response):
+        if session.should_save:
+            session.save_cookie(response, settings.COOKIE_NAME)
+
+
+class ServerSession(Session):
+    """A session that is stored on the server.  `expires` is the
+    expiration date in the store when the session was loaded.
+    """
+    __slots__ = Session.__slots__ + ('expires', 'old_sid')
+
+    def __init__(self, data, sid, new=False, expires=None):
+        Session.__init__(self, data, sid, new)
+        self.expires = expires
+        self.old_sid = None
+
+    @property
+    def needs_refresh(self):
+        """True if more than half of the lifetime of the session passed
+        since it was last written.
+        """
+        if self.expires is None:
+            return True
+        lifetime = timedelta(seconds=settings.SESSION_LIFETIME)
+        return self.expires - datetime.utcnow() < lifetime // 2
+
+
+class ServerSessionInterface(SessionInterface):
+    """Baseclass for interfaces that store the session data on the
+    server.  Subclasses have to implement `load`, `store` and `delete`.
+    """
+
+    def is_valid_key(self, sid):
+        return sid is not None and len(sid) == 40 and \
+               sid.isalnum() and sid.islower()
+
+    def open_session(self, request):
+        sid = request.cookies.get(settings.COOKIE_NAME)
+        if self.is_valid_key(sid):
+            rv = self.load(sid)
+            if rv is not None:
+                data, expires = rv
+                if expires > datetime.utcnow():
+                    return ServerSession(data, sid, expires=expires)
+        return ServerSession({}, generate_key(), new=True)
+
+    def regenerate_session(self, session):
+        if not session.new and session.old_sid is None:
+            session.old_sid = session.sid
+        session.sid = generate_key()
+        session.new = True
+        session.modified = True
+
+    def save_session(self, request, session, response):
+        if session.old_sid is not None:
+            self.delete(session.old_sid)
+        if not session:
+            if not session.new:
+                self.delete(session.sid)
+                response.delete_cookie(settings.COOKIE_NAME)
+            return
+        if session.should_save or session.needs_refresh:
+            expires = datetime.utcnow() + \
+                timedelta(seconds=settings.SESSION_LIFETIME)
+            self.store(session.sid, dict(session), expires, session.new)
+        if session.new:
+            response.set_cookie(settings.COOKIE_NAME, session.sid,
+                                httponly=True)
+
+    def load(self, sid):
+        """Returns a ``(data, expires)`` tuple for the session key or
+        `None` if the session does not exist.
+        """
+        raise NotImplementedError()
+
+    def store(self, sid, data, expires, new):
+        """Stores the data for the session key."""
+        raise NotImplementedError()
+
+    def delete(self, sid):
+        """Deletes the session with the given key."""
+        raise NotImplementedError()
+
+
+class DatabaseSessionInterface(ServerSessionInterface):
+    """Stores the sessions in the sessions table.  The statements are
+    executed outside of the ORM session, so storing a session never
+    interferes with the transaction of the request.
+    """
+
+    def load(self, sid):
+        s = sessions.c
+        row = get_engine().execute(select([s.data, s.expires],
+                                          s.session_key == sid)).fetchone()
+        if row is not None:
+            return row.data, row.expires
+
+    def store(self, sid, data, expires, new):
+        s = sessions.c
+        engine = get_engine()
+        if not new:
+            result = engine.execute(sessions.update(s.session_key == sid),
+                                    data=data, expires=expires)
+            if result.rowcount:
+                return
+        engine.execute(sessions.insert(), session_key=sid, data=data,
+                       expires=expires)
+
+    def delete(self, sid):
+        get_engine().execute(sessions.delete(sessions.c.session_key == sid))
+
+    def collect_expired(self, batch_size):
+        s = sessions.c
+        engine = get_engine()
+        now = datetime.utcnow()
+        removed = 0
+        while 1:
+            keys = [row.session_key for row in engine.execute(
+                select([s.session_key], s.expires < now).limit(batch_size))]
+            if not keys:
+                break
+            engine.execute(sessions.delete(s.session_key.in_(keys)))
+            removed += len(keys)
+            if len(keys) < batch_size:
+                break
+        return removed
+
+
+class CacheSessionInterface(ServerSessionInterface):
+    """Stores the sessions in the cache.  Keep in mind that the memory
+    cache is not shared between processes, so for multi-process
+    deployments this requires the memcached backend.  Sessions are lost
+    when they are evicted from the cache.
+    """
+
+    def load(self, sid):
+        return get_cache().namespace('sessions').get(sid)
+
+    def store(self, sid, data, expires, new):
+        get_cache().namespace('sessions').set(sid, (data, expires),
+                                              settings.SESSION_LIFETIME)
+
+    def delete(self, sid):
+        get_cache().namespace('sessions').delete(sid)
+
+
+_session_interfaces = {
+    'cookie':       CookieSessionInterface,
+    'database':     DatabaseSessionInterface,
+    'cache':        CacheSessionInterface
+}
+
+
+# circular dependencies
+from solace import settings
+from solace.database import get_engine
+from solace.schema import sessions
+from solace.utils.caching import get_cache
@@ -88,3 +88,10 @@ def describe_settings():
 
 revert_to_default()
 autodiscover_settings()
+
+# the signals cannot import the settings because they are imported
+# while the settings are being loaded
+import sys
+from solace import signals
+signals.settings = sys.modules[__name__]
+del sys, signals
@@ -9,18 +9,41 @@
     :license: BSD, see LICENSE for more details.
 """
 from __future__ import with_statement
+import logging
+from time import time
 from types import MethodType
 from inspect import ismethod, currentframe
 from weakref import WeakKeyDictionary, ref as weakref
-from threading import Lock
+from threading import Lock, Thread, local as thread_local
 from operator import itemgetter
 from contextlib import contextmanager
+from Queue import Queue, Full
 
 
 _subscribe_lock = Lock()
 _subscriptions = {}
+_snapshots = {}
 _ref_lock = Lock()
 _method_refs = WeakKeyDictionary()
+_pool_lock = Lock()
+_pool = None
+_deferred = thread_local()
+_stats_lock = Lock()
+_handler_stats = dict.fromkeys(('async_calls', 'async_errors',
+                                'async_overflows', 'deferred_calls',
+                                'deferred_errors'), 0)
+
+_profile_lock = Lock()
+_profile = {}
+
+# the signals are imported while the settings are loaded, so they cannot
+# be imported here.  solace.settings sets this once it is loaded, until
+# then signals are not profiled.  Everything in this module that needs
+# the settings goes through this attribute.
+settings = None
+
+#: the modes handlers can be connected with
+connection_modes = ('sync', 'async', 'after_response')
 
 
 def _ref(func):
@@ -59,6 +82,187 @@ class _MethodRef(object):
             return MethodType(func, obj, cls)
 
 
+def _update_snapshot(signal):
+    """Rebuilds the listener snapshot `emit` uses.  The snapshot is a
+    tuple of ``(weakref, is_method)`` tuples so that it does not keep the
+    listeners alive.  If one of the listeners is garbage collected, the
+    snapshot is dropped and rebuilt on the next emit.  Has to be called
+    with the subscribe lock held, returns the new snapshot.
+    """
+    def _on_collect(ref):
+        _snapshots.pop(signal, None)
+    d = _subscriptions.get(signal)
+    rv = _snapshots[signal] = tuple((weakref(func, _on_collect),
+                                     isinstance(func, _MethodRef), mode)
+                                    for func, mode in (d and d.items() or ()))
+    return rv
+
+
+def _get_snapshot(signal):
+    """Builds the listener snapshot for the signal if necessary."""
+    with _subscribe_lock:
+        rv = _snapshots.get(signal)
+        if rv is None:
+            rv = _update_snapshot(signal)
+        return rv
+
+
+def _count(key):
+    with _stats_lock:
+        _handler_stats[key] += 1
+
+
+def _call_isolated(signal, func, args, kind):
+    """Calls a handler that is not called from `emit` directly.  Errors
+    are logged and counted but never propagate.
+    """
+    try:
+        if settings is not None and settings.SIGNAL_PROFILING:
+            _call_profiled(signal, func, args)
+        else:
+            func(**args)
+    except Exception:
+        _count(kind + '_errors')
+        logging.getLogger('solace.signals').exception(
+            'Error in %s signal handler %r' % (kind, func))
+    else:
+        _count(kind + '_calls')
+
+
+class _HandlerPool(object):
+    """A bounded pool of threads that runs the async handlers."""
+
+    def __init__(self, workers, max_pending):
+        self.queue = Queue(max_pending)
+        for x in xrange(workers):
+            thread = Thread(target=self.work)
+            thread.setDaemon(True)
+            thread.start()
+
+    def submit(self, signal, func, args):
+        """Queues a call.  Returns `False` if the queue is full."""
+        try:
+            self.queue.put_nowait((signal, func, args))
+        except Full:
+            return False
+        return True
+
+    def work(self):
+        while 1:
+            signal, func, args = self.queue.get()
+            try:
+                _call_isolated(signal, func, args, 'async')
+            finally:
+                self.queue.task_done()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _HandlerPool(settings.SIGNAL_ASYNC_WORKERS,
+                                 settings.SIGNAL_ASYNC_QUEUE_SIZE)
+        return _pool
+
+
+def _call_async(signal, func, args):
+    # if the pool cannot keep up, the handler is called right away
+    # which slows down the emitting code instead of queueing forever.
+    if not (_pool or _get_pool()).submit(signal, func, args):
+        _count('async_overflows')
+        _call_isolated(signal, func, args, 'async')
+
+
+def _call_deferred(signal, func, args):
+    calls = getattr(_deferred, 'calls', None)
+    if calls is None:
+        _call_isolated(signal, func, args, 'deferred')
+    else:
+        calls.append((signal, func, args))
+
+
+def _call_profiled(signal, func, args):
+    """Calls a handler and records the time it took."""
+    start = time()
+    try:
+        return func(**args)
+    finally:
+        duration = time() - start
+        key = (repr(signal), _describe_handler(func))
+        with _profile_lock:
+            entry = _profile.get(key)
+            if entry is None:
+                entry = _profile[key] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += duration
+            entry[2] = max(entry[2], duration)
+
+
+def _describe_handler(func):
+    name = getattr(func, '__name__', None) or type(func).__name__
+    if ismethod(func):
+        name = '%s.%s' % (func.im_class.__name__, name)
+    return '%s.%s' % (getattr(func, '__module__', None) or '?', name)
+
+
+def get_profile():
+    """Returns the recorded handler timings as list of dicts with the
+    keys ``signal``, ``handler``, ``calls``, ``total`` and ``max``
+    (times in seconds), the slowest handlers first.  The timings are
+    only recorded if `SIGNAL_PROFILING` is enabled.
+    """
+    with _profile_lock:
+        items = _profile.items()
+        rv = [dict(signal=signal, handler=handler, calls=calls,
+                   total=total, max=max_)
+              for (signal, handler), (calls, total, max_) in items]
+    rv.sort(key=lambda x: -x['total'])
+    return rv
+
+
+def reset_profile():
+    """Forgets the recorded handler timings."""
+    with _profile_lock:
+        _profile.clear()
+
+
+def begin_deferred_handlers():
+    """Starts collecting the calls of handlers connected with the
+    ``'after_response'`` mode for the current thread.  Until this is
+    called (and after :func:`run_deferred_handlers`) these handlers are
+    called right away.
+    """
+    _deferred.calls = []
+
+
+def run_deferred_handlers():
+    """Calls the handlers collected since :func:`begin_deferred_handlers`.
+    The application calls this after the response was sent.
+    """
+    calls = getattr(_deferred, 'calls', None)
+    _deferred.calls = None
+    for signal, func, args in calls or ():
+        _call_isolated(signal, func, args, 'deferred')
+
+
+def wait_for_async_handlers():
+    """Blocks until all queued async handlers were called."""
+    if _pool is not None:
+        _pool.queue.join()
+
+
+def get_handler_stats():
+    """Returns a dict with the number of calls and errors of the async
+    and deferred handlers, the number of async handlers that were called
+    right away because the queue was full and the number of queued
+    calls.
+    """
+    with _stats_lock:
+        rv = dict(_handler_stats)
+    rv['async_pending'] = _pool is not None and _pool.queue.qsize() or 0
+    return rv
+
+
 def SIG(name, args=None):
     """Macroish signal definition.  Only use at global scope.  The
     following pieces of code are the same::
@@ -99,8 +303,9 @@ class Signal(object):
         self.__module__ = mod
         self.__name__ = name
         self.args = tuple(args or ())
+        self._arg_set = frozenset(self.args)
 
-    def connect(self, func):
+    def connect(self, func, mode='sync'):
         """Connect the function to the signal.  The function can be a regular
         Python function object or a bound method.  Internally a weak reference
         to this object is subscribed so it's not a good idea to pass an arbitrary
@@ -119,14 +324,26 @@ class Signal(object):
         which means that if you're connecting twice the function will still only
         be called once and the first disconnect closes the connection.
 
+        By default handlers are called synchronously by `emit`.  Handlers
+        connected with the ``'async'`` mode are called on a bounded pool of
+        threads, handlers connected with ``'after_response'`` are called
+        after the response of the current request was sent (or right away
+        outside of requests).  Both have no return value for `emit` and
+        exceptions are logged instead of propagated.  Keep in mind that
+        async handlers run in another thread, so they must not use the
+        request or the database session of the emitting code.
+
         :param func: the function to connect
+        :param mode: ``'sync'``, ``'async'`` or ``'after_response'``
         """
+        assert mode in connection_modes, 'unknown mode %r' % mode
         func = _ref(func)
         with _subscribe_lock:
             d = _subscriptions.get(self)
             if d is None:
                 d = _subscriptions[self] = WeakKeyDictionary()
-            d[func] = None
+            d[func] = mode
+            _update_snapshot(self)
 
     def is_connected(self, func):
         """Checks if the function is connected to the signal.
@@ -174,6 +391,7 @@ class Signal(object):
             d = _subscriptions.get(self)
             if d is not None:
                 d.pop(func, None)
+            _update_snapshot(self)
 
     def emit(self, **args):
         """Emits a signal with the given named arguments.  The arguments have
@@ -181,8 +399,8 @@ class Signal(object):
         is only performed in debug runs for performance reasons.  Arguments are
         passed as keyword arguments only.
 
-        The return value of the emit function is a list of the handlers and their
-        return values
+        The return value of the emit function is a list of the synchronous
+        handlers and their return values
 
         >>> foo = Signal('foo', ['arg'])
         >>> foo.emit(arg=42)
@@ -192,26 +410,43 @@ class Signal(object):
         :param args: the arguments for the signal.
         :return: a list of ``(handler, return_value)`` tuples.
         """
-        assert set(self.args) == set(args), \
+        assert self._arg_set == frozenset(args), \
             'passed arguments to not match signal signature'
-        listeners = _subscriptions.get(self)
+        snapshot = _snapshots.get(self)
+        if snapshot is None:
+            snapshot = _get_snapshot(self)
+        profiling = settings is not None and settings.SIGNAL_PROFILING
         result = []
-        if listeners is not None:
-            for func in listeners.keys():
-                # if a listener is a method reference we have to resolve it.
-                # there is a small window where this could be garbage collected
-                # while we have the reference so we handle the case when the
-                # resolving returns `None`.
-                if isinstance(func, _MethodRef):
-                    func = func.resolve()
-                    if func is None:
-                        continue
-                result.append((func, func(**args)))
+        for ref, is_method, mode in snapshot:
+            func = ref()
+            # the listener was garbage collected but the snapshot was
+            # not rebuilt yet.  If a listener is a method reference we
+            # have to resolve it which can fail for the same reason.
+            if func is None:
+                continue
+            if is_method:
+                func = func.resolve()
+                if func is None:
+                    continue
+            if mode == 'sync':
+                if profiling:
+                    result.append((func, _call_profiled(self, func, args)))
+                else:
+                    result.append((func, func(**args)))
+            elif mode == 'async':
+                _call_async(self, func, args)
+            else:
+                _call_deferred(self, func, args)
 
         # send the special broadcast signal to notify listeners of the
-        # broadcast signal that a signal was sent.
+        # broadcast signal that a signal was sent.  If nobody listens
+        # to the broadcast signal we don't have to bother.
         if self is not broadcast:
-            Signal.emit(broadcast, signal=self, args=args)
+            snapshot = _snapshots.get(broadcast)
+            if snapshot is None:
+                snapshot = _get_snapshot(broadcast)
+            if snapshot:
+                Signal.emit(broadcast, signal=self, args=args)
 
         return result
 
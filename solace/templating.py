@@ -9,13 +9,14 @@
     :license: BSD, see LICENSE for more details.
 """
 from __future__ import with_statement
+import os
 from os import path
 from itertools import chain
 from threading import Lock
 from werkzeug import escape
 from werkzeug.exceptions import NotFound
 from jinja2 import Environment, PackageLoader, BaseLoader, TemplateNotFound, \
-                   Markup
+     FileSystemBytecodeCache, Markup
 from solace.utils.ini import parse_ini
 from solace.utils.packs import PackManager
 
@@ -53,6 +54,18 @@ def split_path_safely(template):
     return pieces
 
 
+def list_templates_in(folder):
+    """Returns the names of all templates in a folder."""
+    rv = []
+    for dirpath, dirnames, filenames in os.walk(folder):
+        prefix = split_path_safely(dirpath[len(folder):]
+                                   .replace(path.sep, '/'))
+        for filename in filenames:
+            rv.append('/'.join(prefix + [filename]))
+    rv.sort()
+    return rv
+
+
 def get_theme(name=None):
     """Returns the specified theme of the one from the config.  If the
     theme does not exist, `None` is returned.
@@ -70,10 +83,80 @@ def get_theme(name=None):
             if path.isfile(path.join(theme_dir, 'theme.ini')):
                 rv = Theme(theme_dir)
                 if set_theme:
+                    jinja_env.bytecode_cache = get_bytecode_cache(rv)
+                    jinja_env.auto_reload = settings.TEMPLATE_AUTO_RELOAD
                     _theme = rv
                 return rv
 
 
+def list_themes():
+    """Returns the names of all available themes."""
+    rv = set()
+    for folder in chain(settings.THEME_PATH, DEFAULT_THEME_PATH):
+        if path.isdir(folder):
+            for name in os.listdir(folder):
+                if path.isfile(path.join(folder, name, 'theme.ini')):
+                    rv.add(name)
+    return sorted(rv)
+
+
+def get_bytecode_cache(theme):
+    """Returns the bytecode cache for the theme or `None` if the
+    bytecode cache is disabled.  Each theme has its own folder in the
+    `TEMPLATE_CACHE_DIR`.
+    """
+    if not settings.TEMPLATE_CACHE_DIR:
+        return None
+    folder = path.join(settings.TEMPLATE_CACHE_DIR, theme.id)
+    if not path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # another process might have created it in the meantime
+            if not path.isdir(folder):
+                raise
+    return FileSystemBytecodeCache(folder)
+
+
+def list_theme_templates(theme):
+    """Returns the names of all templates that can be loaded if the
+    theme is active.  This includes the builtin templates the theme
+    overrides with a bang prefix.
+    """
+    builtin = set(jinja_env.loader.list_templates())
+    overridden = set(theme.list_templates())
+    templates = builtin | overridden
+    templates.update('!' + x for x in overridden & builtin)
+    return sorted(templates)
+
+
+def precompile_templates(themes=None):
+    """Compiles the builtin templates and the templates of the given
+    themes (defaults to all themes) into the bytecode cache.  Returns the
+    number of compiled templates.
+    """
+    if not settings.TEMPLATE_CACHE_DIR:
+        raise RuntimeError('TEMPLATE_CACHE_DIR is not configured')
+    if themes is None:
+        themes = list_themes()
+    old_theme = settings.THEME
+    compiled = 0
+    try:
+        for name in themes:
+            settings.THEME = name
+            refresh_theme()
+            theme = get_theme()
+            if theme is None:
+                raise RuntimeError('theme %r not found' % name)
+            for template in list_theme_templates(theme):
+                jinja_env.get_template(template)
+                compiled += 1
+    finally:
+        settings.THEME = old_theme
+        refresh_theme()
+    return compiled
+
+
 def refresh_theme():
     """After a config change this unloads the theme to refresh it."""
     global _theme
@@ -102,6 +185,10 @@ class Theme(object):
             if key.startswith('packs.'):
                 self.packs.add_pack(key[6:], value.split())
 
+    def list_templates(self):
+        """Lists the templates the theme provides."""
+        return list_templates_in(self.template_path)
+
     def open_resource(self, filename):
         """Opens a resource from the static folder as fd."""
         pieces = split_path_safely(filename)
@@ -127,6 +214,10 @@ class SolaceThemeLoader(PackageLoader):
     def __init__(self):
         PackageLoader.__init__(self, 'solace')
 
+    def list_templates(self):
+        return list_templates_in(path.join(path.dirname(__file__),
+                                           'templates'))
+
     def get_source(self, environment, template):
         if template[:1] == '!':
             template = template[1:]
@@ -170,7 +261,8 @@ def render_template(template_name, **context):
     context['request'] = Request.current
     context['theme'] = get_theme()
     context['auth_system'] = get_auth_system()
-    return template.render(context)
+    with timed('template'):
+        return template.render(context)
 
 
 def get_macro(template_name, macro_name):
@@ -180,24 +272,43 @@ def get_macro(template_name, macro_name):
 
 
 def datetimeformat_filter(obj, html=True, prefixed=True):
-    rv = format_datetime(obj)
+    return _datetime_markup(obj, format_datetime(obj), html, prefixed)
+
+
+def datetimeformats(objects, attribute, html=True, prefixed=True):
+    """Formats the datetimes in `attribute` of a list of objects like the
+    `datetimeformat` filter, but with a single formatter lookup.  This is
+    useful for list views::
+
+        {% set dates = datetimeformats(topics, 'date') %}
+    """
+    values = [getattr(x, attribute) for x in objects]
+    return [_datetime_markup(obj, rv, html, prefixed) for obj, rv in
+            zip(values, format_datetimes(values))]
+
+
+def _datetime_markup(obj, rv, html, prefixed):
     if prefixed:
         rv = _(u'on %s') % rv
     if html:
         rv = u'<span class="datetime" title="%s">%s</span>' % (
-            obj.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            obj.isoformat()[:19] + 'Z',
             escape(rv)
         )
     return Markup(rv)
 
 
 from solace import settings
-from solace.application import Request, url_for
+from solace.application import Request, url_for, urls_for
 from solace.auth import get_auth_system
 from solace.packs import pack_mgr
-from solace.i18n import gettext, ngettext, format_datetime, format_number, _
+from solace.i18n import gettext, ngettext, format_datetime, format_datetimes, \
+     format_number, _
+from solace.utils.timing import timed
 jinja_env.globals.update(
     url_for=url_for,
+    urls_for=urls_for,
+    datetimeformats=datetimeformats,
     _=gettext,
     gettext=gettext,
     ngettext=ngettext,
@@ -62,6 +62,8 @@ class SolaceTestCase(unittest.TestCase):
     def setUp(self):
         from solace import database, settings, templating
         from solace.application import application
+        from solace.sessions import refresh_session_interface
+        from solace.utils.caching import refresh_cache
         self.__old_settings = dict(settings.__dict__)
         settings.revert_to_default()
         settings.DATABASE_URI = 'sqlite:///' + TEST_DATABASE
@@ -70,6 +72,8 @@ class SolaceTestCase(unittest.TestCase):
         settings.MAIL_LOG_FILE = tempfile.NamedTemporaryFile()
         database.refresh_engine()
         database.init()
+        refresh_cache()
+        refresh_session_interface()
         self.client = Client(application, TestResponse)
         self.is_logged_in = False
 
@@ -125,7 +129,9 @@ class SolaceTestCase(unittest.TestCase):
 
     def tearDown(self):
         from solace import database, settings
+        from solace.utils.caching import refresh_cache
         database.refresh_engine()
+        refresh_cache()
         try:
             os.remove(TEST_DATABASE)
         except OSError:
@@ -137,7 +143,8 @@ class SolaceTestCase(unittest.TestCase):
 
 def suite():
     from solace.tests import models, querycount, kb_views, core_views, \
-         templating, signals, link_check, validation
+         templating, signals, caching, mail, profiling, i18n, \
+         link_check, validation, urls, api
     suite = unittest.TestSuite()
     suite.addTest(models.suite())
     suite.addTest(querycount.suite())
@@ -145,6 +152,12 @@ def suite():
     suite.addTest(core_views.suite())
     suite.addTest(templating.suite())
     suite.addTest(signals.suite())
+    suite.addTest(caching.suite())
+    suite.addTest(mail.suite())
+    suite.addTest(profiling.suite())
+    suite.addTest(i18n.suite())
     suite.addTest(link_check.suite())
     suite.addTest(validation.suite())
+    suite.addTest(urls.suite())
+    suite.addTest(api.suite())
     return suite
@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+"""
+    solace.tests.api
+    ~~~~~~~~~~~~~~~~
+
+    Tests the API.
+
+    :copyright: (c) 2010 by the Solace Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import with_statement
+import sys
+import gzip
+import unittest
+from datetime import datetime
+from xml.sax.saxutils import quoteattr
+from xml.etree import ElementTree
+from StringIO import StringIO
+import simplejson
+from simplejson import loads
+from babel import Locale
+from werkzeug import escape, create_environ
+from solace.tests import SolaceTestCase
+from solace.tests.benchmarks import benchmark_case, compare
+
+from solace import models, settings
+from solace.database import session
+from solace.export import iter_records
+from solace.application import Request
+from solace.templating import render_template
+from solace.utils.api import iter_xml, debug_dump, XML_NS, \
+     _escaped_newline_re
+from solace.utils.ctxlocal import local
+from solace.utils.lazystring import is_lazy_string
+from solace.utils.remoting import parse_fields, remote_export_primitive, \
+     get_load_plan, RemoteObject, _recursive_getattr
+
+
+def legacy_remote_export(obj, fields=None):
+    """The remote export before the compiled exporters, for the
+    benchmark.
+    """
+    if isinstance(obj, RemoteObject):
+        result = {'#type': obj.remote_object_type}
+        for key in obj.public_fields:
+            if isinstance(key, tuple):
+                alias, key = key
+            else:
+                alias = key.rsplit('.', 1)[-1]
+            subfields = None
+            if fields is not None:
+                if alias not in fields:
+                    continue
+                subfields = fields[alias]
+            value = _recursive_getattr(obj, key)
+            if callable(value):
+                value = value()
+            result[alias] = legacy_remote_export(value, subfields)
+        return result
+    if is_lazy_string(obj):
+        return unicode(obj)
+    if isinstance(obj, datetime):
+        return {'#type': 'solace.datetime',
+                'value': obj.strftime('%Y-%m-%dT%H:%M:%SZ')}
+    if isinstance(obj, Locale):
+        return unicode(str(obj))
+    if isinstance(obj, dict):
+        return dict((key, legacy_remote_export(value, fields))
+                    for key, value in obj.iteritems())
+    if hasattr(obj, '__iter__'):
+        return [legacy_remote_export(x, fields) for x in obj]
+    return obj
+
+
+def legacy_dump_xml(obj):
+    """The XML serializer before the streaming writer, for the
+    benchmark.
+    """
+    def _dump(obj):
+        if isinstance(obj, dict):
+            d = dict(obj)
+            obj_type = d.pop('#type', None)
+            key = start = 'dict'
+            if obj_type is not None:
+                if obj_type.startswith('solace.'):
+                    key = start = obj_type[7:]
+                else:
+                    start += ' type=%s' % quoteattr(obj_type)
+            return u'<%s>%s</%s>' % (
+                start,
+                u''.join((u'<%s>%s</%s>' % (key, _dump(value), key)
+                         for key, value in d.iteritems())),
+                key
+            )
+        if isinstance(obj, (tuple, list)):
+            def _item_dump(obj):
+                if not isinstance(obj, (tuple, list, dict)):
+                    return u'<item>%s</item>' % _dump(obj)
+                return _dump(obj)
+            return u'<list>%s</list>' % (u''.join(map(_item_dump, obj)))
+        if isinstance(obj, bool):
+            return obj and u'yes' or u'no'
+        return escape(unicode(obj))
+    return (
+        u'<?xml version="1.0" encoding="utf-8"?>'
+        u'<result xmlns="%s">%s</result>'
+    ) % (XML_NS, _dump(obj))
+
+
+def xml_tree(data):
+    """Parses XML into nested tuples, ignoring the order of the elements
+    in dicts (it differs between a dict and its copy).
+    """
+    def _convert(element):
+        children = [_convert(x) for x in element]
+        if element.tag.rsplit('}', 1)[-1] != 'list':
+            children.sort()
+        return (element.tag, sorted(element.items()), element.text,
+                tuple(children))
+    return _convert(ElementTree.fromstring(data.encode('utf-8')))
+
+
+def make_questions(count=50, replies=5):
+    """Creates questions with replies and returns the exported data of
+    the questions with the replies like "get question" returns it.
+    """
+    users = [models.User('author%d' % x, 'author%d@example.com' % x)
+             for x in xrange(10)]
+    for x in xrange(count):
+        topic = models.Topic('en', u'Topic <%d> & \xfc' % x,
+                             'text\n' * 20, users[x % 10])
+        for y in xrange(replies):
+            models.Post(topic, users[y % 10], 'reply <b>%d</b>\n' % y * 10)
+    session.commit()
+    return [remote_export_primitive({'question': x, 'replies': x.replies})
+            for x in models.Topic.query.all()]
+
+
+class APITestCase(SolaceTestCase):
+
+    def create_test_data(self):
+        users = [models.User('user%d' % x, 'user%d@example.com' % x)
+                 for x in xrange(5)]
+        for x in xrange(7):
+            topic = models.Topic('en', 'Topic %d' % x, 'text', users[x % 5])
+            models.Post(topic, users[(x + 1) % 5], 'reply')
+        session.commit()
+        session.remove()
+
+    def get(self, url, status=200):
+        response = self.client.get('/api/1.0' + url + '&format=json')
+        self.assertEqual(response.status_code, status)
+        if status == 200:
+            return loads(response.data), response.sql_query_count
+
+    def test_parse_fields(self):
+        """Parsing of the fields argument"""
+        self.assertEqual(parse_fields('id, title,author.username,'),
+                         {'id': None, 'title': None,
+                          'author': {'username': None}})
+        self.assertEqual(parse_fields('author.id,author'), {'author': None})
+        self.assertEqual(parse_fields('author,author.id'), {'author': None})
+
+    def test_compiled_exporters(self):
+        """The compiled exporters export the same as before"""
+        self.create_test_data()
+        topic = models.Topic.query.get(1)
+        topic.bind_tags(['foo'])
+        models.Comment(topic.question, topic.author, 'comment')
+        session.commit()
+        objects = models.Topic.query.all() + models.Post.query.all() + \
+                  models.User.query.all() + models.Comment.query.all()
+        self.assertEqual(remote_export_primitive(objects),
+                         legacy_remote_export(objects))
+        for fields in 'id,author.username', 'title,text,author,topic_id':
+            fields = parse_fields(fields)
+            self.assertEqual(remote_export_primitive(objects, fields),
+                             legacy_remote_export(objects, fields))
+        # dotted fields are None if an object in between is None
+        topic = models.Topic('en', 'New', 'text', topic.author)
+        topic.question = None
+        self.assertEqual(topic.remote_export(parse_fields('text')),
+                         {'#type': 'solace.question', 'text': None})
+        session.rollback()
+
+    def test_xml_serializer(self):
+        """The streamed XML is the same as before"""
+        data = {'#type': 'foo.bar', 'flags': [True, False, None],
+                'nested': [[1, 2], {'a': u'<\xfc>'}, ()], 'empty': {},
+                'questions': make_questions(3, 2)}
+        self.assertEqual(xml_tree(u''.join(iter_xml(data))),
+                         xml_tree(legacy_dump_xml(data)))
+        self.assertEqual(u''.join(iter_xml([])), legacy_dump_xml([]))
+
+        response = self.client.get('/api/1.0/questions/1?format=xml')
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/xml; charset=utf-8')
+        self.assert_(response.is_streamed)
+        self.assert_(response.data.startswith('<?xml'))
+        self.assert_(response.data.endswith('</result>'))
+
+    def test_debug_serializer(self):
+        """The streamed debug dump is the same as before"""
+        data = make_questions(2, 1)
+        Request(create_environ('/api/1.0/questions/?format=debug'))
+        try:
+            dump = simplejson.dumps(data, ensure_ascii=False, indent=2)
+            self.assertEqual(u''.join(debug_dump(data)), render_template(
+                'api/debug_dump.html',
+                dump=_escaped_newline_re.sub('\n', dump)))
+        finally:
+            local.request = None
+
+        response = self.client.get('/api/1.0/questions/1?format=debug')
+        self.assertEqual(response.headers['Content-Type'],
+                         'text/html; charset=utf-8')
+        self.assert_(response.is_streamed)
+        self.assert_('&#34;#type&#34;: &#34;solace.question&#34;' in
+                     response.data.split('<pre>', 1)[1].split('</pre>')[0])
+
+    def test_load_plans(self):
+        """Eager loading derived from the public fields"""
+        self.assertEqual(get_load_plan(models.Topic).paths,
+                         ['author', 'author._badges', 'question'])
+        self.assertEqual(get_load_plan(models.Post).paths,
+                         ['author', 'author._badges', 'editor',
+                          'editor._badges'])
+        self.assertEqual(get_load_plan(models.Topic, parse_fields(
+            'id,author.username,text')).paths, ['author', 'question'])
+        self.assertEqual(get_load_plan(models.User,
+                                       parse_fields('id')).paths, [])
+        # the ID of the topic is known without loading the topic
+        self.assertEqual(get_load_plan(models.Post, parse_fields(
+            'id,topic_id')).paths, [])
+
+        # the number of queries does not depend on the number of objects
+        counts = []
+        for count in 2, 12:
+            users = [models.User('user%d_%d' % (count, x), 'x@example.com')
+                     for x in xrange(count)]
+            for x in xrange(count):
+                topic = models.Topic('en', 'Topic', 'text', users[x])
+                for y in xrange(count):
+                    reply = models.Post(topic, users[y], 'reply')
+                    reply.editor = users[-y]
+            session.commit()
+            topic_id = topic.id
+            session.remove()
+            counts.append([self.get(url)[1] for url in
+                           '/questions/?limit=50&count=no',
+                           '/users/?limit=50&count=no',
+                           '/questions/%d?' % topic_id])
+        self.assertEqual(counts, [[2, 2, 3], [2, 2, 3]])
+
+    def test_cursor_pagination(self):
+        """Paginating API lists with cursors"""
+        self.create_test_data()
+        data, queries = self.get('/questions/?limit=3')
+        self.assertEqual(data['total_count'], 7)
+        self.assertEqual(data['offset'], 0)
+        self.assertEqual(queries, 3)
+        seen = [x['id'] for x in data['questions']]
+        while 'next_cursor' in data:
+            data, queries = self.get('/questions/?limit=3&count=no&cursor='
+                                     + data['next_cursor'])
+            self.assert_('total_count' not in data)
+            self.assertEqual(queries, 2)
+            seen.extend(x['id'] for x in data['questions'])
+        # IDs are assigned on flush, not in the order of the dates
+        topics = models.Topic.query.order_by(models.Topic.date.desc(),
+                                             models.Topic.id.desc())
+        self.assertEqual(seen, [x.id for x in topics])
+
+        data, queries = self.get('/users/?limit=3')
+        self.assertEqual([x['username'] for x in data['users']],
+                         ['user0', 'user1', 'user2'])
+        data, queries = self.get('/users/?limit=3&cursor=' +
+                                 data['next_cursor'])
+        self.assertEqual([x['username'] for x in data['users']],
+                         ['user3', 'user4'])
+        self.assert_('next_cursor' not in data)
+
+        self.get('/questions/?cursor=foo', 400)
+        self.get('/questions/?count=maybe', 400)
+
+    def test_fields_and_bulk_fetch(self):
+        """Selecting fields and fetching lists of IDs"""
+        self.create_test_data()
+        data, queries = self.get('/questions/?ids=3,1,99&count=no'
+                                 '&fields=id,title,author.username')
+        self.assertEqual(queries, 1)
+        self.assertEqual(data['questions'], [
+            {'#type': 'solace.question', 'id': 3, 'title': 'Topic 2',
+             'author': {'#type': 'solace.user', 'username': 'user2'}},
+            {'#type': 'solace.question', 'id': 1, 'title': 'Topic 0',
+             'author': {'#type': 'solace.user', 'username': 'user0'}}
+        ])
+
+        data, queries = self.get('/users/?ids=2,1')
+        self.assertEqual(queries, 2)
+        self.assertEqual([x['id'] for x in data['users']], [2, 1])
+        self.assertEqual(data['users'][0]['active_in'], ['en'])
+        self.get('/users/?ids=1,x', 400)
+        self.get('/users/?ids=' + ','.join(map(str, range(51))), 400)
+
+        data, queries = self.get('/questions/1?replies=no&fields=id')
+        self.assertEqual(data, {'question': {'#type': 'solace.question',
+                                             'id': 1}})
+        data, queries = self.get('/questions/1?fields=text')
+        self.assertEqual(queries, 1)
+        self.assertEqual([x['text'] for x in data['replies']], ['reply'])
+
+    def test_export(self):
+        """Streaming export of the knowledge base"""
+        self.create_test_data()
+        user = models.User.query.get(1)
+        topic = models.Topic.query.get(1)
+        topic.bind_tags(['foo', 'bar'])
+        user.upvote(models.Post.query.get(2))
+        models.Comment(topic.question, user, 'comment').date = \
+            datetime(1899, 12, 31, 12, 30)
+        # deleted topics and posts are not exported, neither are the
+        # tags of deleted topics and the comments on their posts
+        deleted_topic = models.Topic.query.get(2)
+        deleted_topic.bind_tags(['foo'])
+        models.Comment(deleted_topic.replies[0], user, 'comment')
+        deleted_topic.question.delete()
+        models.Topic.query.get(3).replies[0].delete()
+        session.commit()
+
+        # the export is disabled by default
+        self.assertEqual(self.client.get('/api/1.0/export').status_code, 404)
+        settings.API_EXPORT_ENABLED = True
+
+        response = self.client.get('/api/1.0/export')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/x-ndjson')
+        self.assert_('ETag' not in response.headers)
+        records = map(loads, response.data.splitlines())
+        counts = {}
+        for record in records:
+            counts[record['#table']] = counts.get(record['#table'], 0) + 1
+        self.assertEqual(counts, {'users': 5, 'tags': 2, 'topics': 6,
+                                  'topic_tags': 2, 'posts': 11,
+                                  'comments': 1})
+        self.assert_(not [x for x in records if x.get('is_deleted') or
+                          x.get('topic_id') == 2])
+        self.assertEqual([x['date'] for x in records
+                          if x['#table'] == 'comments'],
+                         ['1899-12-31T12:30:00Z'])
+        self.assertEqual([x['votes'] for x in records
+                          if x['#table'] == 'posts' and x['post_id'] == 2],
+                         [1])
+        self.assert_(not [x for x in records if 'email' in x or
+                          'pw_hash' in x])
+        self.assertEqual(records[0], {'#table': 'users', 'user_id': 1,
+            'username': 'user0', 'real_name': '', 'reputation': 0,
+            'upvotes': 1, 'downvotes': 0, 'bronce_badges': 1,
+            'silver_badges': 0, 'gold_badges': 0, 'platin_badges': 0,
+            'is_admin': False})
+
+        # small chunks give the same result
+        self.assertEqual(map(loads, iter_records(chunk_size=1)), records)
+        self.assertEqual(map(loads, iter_records(['comments', 'topic_tags'],
+                                                 chunk_size=1)),
+                         [x for x in records if x['#table'] == 'comments'] +
+                         [x for x in records if x['#table'] == 'topic_tags'])
+
+        response = self.client.get('/api/1.0/export?tables=topics&gzip=yes')
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/x-gzip')
+        data = gzip.GzipFile(fileobj=StringIO(response.data)).read()
+        self.assertEqual(map(loads, data.splitlines()),
+                         [x for x in records if x['#table'] == 'topics'])
+
+        self.assertEqual(self.client.get('/api/1.0/export?tables=foo')
+                         .status_code, 400)
+        settings.API_EXPORT_ENABLED = False
+        self.assertEqual(self.client.get('/api/1.0/export').status_code, 404)
+
+
+def benchmark(number=20):
+    """Prints the time per question for the old and the compiled
+    remote export.
+    """
+    with benchmark_case(APITestCase, 'test_compiled_exporters'):
+        users = [models.User('user%d' % x, 'user%d@example.com' % x)
+                 for x in xrange(20)]
+        for x in xrange(50):
+            models.Topic('en', 'Topic %d' % x, 'text', users[x % 20])
+        session.commit()
+        data = {'questions': models.Topic.query.all()}
+        compare([('legacy', lambda: legacy_remote_export(data)),
+                 ('compiled', lambda: remote_export_primitive(data))],
+                number, 'us per question', len(data['questions']))
+
+
+def benchmark_xml(number=5):
+    """Prints the time and the size of the largest string for the old
+    and the streamed XML serializer.
+    """
+    with benchmark_case(APITestCase, 'test_xml_serializer'):
+        data = make_questions(50, 10)
+        for name, func in ('legacy', lambda: [legacy_dump_xml(data)]), \
+                          ('streamed', lambda: iter_xml(data)):
+            largest = max(len(x) for x in func())
+            compare([(name, lambda: list(func()))], number, 'ms',
+                    scale=1e3, label='largest chunk %d characters, ' %
+                    largest)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(APITestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['bench']:
+        benchmark()
+        benchmark_xml()
+    else:
+        unittest.main(defaultTest='suite')
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+    solace.tests.benchmarks
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Helpers for the benchmarks that compare optimized implementations
+    with frozen copies of the replaced ones.  The benchmarks live in the
+    test modules next to the tests of the code they measure and are not
+    part of the test suite.  Run them with::
+
+        python -m solace.tests.<module> bench
+
+    :copyright: (c) 2010 by the Solace Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import with_statement
+from contextlib import contextmanager
+from timeit import Timer
+
+
+@contextmanager
+def benchmark_case(cls, name):
+    """Sets up the test case `cls` for the test method `name` (and with
+    it a fresh test database) for the duration of a benchmark and
+    returns it for its helpers.
+    """
+    case = cls(name)
+    case.setUp()
+    try:
+        yield case
+    finally:
+        case.tearDown()
+
+
+def compare(candidates, number, unit, items=1, scale=1e6, label=''):
+    """Times the candidates, a list of ``(name, func)`` tuples, and prints
+    the time per item for each of them.  The times are multiplied with
+    `scale`, the default prints microseconds.
+    """
+    for name, func in candidates:
+        seconds = Timer(func).timeit(number)
+        print '%-9s %s%.2f %s' % (name, label, seconds / number / items *
+                                  scale, unit)
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+    solace.tests.caching
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Tests the cache backends.  The memcached backend is tested against a
+    minimal stand-in server that speaks the text protocol.
+
+    :copyright: (c) 2010 by the Solace Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+import shutil
+import socket
+import tempfile
+import unittest
+from time import time
+from threading import Thread
+from SocketServer import ThreadingTCPServer, StreamRequestHandler
+from solace.tests import SolaceTestCase
+
+from solace import settings
+from solace.utils import caching
+
+
+class MemcachedStandIn(ThreadingTCPServer):
+    """Implements the subset of the memcached protocol the cache uses."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                    MemcachedStandInHandler)
+        self.items = {}
+        self.connections = set()
+        self.thread = Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    @property
+    def address(self):
+        return '%s:%d' % self.server_address
+
+    def handle_error(self, request, client_address):
+        # connections are reset when the server is closed
+        pass
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        for con in list(self.connections):
+            try:
+                con.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                # the client closed the connection already
+                pass
+
+
+class MemcachedStandInHandler(StreamRequestHandler):
+
+    def handle(self):
+        self.server.connections.add(self.connection)
+        items = self.server.items
+        while 1:
+            line = self.rfile.readline()
+            if not line:
+                break
+            args = line.split()
+            cmd = args.pop(0)
+            if cmd == 'get':
+                for key in args:
+                    item = items.get(key)
+                    if item is not None and (not item[1] or item[1] > time()):
+                        self.wfile.write('VALUE %s 0 %d\r\n%s\r\n' %
+                                         (key, len(item[0]), item[0]))
+                self.wfile.write('END\r\n')
+            elif cmd == 'set':
+                key, flags, exptime, length = args
+                value = self.rfile.read(int(length) + 2)[:-2]
+                exptime = int(exptime)
+                if 0 < exptime <= 60 * 60 * 24 * 30:
+                    exptime += time()
+                items[key] = (value, exptime)
+                self.wfile.write('STORED\r\n')
+            elif cmd == 'delete':
+                found = items.pop(args[0], None) is not None
+                self.wfile.write(found and 'DELETED\r\n' or 'NOT_FOUND\r\n')
+            elif cmd == 'flush_all':
+                items.clear()
+                self.wfile.write('OK\r\n')
+            elif cmd == 'stats':
+                self.wfile.write('STAT curr_items %d\r\nSTAT evictions 0\r\n'
+                                 'END\r\n' % len(items))
+            else:
+                self.wfile.write('ERROR\r\n')
+
+
+class CachingTestCase(SolaceTestCase):
+
+    def check_basic_operations(self, cache):
+        cache.set('foo', {'bar': [1, 2, 3]})
+        self.assertEqual(cache.get('foo'), {'bar': [1, 2, 3]})
+        self.assertEqual(cache.get('missing', 42), 42)
+        cache.set_many({'a': 1, 'b': u'zwei'})
+        self.assertEqual(cache.get_many(['a', 'b', 'c']),
+                         {'a': 1, 'b': u'zwei'})
+        cache.delete('a')
+        self.assertEqual(cache.get('a'), None)
+        cache.set('long key with spaces ' * 20, 23)
+        self.assertEqual(cache.get('long key with spaces ' * 20), 23)
+        self.assertEqual(cache.stats.hits, 4)
+        self.assertEqual(cache.stats.misses, 3)
+
+        ns = cache.namespace('users')
+        ns.set(1, 'user 1')
+        ns.set_many({2: 'user 2'})
+        self.assertEqual(ns.get_many([1, 2]), {1: 'user 1', 2: 'user 2'})
+        self.assertEqual(cache.namespace('other').get(1), None)
+        ns.invalidate()
+        self.assertEqual(ns.get(1), None)
+        ns.set(1, 'new user 1')
+        self.assertEqual(ns.get(1), 'new user 1')
+        # the version is fetched with the value and is not counted
+        hits, misses = cache.stats.hits, cache.stats.misses
+        self.assertEqual(ns.get(1), 'new user 1')
+        self.assertEqual(ns.get(2), None)
+        self.assertEqual((cache.stats.hits, cache.stats.misses),
+                         (hits + 1, misses + 1))
+
+        cache.clear()
+        self.assertEqual(cache.get('foo'), None)
+
+    def test_configured_cache(self):
+        """Cache configuration"""
+        settings.CACHE_BACKEND = 'null'
+        caching.refresh_cache()
+        cache = caching.get_cache()
+        self.assert_(isinstance(cache, caching.NullCache))
+        self.assert_(caching.get_cache() is cache)
+        cache.set('foo', 'bar')
+        self.assertEqual(cache.get('foo'), None)
+
+    def test_memory_cache(self):
+        """In-process LRU cache"""
+        self.check_basic_operations(caching.MemoryCache())
+
+    def test_namespace_lookups(self):
+        """Namespace lookups need one request to the backend"""
+        cache = caching.MemoryCache()
+        calls = []
+        get_many = cache._get_many
+        cache._get_many = lambda keys: calls.append(keys) or get_many(keys)
+        ns = cache.namespace('users')
+        ns.set(1, 'user 1')
+        del calls[:]
+        self.assertEqual(ns.get(1), 'user 1')
+        self.assertEqual(ns.get_many([1, 2]), {1: 'user 1'})
+        self.assertEqual(len(calls), 2)
+
+    def test_memory_cache_bounds(self):
+        """Memory bounds and LRU eviction"""
+        cache = caching.MemoryCache(max_items=3)
+        for key in 'abc':
+            cache.set(key, key)
+        cache.get('a')
+        cache.set('d', 4)
+        self.assertEqual(sorted(cache.get_many('abcd')), ['a', 'c', 'd'])
+        self.assertEqual(cache.stats.evictions, 1)
+
+        cache = caching.MemoryCache(max_bytes=1000)
+        for x in xrange(10):
+            cache.set(x, 'x' * 200)
+        self.assert_(cache.size <= 1000)
+        self.assertEqual(len(cache), 4)
+        self.assertEqual(sorted(cache.get_many(range(10))), [6, 7, 8, 9])
+
+    def test_timeouts(self):
+        """Cache timeouts"""
+        cache = caching.MemoryCache(default_timeout=-1)
+        cache.set('foo', 'expired')
+        cache.set('bar', 'forever', 0)
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(cache.get('bar'), 'forever')
+        self.assertEqual(len(cache), 1)
+
+    def test_filesystem_cache(self):
+        """Filesystem cache"""
+        folder = tempfile.mkdtemp()
+        try:
+            cache = caching.FileSystemCache(cache_dir=folder)
+            self.check_basic_operations(cache)
+            cache = caching.FileSystemCache(cache_dir=folder, threshold=2)
+            for x in xrange(5):
+                cache.set(x, x)
+            self.assert_(len(cache._list_files()) <= 3)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_memcached_cache(self):
+        """Memcached protocol cache"""
+        server = MemcachedStandIn()
+        try:
+            cache = caching.MemcachedCache(servers=[server.address])
+            self.check_basic_operations(cache)
+            self.assertEqual(cache.get_info(),
+                             [(server.address, '0 items, 0 evictions')])
+            # long timeouts are sent as timestamps
+            cache.set('foo', 'bar', 60 * 60 * 24 * 60)
+            self.assertEqual(cache.get('foo'), 'bar')
+            # the server may be shared, it is not flushed on refresh
+            settings.CACHE_BACKEND = 'memcached'
+            settings.CACHE_OPTIONS = {'servers': [server.address]}
+            caching.refresh_cache()
+            caching.get_cache().set('bar', 'baz')
+            caching.refresh_cache()
+            self.assertEqual(cache.get('foo'), 'bar')
+        finally:
+            server.close()
+
+        # unreachable servers behave like an empty cache
+        cache.set('foo', 'bar')
+        self.assertEqual(cache.get('foo'), None)
+
+    def test_admin_status(self):
+        """Cache statistics on the admin panel"""
+        from solace.models import User
+        from solace.database import session
+        User('admin', 'admin@example.com', 'default', is_admin=True)
+        session.commit()
+        self.login('admin', 'default')
+        caching.get_cache().get('missing')
+        response = self.client.get('/admin/status')
+        self.assert_('Misses' in response.data)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CachingTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
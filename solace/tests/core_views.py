@@ -10,10 +10,11 @@
 """
 import re
 import unittest
+from datetime import datetime, timedelta
 from solace.tests import SolaceTestCase
 
-from solace import models, settings
-from solace.database import session
+from solace import models, settings, sessions, schema
+from solace.database import session, get_engine
 
 
 _link_re = re.compile(r'http://\S+')
@@ -115,6 +116,51 @@ class CoreViewsTestCase(SolaceTestCase):
         response = self.client.get('/en/')
         self.assert_('A_USER' in response.data)
 
+    def get_session_cookie(self):
+        return [x for x in self.client.cookie_jar
+                if x.name == settings.COOKIE_NAME][0]
+
+    def check_server_side_sessions(self, store):
+        settings.SESSION_STORE = store
+        sessions.refresh_session_interface()
+        models.User('THE_USER', 'the.user@example.com', 'default')
+        session.commit()
+        self.client.get('/login')
+        planted = self.get_session_cookie().value
+        self.login('THE_USER', 'default')
+
+        # the cookie only holds the session key and the key changes on
+        # login, the old key is no longer valid
+        cookie = self.get_session_cookie()
+        self.assertEqual(len(cookie.value), 40)
+        self.assertNotEqual(cookie.value, planted)
+        self.assertEqual(sessions.get_session_interface().load(planted),
+                         None)
+
+        # unchanged sessions are neither stored nor sent again
+        response = self.client.get('/en/')
+        self.assert_('THE_USER' in response.data)
+        response = self.client.get('/about')
+        self.assert_('set-cookie' not in response.headers)
+
+        self.logout()
+        response = self.client.get('/en/')
+        self.assert_('THE_USER' not in response.data)
+
+    def test_database_sessions(self):
+        """Server side sessions in the database"""
+        self.check_server_side_sessions('database')
+        self.assertEqual(sessions.collect_expired_sessions(), 0)
+        get_engine().execute(schema.sessions.update(),
+                             expires=datetime.utcnow() - timedelta(days=1))
+        self.assertEqual(sessions.collect_expired_sessions(batch_size=1), 1)
+        self.assertEqual(get_engine().execute(
+            schema.sessions.count()).scalar(), 0)
+
+    def test_cache_sessions(self):
+        """Server side sessions in the cache"""
+        self.check_server_side_sessions('cache')
+
 
 def suite():
     suite = unittest.TestSuite()
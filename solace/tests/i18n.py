@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+    solace.tests.i18n
+    ~~~~~~~~~~~~~~~~~
+
+    Tests the translation support.
+
+    :copyright: (c) 2010 by the Solace Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import with_statement
+import os
+import gc
+import sys
+import shutil
+import pickle
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from babel import Locale, dates
+from babel.support import Translations
+from solace.tests import SolaceTestCase
+from solace.tests.benchmarks import benchmark_case, compare
+
+from solace import i18n, database, models, settings
+from solace.database import session
+from solace.utils.ctxlocal import local
+
+
+class FakeRequest(object):
+
+    def __init__(self, locale, offset=None):
+        self.locale = Locale.parse(locale)
+        self.translations = i18n.load_translations(locale)
+        self.tzinfo = offset is not None and i18n.Timezone(offset) or None
+
+
+def legacy_format_datetime(datetime, format='medium'):
+    """The formatting before the formatter cache, for the benchmark."""
+    request = local.request
+    if request.tzinfo is not None:
+        datetime = datetime.replace(tzinfo=i18n.UTC) \
+            .astimezone(request.tzinfo).replace(tzinfo=None)
+    return dates.format_datetime(datetime, format, locale=request.locale)
+
+
+class I18NTestCase(SolaceTestCase):
+
+    def setUp(self):
+        SolaceTestCase.setUp(self)
+        i18n.refresh_translations()
+
+    def tearDown(self):
+        local.request = None
+        i18n.refresh_translations()
+        SolaceTestCase.tearDown(self)
+
+    def test_precompiled_catalogs(self):
+        """Precompiled catalogs"""
+        folder = tempfile.mkdtemp()
+        try:
+            mo_file = os.path.join(folder, 'messages.mo')
+            shutil.copy(i18n.find_catalog('ru'), mo_file)
+            filename = i18n.precompile_catalog(mo_file)
+            self.assertEqual(filename, os.path.join(folder, 'messages.catalog'))
+            translations = i18n.load_precompiled_catalog(filename)
+            with open(mo_file, 'rb') as f:
+                original = Translations(fileobj=f)
+            self.assertEqual(translations._catalog, original._catalog)
+            for n in 1, 2, 5, 11, 21, 22, 25:
+                self.assertEqual(translations.plural(n), original.plural(n))
+                self.assertEqual(translations.ungettext('%d minute ago', '%d minutes ago',
+                                                        n),
+                                 original.ungettext('%d minute ago', '%d minutes ago', n))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_precompiled_catalog_fallback(self):
+        """Outdated precompiled catalogs are ignored"""
+        folder = tempfile.mkdtemp()
+        old_path = i18n.LOCALE_PATH
+        try:
+            os.makedirs(os.path.join(folder, 'de', 'LC_MESSAGES'))
+            mo_file = os.path.join(folder, 'de', 'LC_MESSAGES', 'messages.mo')
+            shutil.copy(i18n.find_catalog('de'), mo_file)
+            i18n.LOCALE_PATH = folder
+            filename = i18n.precompile_catalog(mo_file)
+
+            def load():
+                i18n.refresh_translations()
+                translations = i18n.load_translations('de')
+                self.assertEqual(translations.ugettext('Login'), u'Anmelden')
+                return translations.files[0]
+
+            self.assertEqual(load(), filename)
+            mtime = os.path.getmtime(filename)
+            os.utime(mo_file, (mtime + 10, mtime + 10))
+            self.assertEqual(load(), mo_file)
+
+            i18n.precompile_catalog(mo_file)
+            with open(filename, 'rb') as f:
+                data = pickle.load(f)
+            data['babel'] = '0.0'
+            with open(filename, 'wb') as f:
+                pickle.dump(data, f)
+            self.assertEqual(load(), mo_file)
+
+            with open(filename, 'wb') as f:
+                f.write('garbage')
+            self.assertEqual(load(), mo_file)
+        finally:
+            i18n.LOCALE_PATH = old_path
+            shutil.rmtree(folder)
+
+    def test_catalog_lookup(self):
+        """Catalog lookups are remembered"""
+        self.assertEqual(i18n.find_catalog('fr'), None)
+        self.assert_(i18n.find_catalog('de').endswith('messages.mo'))
+        self.assertEqual(sorted(i18n._catalogs), ['de', 'fr'])
+        self.assertEqual(i18n.select_locale([('fr', 1), ('de-AT', 0.8),
+                                             ('de', 0.5)]), 'de')
+        self.assertEqual(sorted(i18n._catalogs), ['de', 'fr'])
+
+    def test_lazy_strings(self):
+        """Lazy strings remember the translation per locale"""
+        string = i18n.lazy_gettext(u'Login')
+        self.assert_(i18n.lazy_gettext(string) is string)
+        self.assertEqual(unicode(string), u'Login')
+        local.request = FakeRequest('de')
+        self.assertEqual(unicode(string), u'Anmelden')
+        self.assertEqual(string + u'!', u'Anmelden!')
+        local.request = FakeRequest('en')
+        self.assertEqual(unicode(string), u'Login')
+        self.assertEqual(len(string._memo), 2)
+
+        # reloaded catalogs are not kept alive by the strings
+        i18n.refresh_translations()
+        local.request = FakeRequest('de')
+        self.assertEqual(unicode(string), u'Anmelden')
+        local.request = None
+        gc.collect()
+        self.assertEqual(len(string._memo), 1)
+
+        copy = pickle.loads(pickle.dumps(string, 2))
+        self.assertEqual(len(copy._memo), 0)
+        self.assertEqual(unicode(copy), u'Login')
+
+    def test_datetime_formatting(self):
+        """Cached date formatters"""
+        values = [datetime(2010, 1, 1, 23, 30),
+                  datetime(2010, 6, 15, 0, 5, 42),
+                  datetime(1899, 12, 31, 12, 0)]
+        for locale in 'en', 'de', 'ru':
+            for offset in None, 0, 7200, -16200:
+                local.request = FakeRequest(locale, offset)
+                for format in 'short', 'medium', 'long', 'yyyy-MM-dd HH:mm':
+                    expected = [legacy_format_datetime(x, format)
+                                for x in values]
+                    self.assertEqual([i18n.format_datetime(x, format)
+                                      for x in values], expected)
+                    self.assertEqual(i18n.format_datetimes(values, format),
+                                     expected)
+        self.assert_(i18n.get_datetime_formatter('short') is
+                     i18n.get_datetime_formatter('short'))
+        self.assert_(i18n.get_timezone(3600) is i18n.get_timezone(3600))
+        self.assertEqual(i18n.get_timezone(3600).utcoffset(None),
+                         timedelta(hours=1))
+
+        for offset in xrange(i18n._cache_limit * 2):
+            i18n.get_timezone(offset)
+        self.assert_(len(i18n._timezones) <= i18n._cache_limit)
+        self.assert_(i18n.get_timezone(0) is i18n.UTC)
+
+    def test_locale_interning(self):
+        """Locales of the language sections are shared"""
+        de = i18n.intern_locale('de')
+        self.assert_(i18n.intern_locale(u'de') is de)
+        self.assert_(i18n.intern_locale(de) is de)
+        self.assert_(i18n.select_locale([('de', 1)]) is de)
+        self.assertEqual(i18n.intern_locale('de-AT', sep='-'), 'de_AT')
+        self.assert_(i18n.intern_locale('de_AT') is not
+                     i18n.intern_locale('de_AT'))
+        self.assert_('de_AT' not in i18n._locales)
+        self.assertRaises(ValueError, i18n.intern_locale, 'x-y-z-w')
+
+        user = models.User('user', 'user@example.com')
+        for x in xrange(2):
+            models.Topic('de', 'Topic %d' % x, 'Text', user)
+        session.commit()
+        session.remove()
+        topics = models.Topic.query.all()
+        self.assert_(topics[0].locale is topics[1].locale is de)
+
+
+def benchmark_locales(number=20):
+    """Prints the time it takes to load a list of 1000 topics with and
+    without interned locales.
+    """
+    with benchmark_case(I18NTestCase, 'test_locale_interning'):
+        user = models.User('user', 'user@example.com')
+        for x in xrange(1000):
+            models.Topic(settings.LANGUAGE_SECTIONS[x % 4], 'Topic %d' % x,
+                         'Text', user)
+        session.commit()
+        def load(parse):
+            database.intern_locale = parse
+            try:
+                session.remove()
+                models.Topic.query.all()
+            finally:
+                database.intern_locale = i18n.intern_locale
+        compare([('legacy', lambda: load(Locale.parse)),
+                 ('interned', lambda: load(i18n.intern_locale))],
+                number, 'ms per 1000 topics', scale=1e3)
+
+
+def benchmark(number=2000):
+    """Prints the time per formatted date for the old and the new
+    formatting.
+    """
+    values = [datetime(2010, 1, 1) + timedelta(hours=x) for x in xrange(50)]
+    local.request = FakeRequest('de', 7200)
+    try:
+        compare([(name, lambda func=func: [func(x) for x in values])
+                 for name, func in ('legacy', legacy_format_datetime),
+                                   ('cached', i18n.format_datetime)] +
+                [('batch', lambda: i18n.format_datetimes(values))],
+                number, 'us per date', len(values))
+    finally:
+        local.request = None
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(I18NTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['bench']:
+        benchmark()
+        benchmark_locales()
+    else:
+        unittest.main(defaultTest='suite')
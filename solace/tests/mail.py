@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+    solace.tests.mail
+    ~~~~~~~~~~~~~~~~~
+
+    Tests the mail queue against a local SMTP stand-in.
+
+    :copyright: (c) 2010 by the Solace Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+import socket
+import smtpd
+import asyncore
+import unittest
+from email import message_from_string
+from threading import Thread
+from solace.tests import SolaceTestCase
+
+from solace import settings
+from solace.database import session
+from solace.schema import mail_queue
+from solace.utils.mail import send_email, send_queued_mails
+
+
+class SMTPStandIn(smtpd.SMTPServer):
+    """Collects the messages sent to it."""
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.messages = []
+        self.connections = 0
+        self.running = True
+        self.thread = Thread(target=self.serve)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.socket.getsockname()[1]
+
+    def serve(self):
+        while self.running:
+            asyncore.loop(timeout=0.05, count=1)
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((rcpttos, message_from_string(data)))
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        asyncore.close_all()
+
+
+class MailTestCase(SolaceTestCase):
+
+    def setUp(self):
+        SolaceTestCase.setUp(self)
+        settings.MAIL_LOG_FILE = None
+        settings.MAIL_QUEUE_ENABLED = True
+
+    def get_queue(self):
+        q = mail_queue.c
+        return session.execute(mail_queue.select()
+                               .order_by(q.mail_id)).fetchall()
+
+    def test_queued_mails(self):
+        """Mails are queued and sent over one connection"""
+        send_email(u'Hello', u'Hällo World!', 'a@example.com')
+        send_email(u'Second', u'Text', ['b@example.com', 'c@example.com'])
+        session.rollback()
+        self.assertEqual(self.get_queue(), [])
+
+        send_email(u'Hello', u'Hällo World!', 'a@example.com')
+        send_email(u'Second', u'Text', ['b@example.com', 'c@example.com'])
+        session.commit()
+        self.assertEqual([x.status for x in self.get_queue()],
+                         ['pending', 'pending'])
+
+        server = SMTPStandIn()
+        try:
+            settings.SMTP_HOST = '127.0.0.1'
+            settings.SMTP_PORT = server.port
+            self.assertEqual(send_queued_mails(), (2, 0))
+            self.assertEqual(send_queued_mails(), (0, 0))
+        finally:
+            server.stop()
+
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(len(server.messages), 2)
+        to_addrs, msg = server.messages[0]
+        self.assertEqual(to_addrs, ['a@example.com'])
+        self.assertEqual(msg['Subject'], 'Hello')
+        self.assertEqual(msg.get_payload().decode('utf-8'), u'Hällo World!')
+        self.assertEqual(server.messages[1][0],
+                         ['b@example.com', 'c@example.com'])
+        for row in self.get_queue():
+            self.assertEqual(row.status, 'sent')
+            self.assert_(row.sent is not None)
+
+    def test_failed_mails(self):
+        """Failed mails are retried and given up eventually"""
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        settings.SMTP_HOST = '127.0.0.1'
+        settings.SMTP_PORT = sock.getsockname()[1]
+        sock.close()
+
+        send_email(u'Hello', u'Hello World!', 'a@example.com')
+        send_email(u'Hello', u'Hello World!', 'b@example.com')
+        session.commit()
+        self.assertEqual(send_queued_mails(), (0, 2))
+        self.assertEqual(send_queued_mails(), (0, 0))
+        for row in self.get_queue():
+            self.assertEqual(row.status, 'pending')
+            self.assertEqual(row.attempts, 1)
+            self.assert_(row.last_error)
+
+        # without a delay the mails are retried until they fail
+        settings.MAIL_QUEUE_RETRY_DELAY = 0
+        settings.MAIL_QUEUE_MAX_ATTEMPTS = 3
+        session.execute(mail_queue.update(values=dict(
+            next_attempt=mail_queue.c.created)))
+        session.commit()
+        self.assertEqual(send_queued_mails(), (0, 4))
+        for row in self.get_queue():
+            self.assertEqual(row.status, 'failed')
+            self.assertEqual(row.attempts, 3)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(MailTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
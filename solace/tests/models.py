@@ -205,6 +205,224 @@ class ModelTestCase(SolaceTestCase):
         session.commit()
         self.assertEqual(foo.tagged, 2)
 
+    def test_badge_awarding(self):
+        """Badges are awarded without loading the badge collection"""
+        from solace import badges
+        from sqlalchemy.orm.attributes import instance_dict
+        user1 = self.make_test_user('user1')
+        user2 = self.make_test_user('user2')
+        topic = models.Topic('en', 'First topic', 'text', user1)
+        models.Topic('en', 'Second topic', 'text', user1)
+        session.commit()
+        self.assertEqual(user1.bronce_badges, 1)
+        self.assert_(user1.has_badge(badges.INQUIRER))
+        self.assert_(not user1.has_badge(badges.CRITIC))
+
+        user2.downvote(topic)
+        session.commit()
+        self.assertEqual(user2.bronce_badges, 1)
+        self.assert_(user2.has_badge(badges.CRITIC))
+        self.assert_('_badges' not in instance_dict(user1))
+        self.assert_('_badges' not in instance_dict(user2))
+
+        answer = models.Post(topic, user2, 'answer')
+        session.commit()
+        for x in xrange(10):
+            user = self.make_test_user('voter%d' % x)
+            user.upvote(answer)
+        topic.accept_answer(answer)
+        session.commit()
+        self.assert_(user2.has_badge(badges.NICE_ANSWER, str(answer.id)))
+        self.assertEqual(user2.silver_badges, 1)
+        self.assertEqual(user2.bronce_badges, 2)
+        self.assertEqual(sorted(x.identifier for x in user2.badges),
+                         ['critic', 'nice-answer', 'troubleshooter'])
+        user2.upvote(topic)
+        session.commit()
+        self.assertEqual(len(user2.badges), 3)
+
+        # the awarded badges are only remembered until the transaction
+        # ends, badges awarded by other processes show up afterwards
+        from solace.database import get_engine
+        from solace.schema import user_badges
+        self.assert_(not user1.has_badge(badges.CRITIC))
+        get_engine().execute(user_badges.insert(), user_id=user1.id,
+                             badge=badges.CRITIC)
+        self.assert_(not user1.has_badge(badges.CRITIC))
+        session.rollback()
+        self.assert_(user1.has_badge(badges.CRITIC))
+        self.assert_(not user1.has_badge(badges.NICE_ANSWER))
+        get_engine().execute(user_badges.insert(), user_id=user1.id,
+                             badge=badges.NICE_ANSWER, payload='1')
+        session.commit()
+        self.assert_(user1.has_badge(badges.NICE_ANSWER, '1'))
+
+    def test_badge_queue(self):
+        """Badges are awarded from the queue"""
+        from solace import badges
+        from solace.schema import badge_events
+        settings.BADGE_QUEUE_ENABLED = True
+        user1 = self.make_test_user('user1')
+        user2 = self.make_test_user('user2')
+        topic = models.Topic('en', 'First topic', 'text', user1)
+        session.commit()
+        user2.downvote(topic)
+        session.commit()
+        models.Topic('en', 'Rolled back', 'text', user1)
+        session.rollback()
+        self.assert_(not user1.has_badge(badges.INQUIRER))
+        self.assertEqual(session.execute(badge_events.count()).scalar(), 3)
+
+        self.assertEqual(badges.award_queued_badges(batch_size=1), 3)
+        self.assertEqual(badges.award_queued_badges(), 0)
+        user1 = models.User.query.get(user1.id)
+        user2 = models.User.query.get(user2.id)
+        self.assert_(user1.has_badge(badges.INQUIRER))
+        self.assert_(user2.has_badge(badges.CRITIC))
+        self.assertEqual(user1.bronce_badges, 1)
+        self.assertEqual(user2.bronce_badges, 1)
+
+    def test_badge_queue_failures(self):
+        """A failing badge callback does not block the queue"""
+        import logging
+        from solace import badges
+        from solace.schema import badge_events
+        settings.BADGE_QUEUE_ENABLED = True
+        user1 = self.make_test_user('user1')
+        user2 = self.make_test_user('user2')
+        topic = models.Topic('en', 'First topic', 'text', user1)
+        session.commit()
+        user2.downvote(topic)
+        session.commit()
+        models.Topic('en', 'Second topic', 'text', user2)
+        session.commit()
+        queued = session.execute(badge_events.count()).scalar()
+
+        def fail(*args):
+            raise RuntimeError('broken badge')
+        failing = (badges.CRITIC, fail)
+        records = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+        handler = Handler()
+        badges.logger.addHandler(handler)
+        badges.logger.propagate = False
+        badges.badges_by_event['vote'].insert(0, failing)
+        try:
+            self.assertEqual(badges.award_queued_badges(), queued)
+        finally:
+            badges.badges_by_event['vote'].remove(failing)
+            badges.logger.removeHandler(handler)
+            badges.logger.propagate = True
+        self.assertEqual(session.execute(badge_events.count()).scalar(), 0)
+        self.assertEqual(len(records), 1)
+        self.assert_('(vote) failed' in records[0].getMessage())
+        user1 = models.User.query.get(user1.id)
+        user2 = models.User.query.get(user2.id)
+        self.assert_(user1.has_badge(badges.INQUIRER))
+        self.assert_(user2.has_badge(badges.INQUIRER))
+        self.assert_(not user2.has_badge(badges.CRITIC))
+
+    def test_badge_backfill(self):
+        """Badges are awarded retroactively"""
+        from solace import badges
+        from solace.schema import user_badges
+        user1 = self.make_test_user('user1')
+        user2 = self.make_test_user('user2')
+        topic = models.Topic('en', 'First topic', 'text', user1)
+        answer = models.Post(topic, user2, 'answer')
+        session.commit()
+        user1.downvote(topic)
+        user2.downvote(topic)
+        topic.accept_answer(answer)
+        session.commit()
+        answer.votes = 80
+        session.execute(user_badges.delete())
+        session.commit()
+        user_ids = user1.id, user2.id
+        answer_id = answer.id
+
+        self.assertEqual(badges.backfill_badges([badges.CRITIC]), 1)
+        self.assertEqual(badges.backfill_badges(), 6)
+        self.assertEqual(badges.backfill_badges(), 0)
+        session.remove()
+        user1, user2 = map(models.User.query.get, user_ids)
+        self.assertEqual(sorted(x.identifier for x in user1.badges),
+                         ['inquirer', 'self-critic'])
+        self.assertEqual(sorted(x.identifier for x in user2.badges),
+                         ['critic', 'good-answer', 'great-answer',
+                          'nice-answer', 'troubleshooter'])
+        self.assertEqual((user2.bronce_badges, user2.silver_badges,
+                          user2.gold_badges), (2, 2, 1))
+        self.assertEqual(user1.bronce_badges, 1)
+        self.assertEqual(user1.silver_badges, 1)
+        self.assert_(user2.has_badge(badges.GREAT_ANSWER, str(answer_id)))
+
+    def test_topic_slugs(self):
+        """Topic slugs are stored and backfilled"""
+        from solace.database import add_missing_columns
+        from solace.schema import topics
+        user = self.make_test_user()
+        for x in xrange(5):
+            models.Topic('en', u'Topic Nr. %d' % x, 'text', user)
+        session.commit()
+        ids = dict((x.title, x.id) for x in models.Topic.query.all())
+        ids = [ids[u'Topic Nr. %d' % x] for x in xrange(5)]
+        self.assertEqual(add_missing_columns(topics), ([], []))
+        self.assertEqual(models.Topic.query.get(ids[0])._slug,
+                         u'topic-nr-0')
+
+        # old rows without slugs
+        session.execute(topics.update(values={topics.c.slug: None}))
+        session.commit()
+        session.remove()
+        topic = models.Topic.query.get(ids[1])
+        self.assertEqual(topic._slug, None)
+        self.assertEqual(topic.slug, u'topic-nr-1')
+        session.remove()
+        self.assertEqual(models.backfill_topic_slugs(chunk_size=2), 5)
+        self.assertEqual(models.backfill_topic_slugs(), 0)
+        self.assertEqual(sorted(x[0] for x in session.execute(
+            topics.select().with_only_columns([topics.c.slug]))),
+            [u'topic-nr-%d' % x for x in xrange(5)])
+
+        # changing the title changes the slug
+        topic = models.Topic.query.get(ids[2])
+        topic.title = u'Hello World'
+        session.commit()
+        session.remove()
+        topic = models.Topic.query.get(ids[2])
+        self.assertEqual(topic.slug, u'hello-world')
+        topic.title = u'???'
+        self.assertEqual(topic.slug, None)
+
+        # the guid does not need the question
+        self.assert_('question' not in topic.__dict__)
+        self.assert_(topic.guid.endswith('topic/%d' % topic.question_post_id))
+        self.assert_('question' not in topic.__dict__)
+
+    def test_add_missing_columns(self):
+        """Only nullable columns without defaults are added"""
+        from sqlalchemy import MetaData, Table, Column, Integer, String, \
+             ForeignKey
+        from solace.database import add_missing_columns, get_engine
+        Table('old_table', MetaData(),
+            Column('id', Integer, primary_key=True)
+        ).create(bind=get_engine())
+        table = Table('old_table', MetaData(),
+            Column('id', Integer, primary_key=True),
+            Column('note', String(20)),
+            Column('count', Integer, nullable=False),
+            Column('flag', Integer, default=0),
+            Column('topic_id', Integer, ForeignKey('topics.topic_id'))
+        )
+        self.assertEqual(add_missing_columns(table),
+                         (['note'], ['count', 'flag', 'topic_id']))
+        self.assertEqual(add_missing_columns(table),
+                         ([], ['count', 'flag', 'topic_id']))
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(ModelTestCase))
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+    solace.tests.profiling
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests the sampling profiler, the server timing and the startup
+    helpers.
+
+    :copyright: (c) 2010 by the Solace Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import logging
+import unittest
+from time import time
+from thread import get_ident
+from werkzeug import Client, Response
+from solace.tests import SolaceTestCase
+
+from solace import settings
+from solace.models import User
+from solace.database import session
+from solace.utils import profiling
+from solace.urls import url_map
+from solace import application, i18n, templating
+
+
+def busy_loop(rounds=3, timeout=10):
+    """Runs until the sampler looked at the active threads `rounds`
+    times, so the loop is sampled no matter how fast the machine is.
+    """
+    sampler = profiling._get_sampler()
+    if get_ident() not in sampler.active:
+        return
+    end = sampler.rounds + rounds
+    deadline = time() + timeout
+    while sampler.rounds < end and time() < deadline:
+        pass
+
+
+def slow_application(environ, start_response):
+    busy_loop()
+    return Response('done')(environ, start_response)
+
+
+class ProfilingTestCase(SolaceTestCase):
+
+    def setUp(self):
+        SolaceTestCase.setUp(self)
+        settings.PROFILER_INTERVAL = 0.001
+        profiling.reset_profiles()
+
+    def tearDown(self):
+        profiling.reset_profiles()
+        SolaceTestCase.tearDown(self)
+
+    def test_sampling(self):
+        """Stacks are sampled per endpoint"""
+        client = Client(profiling.ProfilerMiddleware(slow_application),
+                        Response)
+        client.get('/')
+        self.assertEqual(profiling.get_profiled_endpoints(), [])
+
+        settings.PROFILER_SAMPLE_RATE = 1
+        client.get('/')
+        client.get('/_no_such_page')
+        endpoints = dict(profiling.get_profiled_endpoints())
+        self.assertEqual(sorted(endpoints), ['<unmatched>', 'core.language_redirect'])
+        self.assert_(endpoints['core.language_redirect'] >= 1)
+
+        stacks = profiling.get_collapsed_stacks('core.language_redirect')
+        for stack in stacks:
+            self.assert_(stack.startswith('solace.tests.profiling.'
+                                          'slow_application'))
+        func, own, total = profiling.get_top_functions('core.language_redirect')[0]
+        self.assertEqual(func, 'solace.tests.profiling.busy_loop')
+        self.assert_(own > 0 and total >= own)
+        folded = profiling.format_collapsed_stacks('core.language_redirect')
+        self.assertEqual(folded.count('\n'), len(stacks))
+        self.assert_(folded.startswith('solace.tests.profiling.'))
+
+    def test_admin_view(self):
+        """Profiles on the admin panel"""
+        User('admin', 'admin@example.com', 'default', is_admin=True)
+        session.commit()
+        self.login('admin', 'default')
+        response = self.client.get('/admin/profiles')
+        self.assert_('No requests were profiled yet.' in response.data)
+        self.assertEqual(self.client.get('/admin/profiles/kb.overview.folded')
+                         .status_code, 404)
+
+        settings.PROFILER_SAMPLE_RATE = 1
+        Client(profiling.ProfilerMiddleware(slow_application),
+               Response).get('/en/')
+        settings.PROFILER_SAMPLE_RATE = 0
+        endpoint = profiling.get_profiled_endpoints()[0][0]
+        self.assertEqual(endpoint, 'kb.overview')
+        response = self.client.get('/admin/profiles')
+        self.assert_(endpoint in response.data)
+        response = self.client.get('/admin/profiles/%s.folded' % endpoint)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data,
+                         profiling.format_collapsed_stacks(endpoint))
+
+    def test_server_timing(self):
+        """Server-Timing header and logging"""
+        response = self.client.get('/en/')
+        self.assertEqual(response.headers.get('Server-Timing'), None)
+
+        settings.SERVER_TIMING = True
+        response = self.client.get('/en/')
+        phases = dict(item.split(';dur=') for item in
+                      response.headers['Server-Timing'].split(', '))
+        for phase in 'match', 'session', 'view', 'template', 'sql', 'total':
+            self.assert_(phase in phases, phase)
+        self.assert_(float(phases['total']) >= float(phases['view']))
+
+        response = self.client.get('/api/1.0/questions/?format=json')
+        self.assert_('serialize;dur=' in response.headers['Server-Timing'])
+        response = self.client.get('/api/1.0/questions/?format=xml')
+        self.assert_('serialize;dur=' not in response.headers['Server-Timing'])
+
+        records = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record.getMessage())
+        handler = Handler()
+        logger = logging.getLogger('solace.timing')
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        try:
+            settings.SERVER_TIMING = False
+            settings.SERVER_TIMING_LOG = True
+            response = self.client.get('/en/')
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(response.headers.get('Server-Timing'), None)
+        self.assertEqual(len(records), 1)
+        self.assert_(records[0].startswith('GET /en/ [kb.overview] match='))
+
+    def test_warmup(self):
+        """Views, templates and translations are loaded by warmup"""
+        application._resolved_views.clear()
+        i18n.refresh_translations()
+        templating.refresh_theme()
+        application.warmup()
+        for rule in url_map.iter_rules():
+            if rule.build_only:
+                continue
+            self.assert_(application._resolved_views[rule.endpoint]
+                         is not None, rule.endpoint)
+        self.assertEqual(sorted(i18n._translations),
+                         sorted(settings.LANGUAGE_SECTIONS))
+        self.assert_('kb/overview.html' in templating.jinja_env.cache)
+
+    def test_import_profile(self):
+        """Import times"""
+        old_module = sys.modules.pop('solace.utils.recaptcha', None)
+        try:
+            result = profiling.profile_imports('solace.utils.recaptcha')
+        finally:
+            if old_module is not None:
+                sys.modules['solace.utils.recaptcha'] = old_module
+        self.assertEqual(result[0][0], 'solace.utils.recaptcha')
+        for name, own, total in result:
+            self.assert_(0 <= own <= total, name)
+        self.assertEqual(profiling.profile_imports('solace.utils'), [])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ProfilingTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
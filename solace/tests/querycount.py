@@ -42,11 +42,15 @@ class QueryCountTestCase(SolaceTestCase):
         response = self.client.get('/en/')
         self.assertEqual(response.sql_query_count, 2)
 
-        # if you're logged in, there is another query for the user needed and
-        # another to check for messages from the database.
+        # if you're logged in, there is another query for the user needed.
+        # Messages are only queried if the user has pending messages.
         self.login('me', 'default')
         response = self.client.get('/en/')
-        self.assertEqual(response.sql_query_count, 4)
+        self.assertEqual(response.sql_query_count, 3)
+
+        # after that the user comes from the identity cache
+        response = self.client.get('/en/')
+        self.assertEqual(response.sql_query_count, 2)
 
     def test_topic_view_queries(self):
         """Number of queries for the topic page under control"""
@@ -57,11 +61,51 @@ class QueryCountTestCase(SolaceTestCase):
         self.assertEqual(response.sql_query_count, 1)
 
         # and if we're logged in we have another one for the user
-        # and a third for the vote cast status and a fourth to
-        # check for messages from the database.
+        # and a third for the vote cast status.
         self.login('me', 'default')
         response = self.client.get('/en/topic/1', follow_redirects=True)
-        self.assertEqual(response.sql_query_count, 4)
+        self.assertEqual(response.sql_query_count, 3)
+        response = self.client.get('/en/topic/1', follow_redirects=True)
+        self.assertEqual(response.sql_query_count, 2)
+
+    def test_user_cache_invalidation(self):
+        """Cached users are invalidated on changes"""
+        from solace.utils.admin import ban_user
+        self.create_test_data(topics=1)
+        self.login('me', 'default')
+        self.client.get('/en/')
+        response = self.client.get('/en/')
+        self.assert_('<span class="reputation">(0)' in response.data)
+
+        # reputation is changed with an atomic add
+        me = models.User.query.filter_by(username='me').one()
+        topic = models.Topic('en', 'My Topic', 'test contents', me)
+        session.commit()
+        topic_id = topic.id
+        self.client.get('/en/')
+        voter = models.User.query.filter_by(username='user_1').one()
+        voter.upvote(models.Topic.query.get(topic_id))
+        session.commit()
+        response = self.client.get('/en/')
+        self.assertEqual(response.sql_query_count, 3)
+        self.assert_('<span class="reputation">(%d)' %
+                     settings.REPUTATION_MAP['GAIN_ON_QUESTION_UPVOTE']
+                     in response.data)
+
+        # messages are only queried if there are pending ones
+        models.UserMessage(models.User.query.filter_by(username='me').one(),
+                           'Hello World')
+        session.commit()
+        response = self.client.get('/en/')
+        self.assert_('Hello World' in response.data)
+        response = self.client.get('/en/')
+        self.assertEqual(response.sql_query_count, 3)
+        response = self.client.get('/en/')
+        self.assertEqual(response.sql_query_count, 2)
+
+        ban_user(models.User.query.filter_by(username='me').one())
+        response = self.client.get('/en/')
+        self.assert_('Logout' not in response.data)
 
     def test_userlist_queries(self):
         """Number of queries for the user list under control"""
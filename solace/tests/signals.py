@@ -11,12 +11,19 @@
 from __future__ import with_statement
 import re
 import gc
+import sys
 import pickle
+import logging
 import unittest
 import doctest
+from threading import current_thread
+from werkzeug import Response, create_environ
+from simplejson import loads
 from solace.tests import SolaceTestCase
+from solace.tests.benchmarks import compare
 
 from solace import signals
+from solace.application import application
 
 
 signals.SIG('TEST_SIGNAL')
@@ -24,6 +31,15 @@ signals.SIG('TEST_SIGNAL')
 
 class SignalTestCase(SolaceTestCase):
 
+    def setUp(self):
+        SolaceTestCase.setUp(self)
+        # failing handlers are tested, silence their tracebacks
+        logging.getLogger('solace.signals').disabled = True
+
+    def tearDown(self):
+        logging.getLogger('solace.signals').disabled = False
+        SolaceTestCase.tearDown(self)
+
     def test_simple_subscriptions(self):
         """Simple signal subscriptions"""
         sig = signals.Signal('FOO', ('a', 'b'))
@@ -146,6 +162,142 @@ class SignalTestCase(SolaceTestCase):
 
         self.assertEqual(on_signal, [(sig, {'foo': 42})])
 
+    def test_listener_snapshots(self):
+        """Listener snapshots are updated"""
+        sig = signals.Signal('sig', ['a'])
+        called = []
+        def foo(a):
+            called.append(a)
+        sig.emit(a=0)
+        sig.connect(foo)
+        sig.connect(foo)
+        self.assertEqual(len(signals._snapshots[sig]), 1)
+        sig.emit(a=1)
+        sig.disconnect(foo)
+        sig.emit(a=2)
+        sig.connect(foo)
+        del foo
+        gc.collect()
+        self.assert_(sig not in signals._snapshots)
+        sig.emit(a=3)
+        self.assertEqual(called, [1])
+        self.assertEqual(signals._snapshots[sig], ())
+
+    def test_async_handlers(self):
+        """Async signal handlers"""
+        sig = signals.Signal('sig', ['a'])
+        called = []
+        def foo(a):
+            called.append((a, current_thread()))
+        def fail(a):
+            raise RuntimeError('handler failed')
+        sig.connect(foo, mode='async')
+        sig.connect(fail, mode='async')
+        stats = signals.get_handler_stats()
+        self.assertEqual(sig.emit(a=42), [])
+        signals.wait_for_async_handlers()
+        self.assertEqual(len(called), 1)
+        self.assertEqual(called[0][0], 42)
+        self.assert_(called[0][1] is not current_thread())
+        new_stats = signals.get_handler_stats()
+        self.assertEqual(new_stats['async_calls'], stats['async_calls'] + 1)
+        self.assertEqual(new_stats['async_errors'], stats['async_errors'] + 1)
+
+    def test_after_response_handlers(self):
+        """Signal handlers called after the response"""
+        called = []
+        def on_response(request, response):
+            called.append(response.status_code)
+        def fail(request, response):
+            raise RuntimeError('handler failed')
+        signals.before_response_sent.connect(on_response,
+                                             mode='after_response')
+        signals.before_response_sent.connect(fail, mode='after_response')
+        try:
+            sent = []
+            def start_response(status, headers, exc_info=None):
+                sent.append(status)
+            app_iter = application(create_environ('/en/'), start_response)
+            self.assertEqual(called, [])
+            self.assertEqual(''.join(app_iter) and sent, ['200 OK'])
+            self.assertEqual(called, [])
+            app_iter.close()
+            self.assertEqual(called, [200])
+
+            # outside of requests they are called right away
+            sig = signals.Signal('sig', ['request', 'response'])
+            sig.connect(on_response, mode='after_response')
+            sig.emit(request=None, response=Response())
+            self.assertEqual(called, [200, 200])
+        finally:
+            signals.before_response_sent.disconnect(on_response)
+            signals.before_response_sent.disconnect(fail)
+
+    def test_profiling(self):
+        """Signal handler profiling"""
+        from solace import settings
+        from solace.models import User, session
+        sig = signals.Signal('sig', ['a'])
+        def foo(a):
+            return a
+        sig.connect(foo)
+        signals.reset_profile()
+        sig.emit(a=1)
+        self.assertEqual(signals.get_profile(), [])
+
+        settings.SIGNAL_PROFILING = True
+        self.assertEqual(sig.emit(a=2), [(foo, 2)])
+        sig.emit(a=3)
+        profile = signals.get_profile()
+        self.assertEqual(len(profile), 1)
+        self.assertEqual(profile[0]['signal'], 'sig')
+        self.assertEqual(profile[0]['handler'], 'solace.tests.signals.foo')
+        self.assertEqual(profile[0]['calls'], 2)
+        self.assert_(profile[0]['max'] <= profile[0]['total'])
+
+        User('admin', 'admin@example.com', 'default', is_admin=True)
+        session.commit()
+        self.login('admin', 'default')
+        response = self.client.get('/admin/status')
+        self.assert_('solace.tests.signals.foo' in response.data)
+        data = loads(self.client.get('/admin/status/signals.json').data)
+        handlers = [x['handler'] for x in data['profile']]
+        self.assert_('solace.database.add_query_debug_headers' in handlers)
+        self.assert_('async_calls' in data['handlers'])
+
+
+def legacy_emit(self, **args):
+    """The dispatching before listener snapshots, for the benchmark."""
+    assert set(self.args) == set(args), \
+        'passed arguments to not match signal signature'
+    listeners = signals._subscriptions.get(self)
+    result = []
+    if listeners is not None:
+        for func in listeners.keys():
+            if isinstance(func, signals._MethodRef):
+                func = func.resolve()
+                if func is None:
+                    continue
+            result.append((func, func(**args)))
+    if self is not signals.broadcast:
+        legacy_emit(signals.broadcast, signal=self, args=args)
+    return result
+
+
+def benchmark(number=100000):
+    """Prints the time per emit for the old and the new dispatching."""
+    class Listener(object):
+        def method(self, a):
+            pass
+    listeners = [Listener() for x in xrange(4)]
+    for count in 0, 1, 4:
+        sig = signals.Signal('sig', ['a'])
+        for listener in listeners[:count]:
+            sig.connect(listener.method)
+        compare([(name, lambda emit=emit: emit(sig, a=42)) for name, emit in
+                 ('legacy', legacy_emit), ('snapshot', signals.Signal.emit)],
+                number, 'us per emit', label='%d listener(s): ' % count)
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -155,4 +307,7 @@ def suite():
 
 
 if __name__ == '__main__':
-    unittest.main(defaultTest='suite')
+    if sys.argv[1:] == ['bench']:
+        benchmark()
+    else:
+        unittest.main(defaultTest='suite')
@@ -8,12 +8,20 @@
     :copyright: (c) 2010 by the Solace Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
+import os
+import shutil
+import tempfile
 from os.path import dirname, join
 import unittest
 import doctest
 
+from werkzeug import create_environ
 from solace.tests import SolaceTestCase
+
 from solace import templating, models, settings
+from solace.application import Request
+from solace.database import session
+from solace.utils.ctxlocal import local
 
 
 class TemplatingTestCase(SolaceTestCase):
@@ -27,6 +35,29 @@ class TemplatingTestCase(SolaceTestCase):
         self.assert_('MEH' in rv)
         self.assert_('See you soon on Solace' in rv)
 
+    def test_batch_date_formatting(self):
+        """Dates of list views are formatted like single dates"""
+        me = models.User('me', 'me@example.com')
+        for x in xrange(3):
+            models.Topic('en', 'Topic %d' % x, 'text', me)
+        session.commit()
+        topics = models.Topic.query.all()
+        Request(create_environ('/en/'))
+        try:
+            self.assertEqual(templating.datetimeformats(topics, 'date'),
+                             [templating.datetimeformat_filter(x.date)
+                              for x in topics])
+            self.assertEqual(templating.datetimeformats(topics, 'date',
+                                                        html=False,
+                                                        prefixed=False),
+                             [templating.datetimeformat_filter(x.date, False,
+                                                               False)
+                              for x in topics])
+        finally:
+            local.request = None
+        resp = self.client.get('/en/')
+        self.assert_(resp.data.count('class="datetime"') >= 3)
+
     def test_theme_switches(self):
         """Theme based template switches."""
         settings.THEME_PATH.append(dirname(__file__))
@@ -37,6 +68,38 @@ class TemplatingTestCase(SolaceTestCase):
         self.assert_('I AM THE TEST THEME HEAD' in resp.data)
         self.assert_('_themes/test_theme' in resp.data)
 
+    def test_bytecode_cache(self):
+        """Precompiled templates in the bytecode cache"""
+        folder = tempfile.mkdtemp()
+        try:
+            settings.THEME_PATH.append(dirname(__file__))
+            settings.TEMPLATE_CACHE_DIR = folder
+            settings.TEMPLATE_AUTO_RELOAD = False
+            builtin = templating.jinja_env.loader.list_templates()
+            self.assertEqual(templating.list_themes(), ['teal', 'test_theme'])
+            compiled = templating.precompile_templates(['test_theme'])
+            # the layout of the test theme and the builtin one
+            self.assertEqual(compiled, len(builtin) + 1)
+            self.assertEqual(os.listdir(folder), ['test_theme'])
+            self.assertEqual(len(os.listdir(join(folder, 'test_theme'))),
+                             compiled)
+
+            settings.THEME = 'test_theme'
+            templating.refresh_theme()
+            templating.get_theme()
+            self.assertEqual(templating.jinja_env.bytecode_cache.directory,
+                             join(folder, 'test_theme'))
+            self.assertEqual(templating.jinja_env.auto_reload, False)
+            resp = self.client.get('/en/')
+            self.assert_('I AM THE TEST THEME HEAD' in resp.data)
+        finally:
+            settings.THEME = 'teal'
+            settings.TEMPLATE_CACHE_DIR = None
+            settings.TEMPLATE_AUTO_RELOAD = True
+            templating.refresh_theme()
+            templating.get_theme()
+            shutil.rmtree(folder)
+
 
 def suite():
     suite = unittest.TestSuite()
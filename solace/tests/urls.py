@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+    solace.tests.urls
+    ~~~~~~~~~~~~~~~~~
+
+    Tests the URL building.
+
+    :copyright: (c) 2010 by the Solace Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import with_statement
+import sys
+import unittest
+from werkzeug import create_environ, url_quote
+from werkzeug.routing import BuildError
+from solace.tests import SolaceTestCase, html_xpath
+from solace.tests.benchmarks import benchmark_case, compare
+
+from solace import application, models
+from solace.application import Request, url_for, urls_for, \
+     iter_endpoint_choices, inject_lang_code, get_view
+from solace.database import session
+from solace.utils.csrf import get_exchange_token, is_exchange_token_protected
+from solace.utils.ctxlocal import local
+
+
+def legacy_url_for(endpoint, **values):
+    """The URL building before the build plans, for the benchmark."""
+    external = values.pop('_external', False)
+    if hasattr(endpoint, 'get_url_values'):
+        endpoint, values = endpoint.get_url_values(**values)
+    request = Request.current
+    anchor = values.pop('_anchor', None)
+    for endpoint_choice in iter_endpoint_choices(endpoint, request.endpoint):
+        real_values = inject_lang_code(request, endpoint_choice, values)
+        if real_values is None:
+            continue
+        try:
+            url = request.url_adapter.build(endpoint_choice, real_values,
+                                            force_external=external)
+        except BuildError:
+            continue
+        view = get_view(endpoint)
+        if is_exchange_token_protected(view):
+            xt = get_exchange_token(request)
+            url = '%s%s_xt=%s' % (url, '?' in url and '&' or '?', xt)
+        if anchor is not None:
+            url += '#' + url_quote(anchor)
+        return url
+    raise BuildError(endpoint, values, 'GET')
+
+
+class URLTestCase(SolaceTestCase):
+
+    def setUp(self):
+        SolaceTestCase.setUp(self)
+        application._build_plans.clear()
+
+    def tearDown(self):
+        local.request = None
+        SolaceTestCase.tearDown(self)
+
+    def make_topics(self, count=3):
+        user = models.User('user', 'user@example.com')
+        tag = models.Tag(u'foo', 'en')
+        for x in xrange(count):
+            topic = models.Topic('en', u'Topic Nr. %d' % x, 'Text', user)
+            topic.tags.append(tag)
+        session.commit()
+        return models.Topic.query.order_by(models.Topic.id).all()
+
+    def test_build_plans(self):
+        """URL building with build plans"""
+        topics = self.make_topics()
+        Request(create_environ('/de/'))
+        for obj in topics + [topics[0].tags[0], topics[0].author,
+                             topics[0].question]:
+            self.assertEqual(url_for(obj), legacy_url_for(obj))
+            # the second time the build plan is used
+            self.assertEqual(url_for(obj), legacy_url_for(obj))
+        self.assert_(application._build_plans)
+        self.assertEqual(url_for(topics[0]), '/en/topic/%d-topic-nr-0' %
+                         topics[0].id)
+        self.assertEqual(url_for('kb.overview', _anchor='foo bar',
+                                 _external=True),
+                         'http://localhost/de/#foo%20bar')
+        self.assertEqual(url_for(topics[0], action='vote'),
+                         legacy_url_for(topics[0], action='vote'))
+        self.assertRaises(BuildError, url_for, 'kb.missing')
+        self.assertRaises(BuildError, url_for, 'kb.topic')
+
+        # the language code is not part of the plan
+        self.assertEqual(url_for('kb.overview'), '/de/')
+        Request(create_environ('/en/'))
+        self.assertEqual(url_for('kb.overview'), '/en/')
+        request = Request(create_environ('/'))
+        request.locale = 'de'
+        self.assertEqual(url_for('kb.overview'), '/de/')
+
+        # the plans are bounded
+        application._build_plans.clear()
+        for x in xrange(application._build_plans_limit + 10):
+            url_for('kb.overview', **{'arg%d' % x: 'x'})
+        self.assert_(len(application._build_plans) <=
+                     application._build_plans_limit)
+
+    def test_topic_slug(self):
+        """Topic slugs follow title changes"""
+        topic = self.make_topics(1)[0]
+        self.assertEqual(topic.slug, u'topic-nr-0')
+        topic.title = u'Hello World'
+        self.assertEqual(topic.slug, u'hello-world')
+        topic.title = u'???'
+        self.assertEqual(topic.slug, None)
+
+    def test_bulk_building(self):
+        """Building URLs for lists of objects"""
+        topics = self.make_topics()
+        Request(create_environ('/en/'))
+        expected = [(x, legacy_url_for(x)) for x in topics]
+        self.assertEqual(urls_for(topics), expected)
+        self.assertEqual(urls_for(topics, action='feed', _external=True),
+                         [(x, legacy_url_for(x, action='feed',
+                                             _external=True))
+                          for x in topics])
+        self.assertEqual(urls_for([]), [])
+
+        response = self.client.get('/en/')
+        links = set(x.attrib['href'] for x in html_xpath(response.html,
+            '//html:div[@class="text"]/html:h2/html:a'))
+        self.assertEqual(links, set(url for x, url in expected))
+
+
+def benchmark(number=50):
+    """Prints the time per URL for the old and the new URL building."""
+    with benchmark_case(URLTestCase, 'test_bulk_building') as case:
+        topics = case.make_topics(200)
+        Request(create_environ('/en/'))
+        compare([('legacy', lambda: [legacy_url_for(x) for x in topics]),
+                 ('cached', lambda: [url_for(x) for x in topics]),
+                 ('bulk', lambda: urls_for(topics))],
+                number, 'us per URL', len(topics))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(URLTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['bench']:
+        benchmark()
+    else:
+        unittest.main(defaultTest='suite')
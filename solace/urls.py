@@ -68,6 +68,9 @@ url_map = Map([
     # administration
     Rule('/admin/') > 'admin.overview',
     Rule('/admin/status') > 'admin.status',
+    Rule('/admin/status/signals.json') > 'admin.signal_profile',
+    Rule('/admin/profiles') > 'admin.profiles',
+    Rule('/admin/profiles/<name>.folded') > 'admin.download_profile',
     Rule('/admin/bans') > 'admin.bans',
     Rule('/admin/ban/<user>') > 'admin.ban_user',
     Rule('/admin/unban/<user>') > 'admin.unban_user',
@@ -99,7 +102,8 @@ url_map = Map([
         Rule('/badges/<identifier>') > 'api.get_badge',
         Rule('/questions/') > 'api.list_questions',
         Rule('/questions/<int:question_id>') > 'api.get_question',
-        Rule('/replies/<int:reply_id>') > 'api.get_reply'
+        Rule('/replies/<int:reply_id>') > 'api.get_reply',
+        Rule('/export') > 'api.export'
     ]),
 
     # support for theme resources.
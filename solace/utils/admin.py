@@ -13,7 +13,7 @@ from solace.i18n import _
 from solace.application import url_for
 from solace.templating import render_template
 from solace.utils.mail import send_email
-from solace.models import User, session
+from solace.models import User, session, invalidate_cached_user
 
 
 def ban_user(user):
@@ -28,6 +28,7 @@ def ban_user(user):
                render_template('mails/user_banned.txt', user=user),
                user.email)
     session.commit()
+    invalidate_cached_user(user.id)
 
 
 def unban_user(user):
@@ -47,3 +48,4 @@ def unban_user(user):
                render_template('mails/user_unbanned.txt', user=user,
                                reset_url=reset_url), user.email)
     session.commit()
+    invalidate_cached_user(user.id)
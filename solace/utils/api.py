@@ -8,21 +8,28 @@
     :copyright: (c) 2010 by the Solace Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
+from __future__ import with_statement
 import re
 import inspect
 import simplejson
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
 from xml.sax.saxutils import quoteattr
 from functools import update_wrapper
-from babel import Locale, UnknownLocaleError
+from babel import UnknownLocaleError
 from werkzeug.exceptions import MethodNotAllowed, BadRequest
 from werkzeug import Response, escape
+from jinja2 import escape as jinja_escape
+from sqlalchemy import DateTime, and_, or_
 
 from solace.application import get_view
 from solace.urls import url_map
 from solace.templating import render_template
-from solace.i18n import _, has_section
-from solace.utils.remoting import remote_export_primitive
+from solace.i18n import _, has_section, intern_locale
+from solace.utils.remoting import remote_export_primitive, parse_fields
+from solace.export import iter_chunks
 from solace.utils.formatting import format_creole
+from solace.utils.timing import timed
 
 
 XML_NS = 'http://opensource.plurk.com/solace/'
@@ -30,45 +37,109 @@ XML_NS = 'http://opensource.plurk.com/solace/'
 
 _escaped_newline_re = re.compile(r'(?:(?:\\r)?\\n)')
 
+# the XML writer yields a chunk after this many pieces
+_xml_chunk_pieces = 4096
+
+# the debug dump is streamed into the page in place of this
+_debug_placeholder = u'\x00solace-api-dump\x00'
+
+# the format of dates in cursors.  Unlike the exported dates these
+# include microseconds so that the cursor is exact.
+_cursor_date_format = '%Y-%m-%dT%H:%M:%S.%f'
+
 
 def debug_dump(obj):
-    """Dumps the data into a HTML page for debugging."""
-    dump = _escaped_newline_re.sub('\n',
-        simplejson.dumps(obj, ensure_ascii=False, indent=2))
-    return render_template('api/debug_dump.html', dump=dump)
+    """Dumps the data into a HTML page for debugging.  The page is
+    rendered around a placeholder that is replaced with the chunks of
+    the dump, so the page streams like the XML format.
+    """
+    page = render_template('api/debug_dump.html', dump=_debug_placeholder)
+    head, tail = page.split(_debug_placeholder, 1)
+    return _iter_debug_dump(obj, head, tail)
+
+
+def _iter_debug_dump(obj, head, tail):
+    encoder = simplejson.JSONEncoder(ensure_ascii=False, indent=2)
+    yield head
+    for chunk in iter_chunks(encoder.iterencode(obj)):
+        yield unicode(jinja_escape(_escaped_newline_re.sub('\n', chunk)))
+    yield tail
+
+
+def _xml_start_tag(value):
+    """The start and end tag of a dict."""
+    obj_type = value.get('#type')
+    key = start = u'dict'
+    if obj_type is not None:
+        if obj_type.startswith('solace.'):
+            key = start = obj_type[7:]
+        else:
+            start += u' type=%s' % quoteattr(obj_type)
+    return u'<%s>' % start, u'</%s>' % key
+
+
+def _iter_xml_dict(value):
+    for key, item in value.iteritems():
+        if key != '#type':
+            yield key, item
+
+
+def _iter_xml_list(value):
+    for item in value:
+        if isinstance(item, (tuple, list, dict)):
+            yield None, item
+        else:
+            yield u'item', item
+
+
+def iter_xml(obj):
+    """Dumps data into a simple XML format.  The document is written
+    incrementally without recursion and yielded in chunks, so it can be
+    used as the body of a streamed response.
+    """
+    buffer = [u'<?xml version="1.0" encoding="utf-8"?>'
+              u'<result xmlns="%s">' % XML_NS]
+    write = buffer.append
+    # the iterators over the (tag, value) pairs of the open dicts and
+    # lists with the end tags that are written when they are exhausted
+    stack = [(iter([(None, obj)]), u'</result>')]
+    while stack:
+        items, end = stack[-1]
+        for tag, value in items:
+            if tag is not None:
+                write(u'<%s>' % tag)
+                tag_end = u'</%s>' % tag
+            else:
+                tag_end = u''
+            value_type = type(value)
+            if value_type is unicode or value_type is str:
+                write(escape(value))
+            elif isinstance(value, dict):
+                start, value_end = _xml_start_tag(value)
+                write(start)
+                stack.append((_iter_xml_dict(value), value_end + tag_end))
+                break
+            elif isinstance(value, (tuple, list)):
+                write(u'<list>')
+                stack.append((_iter_xml_list(value), u'</list>' + tag_end))
+                break
+            elif isinstance(value, bool):
+                write(value and u'yes' or u'no')
+            else:
+                write(escape(unicode(value)))
+            write(tag_end)
+            if len(buffer) >= _xml_chunk_pieces:
+                yield u''.join(buffer)
+                del buffer[:]
+        else:
+            stack.pop()
+            write(end)
+    yield u''.join(buffer)
 
 
 def dump_xml(obj):
-    """Dumps data into a simple XML format."""
-    def _dump(obj):
-        if isinstance(obj, dict):
-            d = dict(obj)
-            obj_type = d.pop('#type', None)
-            key = start = 'dict'
-            if obj_type is not None:
-                if obj_type.startswith('solace.'):
-                    key = start = obj_type[7:]
-                else:
-                    start += ' type=%s' % quoteattr(obj_type)
-            return u'<%s>%s</%s>' % (
-                start,
-                u''.join((u'<%s>%s</%s>' % (key, _dump(value), key)
-                         for key, value in d.iteritems())),
-                key
-            )
-        if isinstance(obj, (tuple, list)):
-            def _item_dump(obj):
-                if not isinstance(obj, (tuple, list, dict)):
-                    return u'<item>%s</item>' % _dump(obj)
-                return _dump(obj)
-            return u'<list>%s</list>' % (u''.join(map(_item_dump, obj)))
-        if isinstance(obj, bool):
-            return obj and u'yes' or u'no'
-        return escape(unicode(obj))
-    return (
-        u'<?xml version="1.0" encoding="utf-8"?>'
-        u'<result xmlns="%s">%s</result>'
-    ) % (XML_NS, _dump(obj))
+    """Dumps data into a simple XML format, see :func:`iter_xml`."""
+    return u''.join(iter_xml(obj))
 
 
 def get_serializer(request):
@@ -119,7 +190,7 @@ def prepare_api_request(request):
     locale = request.args.get('locale')
     if locale is not None:
         try:
-            locale = Locale.parse(locale)
+            locale = intern_locale(locale)
             if not has_locale(locale):
                 raise UnknownLocaleError()
         except UnknownLocaleError:
@@ -127,11 +198,137 @@ def prepare_api_request(request):
         request.view_lang = locale
 
 
+def get_bool_arg(request, name, default=True):
+    """Returns a boolean query argument.  The API uses "yes" and "no" for
+    booleans, but "1", "0", "true" and "false" are accepted as well.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    value = value.lower()
+    if value in ('yes', '1', 'true'):
+        return True
+    if value in ('no', '0', 'false'):
+        return False
+    raise BadRequest(_(u'Invalid value for "%s"') % escape(name))
+
+
+def get_id_list(request, name='ids', limit=50):
+    """Returns the list of integer IDs from a comma separated query
+    argument or `None` if the argument was not sent.  At most `limit`
+    IDs are accepted.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        ids = [int(x) for x in value.split(',') if x.strip()]
+    except ValueError:
+        raise BadRequest(_(u'Invalid value for "%s"') % escape(name))
+    if len(ids) > limit:
+        raise BadRequest(_(u'You can only request %d items at once') % limit)
+    return ids
+
+
+def encode_cursor(values):
+    """Encodes the sort key values of the last item of a page into an
+    opaque cursor for the next page.
+    """
+    data = [isinstance(x, datetime) and x.strftime(_cursor_date_format) or x
+            for x in values]
+    return urlsafe_b64encode(simplejson.dumps(data, separators=(',', ':')))
+
+
+def decode_cursor(cursor, keys):
+    """Decodes a cursor created by :func:`encode_cursor` for the given sort
+    keys.  Invalid cursors cause a bad request error.
+    """
+    try:
+        values = simplejson.loads(urlsafe_b64decode(str(cursor)))
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise ValueError()
+        for idx, (attr, descending) in enumerate(keys):
+            if isinstance(attr.property.columns[0].type, DateTime):
+                values[idx] = datetime.strptime(values[idx],
+                                                _cursor_date_format)
+    except (TypeError, ValueError):
+        raise BadRequest(_(u'Invalid cursor'))
+    return values
+
+
+def _after_cursor(keys, values):
+    """The filter for the items after the cursor values."""
+    (attr, descending), value = keys[0], values[0]
+    if descending:
+        rv = attr < value
+    else:
+        rv = attr > value
+    if len(keys) > 1:
+        rv = or_(rv, and_(attr == value, _after_cursor(keys[1:], values[1:])))
+    return rv
+
+
+def paginate(request, query, keys, max_limit=50):
+    """Paginates a query for a list method of the API.  `keys` is a list
+    of ``(attribute, descending)`` tuples the items are sorted by.  The
+    last attribute has to be unique so that the keys are stable.
+
+    Pages are either selected with the opaque cursor of the previous page
+    (``cursor``) or with an ``offset``.  The total number of items is
+    counted unless ``count=no`` is passed.  Returns the items and a dict
+    with the pagination info for the response.
+    """
+    limit = max(0, min(max_limit, request.args.get('limit', 10, type=int)))
+    info = {'limit': limit}
+    if get_bool_arg(request, 'count'):
+        info['total_count'] = query.count()
+    for attr, descending in keys:
+        if descending:
+            attr = attr.desc()
+        query = query.order_by(attr)
+    cursor = request.args.get('cursor')
+    if cursor is not None:
+        query = query.filter(_after_cursor(keys, decode_cursor(cursor, keys)))
+    else:
+        info['offset'] = max(0, request.args.get('offset', type=int) or 0)
+        query = query.offset(info['offset'])
+    items = query.limit(limit + 1).all()
+    if limit and len(items) > limit:
+        del items[limit:]
+        info['next_cursor'] = encode_cursor([getattr(items[-1], attr.key)
+                                             for attr, descending in keys])
+    return items, info
+
+
+def get_fields(request):
+    """Returns the fields requested with the ``fields`` argument in the
+    format :func:`~solace.utils.remoting.parse_fields` returns or `None`
+    if all fields should be exported.
+    """
+    fields = request.args.get('fields')
+    if fields is not None:
+        fields = parse_fields(fields)
+    return fields
+
+
 def send_api_response(request, result):
-    """Sends the API response."""
-    ro = remote_export_primitive(result)
+    """Sends the API response.  If the request has a ``fields`` argument
+    only those fields of the remote objects are exported.  Serializers
+    return a string or an iterable of chunks that is streamed.
+
+    Streamed formats are serialized while the response is sent, after
+    the timings went out with the headers, so only the serialization of
+    the other formats shows up as ``serialize`` phase.  Like all other
+    responses the API responses get no ETag, whatever the format.
+    """
+    ro = remote_export_primitive(result, get_fields(request))
     serializer, mimetype = get_serializer(request)
-    return Response(serializer(ro), mimetype=mimetype)
+    if serializer in _streaming_serializers:
+        data = serializer(ro)
+    else:
+        with timed('serialize'):
+            data = serializer(ro)
+    return Response(data, mimetype=mimetype)
 
 
 def api_method(methods=('GET',)):
@@ -142,6 +339,8 @@ def api_method(methods=('GET',)):
                 raise MethodNotAllowed(methods)
             prepare_api_request(request)
             rv = f(request, *args, **kwargs)
+            if isinstance(rv, Response):
+                return rv
             return send_api_response(request, rv)
         f.is_api_method = True
         f.valid_methods = tuple(methods)
@@ -179,6 +378,9 @@ _serializer_for_mimetypes = {
 }
 _serializer_map = {
     'json':     (simplejson.dumps, 'application/json'),
-    'xml':      (dump_xml, 'application/xml'),
+    'xml':      (iter_xml, 'application/xml'),
     'debug':    (debug_dump, 'text/html')
 }
+
+# the serializers that return an iterable of chunks instead of a string
+_streaming_serializers = frozenset([iter_xml, debug_dump])
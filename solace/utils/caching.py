@@ -3,12 +3,33 @@
     solace.utils.caching
     ~~~~~~~~~~~~~~~~~~~~
 
-    Implements cache helpers.
+    Implements cache helpers and the pluggable cache layer.  The active
+    cache is configured with the `CACHE_BACKEND` and `CACHE_OPTIONS` settings
+    and returned by :func:`get_cache`.  All backends share the same interface
+    (`get`, `set`, `delete`, `get_many`, `set_many`, `clear`) and the same
+    hit/miss/eviction statistics.
+
+    Values are pickled for all backends, so cached objects never share
+    state with the code that put them into the cache.
 
     :copyright: (c) 2010 by the Solace Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
+from __future__ import with_statement
+import os
+import socket
+import tempfile
+from time import time
+from zlib import crc32
+from hashlib import md5
+from threading import Lock, local as thread_local
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
 from functools import update_wrapper
+from werkzeug import import_string
+
+
+_cache = None
+_cache_lock = Lock()
 
 
 def no_cache(f):
@@ -22,3 +43,623 @@ def no_cache(f):
         ])
         return response
     return update_wrapper(new_view, f)
+
+
+def get_cache():
+    """Creates or returns the cache from the configuration."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            backend = settings.CACHE_BACKEND
+            cls = _backends.get(backend)
+            if cls is None:
+                cls = import_string(backend)
+            _cache = cls(default_timeout=settings.CACHE_DEFAULT_TIMEOUT,
+                         key_prefix=settings.CACHE_KEY_PREFIX,
+                         **settings.CACHE_OPTIONS)
+        return _cache
+
+
+def refresh_cache():
+    """Drops the active cache after a config change.  The contents of
+    the old cache are cleared so that tests or interactive sessions do
+    not see stale values of a previous configuration, unless the cache
+    may be shared with other applications (memcached).
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is not None and not _cache.shared:
+            _cache.clear()
+        _cache = None
+
+
+def _serialize(value):
+    return dumps(value, HIGHEST_PROTOCOL)
+
+
+class CacheStats(object):
+    """Counts cache operations.  The counters are not protected by a
+    lock, in threaded environments they are approximations.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.hits = self.misses = self.evictions = 0
+        self.sets = self.deletes = 0
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        if total:
+            return self.hits / float(total)
+        return 0.0
+
+    def as_dict(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, sets=self.sets,
+                    deletes=self.deletes, hit_ratio=self.hit_ratio)
+
+
+class BaseCache(object):
+    """Baseclass for all cache backends.  Subclasses have to implement
+    `_get_many`, `_set_many`, `_delete_many` and `_clear`, the public
+    methods take care of key prefixes, timeouts and statistics.
+
+    A timeout of `None` means the default timeout, a timeout of ``0``
+    means that the item does not expire.
+    """
+
+    #: the name of the backend as displayed on the admin panel
+    name = None
+
+    #: true if the storage may be shared with other applications.  Such
+    #: caches are never cleared implicitly.
+    shared = False
+
+    def __init__(self, default_timeout=300, key_prefix=''):
+        self.default_timeout = default_timeout
+        self.key_prefix = key_prefix
+        self.stats = CacheStats()
+
+    def _make_key(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        elif not isinstance(key, str):
+            key = str(key)
+        return self.key_prefix + key
+
+    def _get_timeout(self, timeout):
+        if timeout is None:
+            return self.default_timeout
+        return timeout
+
+    def get(self, key, default=None):
+        """Looks up a single key.  If it does not exist or expired,
+        `default` is returned.
+        """
+        rv = self.get_many([key])
+        if key in rv:
+            return rv[key]
+        return default
+
+    def get_many(self, keys):
+        """Looks up multiple keys at once and returns a dict of the
+        keys that were found.
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        rv = self._load_many(keys)
+        self.stats.hits += len(rv)
+        self.stats.misses += len(keys) - len(rv)
+        return rv
+
+    def _load_many(self, keys):
+        """Like :meth:`get_many` but without counting hits and misses."""
+        real_keys = dict((self._make_key(key), key) for key in keys)
+        rv = {}
+        for real_key, value in self._get_many(real_keys.keys()).iteritems():
+            rv[real_keys[real_key]] = loads(value)
+        return rv
+
+    def set(self, key, value, timeout=None):
+        """Stores a single value in the cache."""
+        self.set_many({key: value}, timeout)
+
+    def set_many(self, mapping, timeout=None):
+        """Stores all values of the mapping in the cache."""
+        if not mapping:
+            return
+        self._set_many(dict((self._make_key(key), _serialize(value))
+                            for key, value in mapping.iteritems()),
+                       self._get_timeout(timeout))
+        self.stats.sets += len(mapping)
+
+    def delete(self, key):
+        """Removes a key from the cache."""
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        """Removes multiple keys from the cache."""
+        keys = [self._make_key(key) for key in keys]
+        if keys:
+            self._delete_many(keys)
+            self.stats.deletes += len(keys)
+
+    def clear(self):
+        """Clears the cache.  Not every backend can clear just the keys
+        with the prefix, the memcached one for example flushes the whole
+        server.
+        """
+        self._clear()
+
+    def namespace(self, name):
+        """Returns a :class:`CacheNamespace` for the given name."""
+        return CacheNamespace(self, name)
+
+    def get_info(self):
+        """Returns a list of ``(key, value)`` tuples with backend specific
+        information for the admin panel.
+        """
+        return []
+
+    def _get_many(self, keys):
+        raise NotImplementedError()
+
+    def _set_many(self, mapping, timeout):
+        raise NotImplementedError()
+
+    def _delete_many(self, keys):
+        raise NotImplementedError()
+
+    def _clear(self):
+        raise NotImplementedError()
+
+
+class CacheNamespace(object):
+    """A view on a cache that can be invalidated as a whole.  The values
+    are stored together with the version of the namespace and a value of
+    an older version counts as a miss, so bumping the version with
+    :meth:`invalidate` invalidates all keys without having to know them.
+    The version is fetched together with the values, so a lookup costs
+    one request to the cache.
+    """
+
+    def __init__(self, cache, name):
+        self.cache = cache
+        self.name = name
+        self._version_key = '__ns__/' + name
+
+    def get_version(self):
+        """Returns the current version of the namespace."""
+        version = self.cache._load_many([self._version_key]) \
+            .get(self._version_key)
+        if version is None:
+            version = int(time() * 1000)
+            self.cache.set(self._version_key, version, 0)
+        return version
+
+    def _make_key(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return '%s/%s' % (self.name, key)
+
+    def get(self, key, default=None):
+        rv = self.get_many([key])
+        if key in rv:
+            return rv[key]
+        return default
+
+    def get_many(self, keys):
+        real_keys = dict((self._make_key(key), key) for key in keys)
+        if not real_keys:
+            return {}
+        found = self.cache._load_many(real_keys.keys() + [self._version_key])
+        version = found.pop(self._version_key, None)
+        rv = {}
+        if version is not None:
+            for real_key, (item_version, value) in found.iteritems():
+                if item_version == version:
+                    rv[real_keys[real_key]] = value
+        self.cache.stats.hits += len(rv)
+        self.cache.stats.misses += len(real_keys) - len(rv)
+        return rv
+
+    def set(self, key, value, timeout=None):
+        self.set_many({key: value}, timeout)
+
+    def set_many(self, mapping, timeout=None):
+        version = self.get_version()
+        self.cache.set_many(dict((self._make_key(key), (version, value))
+                                 for key, value in mapping.iteritems()),
+                            timeout)
+
+    def delete(self, key):
+        self.cache.delete(self._make_key(key))
+
+    def delete_many(self, keys):
+        self.cache.delete_many([self._make_key(key) for key in keys])
+
+    def invalidate(self):
+        """Invalidates all keys in the namespace.  The old values are not
+        removed from the cache, they are ignored and expire or are evicted
+        eventually.
+        """
+        self.cache.set(self._version_key, self.get_version() + 1, 0)
+
+
+class NullCache(BaseCache):
+    """A cache that does not cache at all."""
+
+    name = 'null'
+
+    def _get_many(self, keys):
+        return {}
+
+    def _set_many(self, mapping, timeout):
+        pass
+
+    def _delete_many(self, keys):
+        pass
+
+    def _clear(self):
+        pass
+
+
+class _LRUItem(object):
+    __slots__ = ('key', 'value', 'expires', 'prev', 'next')
+
+
+class MemoryCache(BaseCache):
+    """An in-process LRU cache.  The cache is bounded by the number of
+    items and the size of the pickled values.  If either bound is reached,
+    the least recently used items are evicted.  This is the default
+    backend but keep in mind that every process has its own cache.
+    """
+
+    name = 'memory'
+
+    def __init__(self, default_timeout=300, key_prefix='', max_items=10000,
+                 max_bytes=32 * 1024 * 1024):
+        BaseCache.__init__(self, default_timeout, key_prefix)
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._clear()
+
+    @property
+    def size(self):
+        """The size of the stored values in bytes."""
+        return self._size
+
+    def __len__(self):
+        return len(self._items)
+
+    def _unlink(self, item):
+        item.prev.next = item.next
+        item.next.prev = item.prev
+
+    def _link_front(self, item):
+        item.prev = self._root
+        item.next = self._root.next
+        self._root.next.prev = item
+        self._root.next = item
+
+    def _remove(self, item):
+        self._unlink(item)
+        del self._items[item.key]
+        self._size -= len(item.value)
+
+    def _get_many(self, keys):
+        now = time()
+        rv = {}
+        with self._lock:
+            for key in keys:
+                item = self._items.get(key)
+                if item is None:
+                    continue
+                if item.expires and item.expires <= now:
+                    self._remove(item)
+                    continue
+                self._unlink(item)
+                self._link_front(item)
+                rv[key] = item.value
+        return rv
+
+    def _set_many(self, mapping, timeout):
+        expires = timeout and time() + timeout or 0
+        with self._lock:
+            for key, value in mapping.iteritems():
+                item = self._items.get(key)
+                if item is not None:
+                    self._remove(item)
+                if len(value) > self.max_bytes:
+                    continue
+                item = _LRUItem()
+                item.key = key
+                item.value = value
+                item.expires = expires
+                self._items[key] = item
+                self._size += len(value)
+                self._link_front(item)
+            while self._items and (len(self._items) > self.max_items or
+                                   self._size > self.max_bytes):
+                self._remove(self._root.prev)
+                self.stats.evictions += 1
+
+    def _delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                item = self._items.get(key)
+                if item is not None:
+                    self._remove(item)
+
+    def _clear(self):
+        with self._lock:
+            self._root = root = _LRUItem()
+            root.prev = root.next = root
+            self._items = {}
+            self._size = 0
+
+    def get_info(self):
+        return [('items', '%d / %d' % (len(self._items), self.max_items)),
+                ('bytes', '%d / %d' % (self._size, self.max_bytes))]
+
+
+class FileSystemCache(BaseCache):
+    """Stores the items in files in a folder.  If more than `threshold`
+    files are stored, expired items and then the oldest items are
+    removed.  This backend is shared by all processes on the machine.
+    """
+
+    name = 'filesystem'
+
+    def __init__(self, default_timeout=300, key_prefix='', cache_dir=None,
+                 threshold=2000):
+        BaseCache.__init__(self, default_timeout, key_prefix)
+        if cache_dir is None:
+            cache_dir = os.path.join(tempfile.gettempdir(), 'solace-cache')
+        self.cache_dir = cache_dir
+        self.threshold = threshold
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _get_filename(self, key):
+        return os.path.join(self.cache_dir, md5(key).hexdigest())
+
+    def _list_files(self):
+        return [os.path.join(self.cache_dir, fn) for fn
+                in os.listdir(self.cache_dir) if not fn.startswith('.')]
+
+    def _prune(self):
+        files = self._list_files()
+        if len(files) <= self.threshold:
+            return
+        now = time()
+        survivors = []
+        for fn in files:
+            try:
+                with open(fn, 'rb') as f:
+                    expires = float(f.readline())
+                if expires and expires <= now:
+                    os.remove(fn)
+                    self.stats.evictions += 1
+                else:
+                    survivors.append((os.path.getmtime(fn), fn))
+            except (IOError, OSError, ValueError):
+                pass
+        survivors.sort()
+        for mtime, fn in survivors[:max(0, len(survivors) - self.threshold)]:
+            try:
+                os.remove(fn)
+                self.stats.evictions += 1
+            except OSError:
+                pass
+
+    def _get_many(self, keys):
+        now = time()
+        rv = {}
+        for key in keys:
+            fn = self._get_filename(key)
+            try:
+                with open(fn, 'rb') as f:
+                    expires = float(f.readline())
+                    value = f.read()
+            except (IOError, OSError, ValueError):
+                continue
+            if expires and expires <= now:
+                try:
+                    os.remove(fn)
+                except OSError:
+                    pass
+                continue
+            rv[key] = value
+        return rv
+
+    def _set_many(self, mapping, timeout):
+        self._prune()
+        expires = timeout and time() + timeout or 0
+        for key, value in mapping.iteritems():
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix='.')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write('%r\n' % float(expires))
+                    f.write(value)
+                os.rename(tmp, self._get_filename(key))
+            except (IOError, OSError):
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
+    def _delete_many(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._get_filename(key))
+            except OSError:
+                pass
+
+    def _clear(self):
+        for fn in self._list_files():
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+
+    def get_info(self):
+        return [('directory', self.cache_dir),
+                ('files', '%d / %d' % (len(self._list_files()),
+                                       self.threshold))]
+
+
+class MemcachedCache(BaseCache):
+    """Talks the memcached text protocol to one or more servers.  Keys
+    are distributed over the servers by their hash.  Network errors never
+    propagate, a failing server behaves like an empty cache and the
+    connection is retried on the next access.
+
+    Connections are kept open per thread.
+    """
+
+    name = 'memcached'
+
+    shared = True
+
+    #: memcached does not accept keys longer than 250 characters
+    max_key_length = 250
+
+    #: memcached takes timeouts longer than 30 days as unix timestamps
+    max_relative_timeout = 60 * 60 * 24 * 30
+
+    def __init__(self, default_timeout=300, key_prefix='',
+                 servers=('127.0.0.1:11211',), socket_timeout=3):
+        BaseCache.__init__(self, default_timeout, key_prefix)
+        self.servers = []
+        for server in servers:
+            host, port = server.rsplit(':', 1)
+            self.servers.append((host, int(port)))
+        self.socket_timeout = socket_timeout
+        self._local = thread_local()
+
+    def _make_key(self, key):
+        key = BaseCache._make_key(self, key)
+        if len(key) > self.max_key_length or \
+           [c for c in key if c <= ' ' or c == '\x7f']:
+            key = 'md5:' + md5(key).hexdigest()
+        return key
+
+    def _get_server(self, key):
+        return self.servers[(crc32(key) & 0xffffffff) % len(self.servers)]
+
+    def _group_by_server(self, keys):
+        rv = {}
+        for key in keys:
+            rv.setdefault(self._get_server(key), []).append(key)
+        return rv.iteritems()
+
+    def _get_connection(self, server):
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        con = connections.get(server)
+        if con is None:
+            sock = socket.create_connection(server, self.socket_timeout)
+            con = connections[server] = (sock, sock.makefile('rb'))
+        return con
+
+    def _drop_connection(self, server):
+        con = getattr(self._local, 'connections', {}).pop(server, None)
+        if con is not None:
+            try:
+                con[0].close()
+            except socket.error:
+                pass
+
+    def _command(self, server, data, reader):
+        """Sends the data to the server and returns whatever the reader
+        returns.  The reader is invoked with the file object for the
+        socket.  On errors `None` is returned.
+        """
+        try:
+            sock, f = self._get_connection(server)
+            sock.sendall(data)
+            return reader(f)
+        except (socket.error, EnvironmentError, ValueError):
+            self._drop_connection(server)
+
+    def _get_many(self, keys):
+        rv = {}
+        def reader(f):
+            while 1:
+                line = f.readline()
+                if not line.endswith('\r\n'):
+                    raise ValueError('unexpected end of stream')
+                if line == 'END\r\n':
+                    return
+                response, key, flags, length = line.split()
+                if response != 'VALUE':
+                    raise ValueError('unexpected response %r' % line)
+                rv[key] = f.read(int(length) + 2)[:-2]
+        for server, server_keys in self._group_by_server(keys):
+            self._command(server, 'get %s\r\n' % ' '.join(server_keys),
+                          reader)
+        return rv
+
+    def _set_many(self, mapping, timeout):
+        if timeout > self.max_relative_timeout:
+            timeout = int(time()) + timeout
+        for server, server_keys in self._group_by_server(mapping):
+            data = ''.join('set %s 0 %d %d\r\n%s\r\n' % (
+                key, timeout, len(mapping[key]), mapping[key])
+                for key in server_keys)
+            def reader(f, count=len(server_keys)):
+                for x in xrange(count):
+                    f.readline()
+            self._command(server, data, reader)
+
+    def _delete_many(self, keys):
+        for server, server_keys in self._group_by_server(keys):
+            data = ''.join('delete %s\r\n' % key for key in server_keys)
+            def reader(f, count=len(server_keys)):
+                for x in xrange(count):
+                    f.readline()
+            self._command(server, data, reader)
+
+    def _clear(self):
+        for server in self.servers:
+            self._command(server, 'flush_all\r\n', lambda f: f.readline())
+
+    def get_info(self):
+        rv = []
+        def reader(f):
+            result = {}
+            while 1:
+                line = f.readline()
+                if not line.endswith('\r\n') or line == 'END\r\n':
+                    return result
+                pieces = line.split()
+                if len(pieces) == 3 and pieces[0] == 'STAT':
+                    result[pieces[1]] = pieces[2]
+        for server in self.servers:
+            stats = self._command(server, 'stats\r\n', reader)
+            if stats is None:
+                rv.append(('%s:%d' % server, 'unreachable'))
+            else:
+                rv.append(('%s:%d' % server, '%s items, %s evictions' % (
+                    stats.get('curr_items', '?'),
+                    stats.get('evictions', '?'))))
+        return rv
+
+
+_backends = {
+    'null':         NullCache,
+    'memory':       MemoryCache,
+    'filesystem':   FileSystemCache,
+    'memcached':    MemcachedCache
+}
+
+
+# circular dependencies
+from solace import settings
@@ -25,7 +25,6 @@ from jinja2 import Markup, escape
 from solace import settings
 from solace.i18n import _, ngettext, lazy_gettext
 from solace.utils.support import OrderedDict
-from solace.utils.recaptcha import get_recaptcha_html, validate_recaptcha
 from solace.utils.csrf import get_csrf_token, invalidate_csrf_token
 
 
@@ -785,6 +784,7 @@ class FormWidget(MappingWidget):
     def captcha(self):
         """The captcha if one exists for this form."""
         if self._field.form.captcha_protected:
+            from solace.utils.recaptcha import get_recaptcha_html
             return get_recaptcha_html()
 
     @property
@@ -1113,6 +1113,7 @@ class FormMapping(Mapping):
             request = self.form.request
             if request is None:
                 raise RuntimeError('captcha protected forms need a request')
+            from solace.utils.recaptcha import validate_recaptcha
             if not validate_recaptcha(request.values.get('recaptcha_challenge_field'),
                                       request.values.get('recaptcha_response_field'),
                                       request.remote_addr):
@@ -3,7 +3,9 @@
     solace.utils.mail
     ~~~~~~~~~~~~~~~~~
 
-    This module can be used to send mails.
+    This module can be used to send mails.  If the mail queue is enabled
+    mails are written into the mail queue table instead and sent in
+    batches over one connection by `send_queued_mails`.
 
     :copyright: (c) 2010 by the Solace Team, see AUTHORS for more details.
                 (c) 2009 by the Zine Team, see AUTHORS for more details.
@@ -11,28 +13,135 @@
 """
 import os
 import re
+import socket
+from datetime import datetime, timedelta
 try:
     from email.mime.text import MIMEText
 except ImportError:
     from email.MIMEText import MIMEText
-from smtplib import SMTP, SMTPException
+from smtplib import SMTP, SMTPException, SMTPServerDisconnected
 from urlparse import urlparse
+from sqlalchemy import select
 
 from solace import settings
 
 
 def send_email(subject, text, to_addrs, quiet=True):
     """Send a mail using the `EMail` class.  This will log the email instead
-    if the application configuration wants to log email.
+    if the application configuration wants to log email.  If the mail
+    queue is enabled, the mail is queued and sent after the current
+    transaction was committed.
     """
     e = EMail(subject, text, to_addrs)
     if settings.MAIL_LOG_FILE is not None:
         return e.log(settings.MAIL_LOG_FILE)
+    if settings.MAIL_QUEUE_ENABLED:
+        return e.queue()
     if quiet:
         return e.send_quiet()
     return e.send()
 
 
+def connect_smtp():
+    """Opens a connection to the configured SMTP server and logs in if
+    necessary.  Raises a `RuntimeError` if that fails.
+    """
+    try:
+        smtp = SMTP(settings.SMTP_HOST, settings.SMTP_PORT)
+    except (SMTPException, socket.error), e:
+        raise RuntimeError(str(e))
+
+    if settings.SMTP_USE_TLS:
+        smtp.ehlo()
+        if not smtp.esmtp_features.has_key('starttls'):
+            raise RuntimeError('TLS enabled but server does not '
+                               'support TLS')
+        smtp.starttls()
+        smtp.ehlo()
+
+    if settings.SMTP_USER:
+        try:
+            smtp.login(settings.SMTP_USER,
+                       settings.SMTP_PASSWORD)
+        except SMTPException, e:
+            raise RuntimeError(str(e))
+    return smtp
+
+
+def close_smtp(smtp):
+    """Closes a connection opened by `connect_smtp`."""
+    try:
+        smtp.quit()
+    except (SMTPServerDisconnected, socket.error):
+        # avoid false failure detection when the server closes
+        # the SMTP connection with TLS enabled
+        smtp.close()
+
+
+def send_queued_mails(batch_size=50):
+    """Sends the mails from the mail queue that are due.  The mails are
+    sent in batches of `batch_size` over one connection.  If sending a
+    mail fails, the error is recorded and the mail is tried again later
+    until `MAIL_QUEUE_MAX_ATTEMPTS` is reached.  Only one worker should
+    send mails at a time.
+
+    Returns a ``(sent, failed)`` tuple with the number of mails.
+    """
+    q = mail_queue.c
+    sent = failed = 0
+    while 1:
+        now = datetime.utcnow()
+        rows = session.execute(select([q.mail_id, q.from_addr, q.to_addrs,
+                                       q.message, q.attempts],
+            (q.status == 'pending') & (q.next_attempt <= now))
+            .order_by(q.mail_id).limit(batch_size)).fetchall()
+        if not rows:
+            break
+        smtp = connect_error = None
+        try:
+            for row in rows:
+                try:
+                    # if the server is not reachable, all the mails of
+                    # the batch fail without trying to connect again.
+                    if smtp is None:
+                        if connect_error is None:
+                            try:
+                                smtp = connect_smtp()
+                            except RuntimeError, e:
+                                connect_error = e
+                        if connect_error is not None:
+                            raise connect_error
+                    smtp.sendmail(row.from_addr, row.to_addrs.splitlines(),
+                                  row.message.encode('utf-8'))
+                except (RuntimeError, SMTPException, socket.error), e:
+                    # the connection is unusable after these errors
+                    if smtp is not None and isinstance(e,
+                       (SMTPServerDisconnected, socket.error)):
+                        smtp.close()
+                        smtp = None
+                    attempts = row.attempts + 1
+                    delay = settings.MAIL_QUEUE_RETRY_DELAY * \
+                        2 ** (attempts - 1)
+                    if attempts >= settings.MAIL_QUEUE_MAX_ATTEMPTS:
+                        status = 'failed'
+                    else:
+                        status = 'pending'
+                    values = dict(status=status, attempts=attempts,
+                                  last_error=str(e)[:255],
+                                  next_attempt=now + timedelta(seconds=delay))
+                    failed += 1
+                else:
+                    values = dict(status='sent', sent=datetime.utcnow())
+                    sent += 1
+                session.execute(mail_queue.update(q.mail_id == row.mail_id),
+                                values)
+        finally:
+            if smtp is not None:
+                close_smtp(smtp)
+        session.commit()
+    return sent, failed
+
+
 class EMail(object):
     """Represents one E-Mail message that can be sent."""
 
@@ -99,28 +208,28 @@ class EMail(object):
             if close_later:
                 f.close()
 
-    def send(self):
-        """Send the message."""
-        try:
-            smtp = SMTP(settings.SMTP_HOST, settings.SMTP_PORT)
-        except SMTPException, e:
-            raise RuntimeError(str(e))
-
-        if settings.SMTP_USE_TLS:
-            smtp.ehlo()
-            if not smtp.esmtp_features.has_key('starttls'):
-                raise RuntimeError('TLS enabled but server does not '
-                                   'support TLS')
-            smtp.starttls()
-            smtp.ehlo()
-
-        if settings.SMTP_USER:
-            try:
-                smtp.login(settings.SMTP_USER,
-                           settings.SMTP_PASSWORD)
-            except SMTPException, e:
-                raise RuntimeError(str(e))
-
+    def queue(self):
+        """Puts the message into the mail queue.  It's sent after the
+        transaction of the session was committed.
+        """
+        now = datetime.utcnow()
+        session.execute(mail_queue.insert(), dict(
+            from_addr=self.from_addr,
+            to_addrs=u'\n'.join(self.to_addrs),
+            message=self.format().decode('utf-8'),
+            status='pending',
+            attempts=0,
+            next_attempt=now,
+            created=now
+        ))
+
+    def send(self, smtp=None):
+        """Send the message.  If no connection returned by `connect_smtp`
+        is given, a new one is opened and closed afterwards.
+        """
+        close_later = smtp is None
+        if close_later:
+            smtp = connect_smtp()
         msgtext = self.format()
         try:
             try:
@@ -128,16 +237,8 @@ class EMail(object):
             except SMTPException, e:
                 raise RuntimeError(str(e))
         finally:
-            if settings.SMTP_USE_TLS:
-                # avoid false failure detection when the server closes
-                # the SMTP connection with TLS enabled
-                import socket
-                try:
-                    smtp.quit()
-                except socket.sslerror:
-                    pass
-            else:
-                smtp.quit()
+            if close_later:
+                close_smtp(smtp)
 
     def send_quiet(self):
         """Send the message, swallowing exceptions."""
@@ -145,3 +246,8 @@ class EMail(object):
             return self.send()
         except Exception:
             return
+
+
+# circular dependencies
+from solace.database import session
+from solace.schema import mail_queue
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+    solace.utils.profiling
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Implements a sampling profiler that can be enabled in production.  A
+    fraction of the requests (`PROFILER_SAMPLE_RATE`) is observed by a
+    background thread that looks at the stack of the request's thread
+    every `PROFILER_INTERVAL` seconds.  The stacks are aggregated per
+    endpoint in the collapsed format flamegraph tools understand.
+
+    Only the dispatching of the request is profiled, the iteration over
+    a streamed response body is not.
+
+    Additionally :func:`profile_imports` reports which modules slow down
+    the startup.
+
+    :copyright: (c) 2010 by the Solace Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import with_statement
+import sys
+import __builtin__
+from random import random
+from threading import Lock, Thread, Event
+from time import sleep, time
+from thread import get_ident
+from werkzeug.exceptions import HTTPException
+
+
+_profiles_lock = Lock()
+_profiles = {}
+_sampler_lock = Lock()
+_sampler = None
+
+
+def get_profiled_endpoints():
+    """Returns a list of ``(endpoint, samples)`` tuples for all endpoints
+    with samples, the ones with the most samples first.
+    """
+    with _profiles_lock:
+        rv = [(endpoint, sum(stacks.itervalues()))
+              for endpoint, stacks in _profiles.iteritems()]
+    rv.sort(key=lambda x: (-x[1], x[0]))
+    return rv
+
+
+def get_collapsed_stacks(endpoint):
+    """Returns a dict of the collapsed stacks (frames separated by
+    semicolons, the outermost first) and the number of samples for the
+    endpoint.
+    """
+    with _profiles_lock:
+        return dict(_profiles.get(endpoint, ()))
+
+
+def format_collapsed_stacks(endpoint):
+    """Returns the stacks of the endpoint in the folded format that is
+    used by ``flamegraph.pl`` and compatible tools.
+    """
+    stacks = get_collapsed_stacks(endpoint)
+    return ''.join('%s %d\n' % item for item in sorted(stacks.iteritems()))
+
+
+def get_top_functions(endpoint, limit=20):
+    """Returns the functions with the most samples for the endpoint as
+    list of ``(function, self_samples, total_samples)`` tuples.  The self
+    samples are the samples where the function was running, the total
+    samples the ones where it was on the stack.
+    """
+    own = {}
+    total = {}
+    for stack, samples in get_collapsed_stacks(endpoint).iteritems():
+        frames = stack.split(';')
+        own[frames[-1]] = own.get(frames[-1], 0) + samples
+        for frame in set(frames):
+            total[frame] = total.get(frame, 0) + samples
+    rv = [(func, own.get(func, 0), samples)
+          for func, samples in total.iteritems()]
+    rv.sort(key=lambda x: (-x[1], -x[2], x[0]))
+    return rv[:limit]
+
+
+def reset_profiles():
+    """Forgets all samples."""
+    with _profiles_lock:
+        _profiles.clear()
+
+
+def _collapse(frame, stop):
+    """Collapses the stack into a string.  `stop` is the frame of the
+    middleware, frames outside of it are ignored.
+    """
+    frames = []
+    while frame is not None and frame is not stop:
+        code = frame.f_code
+        frames.append('%s.%s' % (frame.f_globals.get('__name__', '?'),
+                                 code.co_name))
+        frame = frame.f_back
+    frames.reverse()
+    return ';'.join(frames)
+
+
+class _Sampler(object):
+    """Samples the stacks of the threads that are profiled."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.active = {}
+        self.wakeup = Event()
+        #: the number of times the active threads were sampled
+        self.rounds = 0
+        thread = Thread(target=self.run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def start(self, frame):
+        """Starts sampling the current thread below `frame`."""
+        with self.lock:
+            self.active[get_ident()] = (frame, {})
+            self.wakeup.set()
+
+    def stop(self):
+        """Stops sampling the current thread and returns the samples.
+        Once this returns the sampler no longer touches the samples.
+        """
+        with self.lock:
+            frame, samples = self.active.pop(get_ident(), (None, {}))
+            if not self.active:
+                self.wakeup.clear()
+        return samples
+
+    def run(self):
+        while 1:
+            self.wakeup.wait()
+            sleep(settings.PROFILER_INTERVAL)
+            frames = sys._current_frames()
+            # the samples are recorded with the lock held, so they cannot
+            # change after stop() returned them
+            with self.lock:
+                for ident, (stop, samples) in self.active.iteritems():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stack = _collapse(frame, stop)
+                        # samples in the middleware itself (starting and
+                        # stopping the sampling) are not interesting
+                        if stack and not stack.startswith(__name__ + '.'):
+                            samples[stack] = samples.get(stack, 0) + 1
+                self.rounds += 1
+            del frames
+
+
+def _get_sampler():
+    global _sampler
+    with _sampler_lock:
+        if _sampler is None:
+            _sampler = _Sampler()
+        return _sampler
+
+
+class ProfilerMiddleware(object):
+    """Profiles `PROFILER_SAMPLE_RATE` of the requests to the wrapped
+    application.  If the rate is zero, requests are passed through.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def get_endpoint(self, environ):
+        try:
+            return url_map.bind_to_environ(environ).match()[0]
+        except HTTPException:
+            return '<unmatched>'
+
+    def __call__(self, environ, start_response):
+        rate = settings.PROFILER_SAMPLE_RATE
+        if not rate or random() >= rate:
+            return self.app(environ, start_response)
+        sampler = _get_sampler()
+        sampler.start(sys._getframe())
+        try:
+            return self.app(environ, start_response)
+        finally:
+            samples = sampler.stop()
+            if samples:
+                endpoint = self.get_endpoint(environ)
+                with _profiles_lock:
+                    stacks = _profiles.setdefault(endpoint, {})
+                    for stack, count in samples.iteritems():
+                        stacks[stack] = stacks.get(stack, 0) + count
+
+
+def _import_name(name, modules):
+    """Returns the name of the requested module from the modules that
+    were loaded by an import of `name`.
+    """
+    matches = [x for x in modules if x == name or x.endswith('.' + name)]
+    if matches:
+        return min(matches, key=len)
+    return min(modules, key=len)
+
+
+def profile_imports(module):
+    """Imports the module and returns a list of ``(name, self, total)``
+    tuples for every module that was imported for the first time, the
+    slowest first.  `self` is the time spent in the module's own code,
+    `total` includes the modules it imported.  Modules that were already
+    imported are not listed, so call this from a fresh interpreter.
+    """
+    original_import = __builtin__.__import__
+    children = [0.0]
+    rv = []
+
+    def profiled_import(*args, **kwargs):
+        before = set(sys.modules)
+        children.append(0.0)
+        start = time()
+        try:
+            return original_import(*args, **kwargs)
+        finally:
+            total = time() - start
+            nested = children.pop()
+            children[-1] += total
+            new = [x for x in set(sys.modules) - before
+                   if sys.modules[x] is not None]
+            if new:
+                rv.append((_import_name(args[0], new), total - nested,
+                           total))
+            else:
+                # the time spent for already imported modules belongs
+                # to the importing module
+                children[-1] -= total
+
+    __builtin__.__import__ = profiled_import
+    try:
+        profiled_import(module)
+    finally:
+        __builtin__.__import__ = original_import
+    rv.sort(key=lambda x: -x[2])
+    return rv
+
+
+# circular dependencies
+from solace import settings
+from solace.urls import url_map
@@ -12,36 +12,340 @@
     :copyright: (c) 2010 by the Solace Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
+from types import MethodType, FunctionType, InstanceType
+from operator import attrgetter
+from itertools import izip
 from datetime import datetime
 from babel import Locale
+from sqlalchemy.orm import class_mapper, eagerload
+from sqlalchemy.orm.attributes import QueryableAttribute
+from sqlalchemy.orm.properties import RelationProperty
 from solace.utils.lazystring import is_lazy_string
 
 
-def remote_export_primitive(obj):
-    """Remote exports a primitive."""
-    if isinstance(obj, RemoteObject):
-        return obj.remote_export()
-    if is_lazy_string(obj):
-        return unicode(obj)
-    if isinstance(obj, datetime):
-        return {'#type': 'solace.datetime',
-                'value': obj.strftime('%Y-%m-%dT%H:%M:%SZ')}
-    if isinstance(obj, Locale):
-        return unicode(str(obj))
-    if isinstance(obj, dict):
-        return dict((key, remote_export_primitive(value))
-                    for key, value in obj.iteritems())
-    if hasattr(obj, '__iter__'):
-        return map(remote_export_primitive, obj)
+# the compiled exporters for the remote objects by class and for the
+# exporters of selected fields by class and field names.  The load plans
+# are cached the same way.
+_exporters = {}
+_field_exporters = {}
+_field_exporters_limit = 256
+_load_plans = {}
+
+# values of these types are exported as they are
+_plain_types = frozenset([int, long, float, bool, str, unicode, type(None)])
+
+# how fields are called by the exporters.  Methods are always called,
+# columns and relations never and for everything else it depends on
+# the value.
+_never_call, _always_call, _call_if_callable = range(3)
+
+
+def remote_export_primitive(obj, fields=None):
+    """Remote exports a primitive.  `fields` is passed to the
+    :meth:`RemoteObject.remote_export` method of the remote objects.
+    """
+    try:
+        exporter = _primitive_exporters[type(obj)]
+    except KeyError:
+        exporter = _find_primitive_exporter(obj)
+    return exporter(obj, fields)
+
+
+def _export_plain(obj, fields):
     return obj
 
 
+def _export_remote_object(obj, fields):
+    return obj.remote_export(fields)
+
+
+def _export_lazy_string(obj, fields):
+    return unicode(obj)
+
+
+def format_utc_datetime(obj):
+    """Formats a naive UTC datetime for exports.  Unlike `strftime` this
+    also works for dates before 1900.
+
+    >>> from datetime import datetime
+    >>> format_utc_datetime(datetime(1899, 12, 31, 23, 59, 1, 500))
+    '1899-12-31T23:59:01Z'
+    """
+    return obj.isoformat()[:19] + 'Z'
+
+
+def _export_datetime(obj, fields):
+    return {'#type': 'solace.datetime', 'value': format_utc_datetime(obj)}
+
+
+def _export_locale(obj, fields):
+    return unicode(str(obj))
+
+
+def _export_dict(obj, fields):
+    rv = {}
+    for key, value in obj.iteritems():
+        if type(value) not in _plain_types:
+            value = remote_export_primitive(value, fields)
+        rv[key] = value
+    return rv
+
+
+def _export_iterable(obj, fields):
+    rv = []
+    for value in obj:
+        if type(value) not in _plain_types:
+            value = remote_export_primitive(value, fields)
+        rv.append(value)
+    return rv
+
+
+def _find_primitive_exporter(obj):
+    """Finds the exporter for an object whose type was not exported
+    before and remembers it for that type.
+    """
+    if isinstance(obj, RemoteObject):
+        rv = _export_remote_object
+    elif is_lazy_string(obj):
+        rv = _export_lazy_string
+    elif isinstance(obj, datetime):
+        rv = _export_datetime
+    elif isinstance(obj, Locale):
+        rv = _export_locale
+    elif isinstance(obj, dict):
+        rv = _export_dict
+    elif hasattr(obj, '__iter__'):
+        rv = _export_iterable
+    else:
+        rv = _export_plain
+    # all instances of old-style classes have the same type
+    if type(obj) is not InstanceType:
+        _primitive_exporters[type(obj)] = rv
+    return rv
+
+
+_primitive_exporters = dict.fromkeys(_plain_types, _export_plain)
+_primitive_exporters.update({
+    datetime:   _export_datetime,
+    dict:       _export_dict,
+    list:       _export_iterable,
+    tuple:      _export_iterable
+})
+
+
 def _recursive_getattr(obj, key):
     for attr in key.split('.'):
         obj = getattr(obj, attr, None)
     return obj
 
 
+def _iter_public_fields(cls):
+    """Iterates over the aliases and keys of the public fields."""
+    for key in cls.public_fields:
+        if isinstance(key, tuple):
+            yield key
+        else:
+            yield key.rsplit('.', 1)[-1], key
+
+
+def _get_call_mode(cls, key):
+    if '.' in key:
+        return _call_if_callable
+    attr = getattr(cls, key, None)
+    if isinstance(attr, (MethodType, FunctionType)):
+        return _always_call
+    if isinstance(attr, QueryableAttribute):
+        return _never_call
+    return _call_if_callable
+
+
+def compile_exporter(cls, aliases=None):
+    """Compiles the function that exports the `public_fields` of the
+    remote object class (or only the fields with the given aliases).
+    All fields are looked up with one `attrgetter`, the dotted names
+    are only resolved one by one if that fails because an object in
+    between is `None` or an attribute is missing.
+    """
+    remote_object_type = cls.remote_object_type
+    names = []
+    keys = []
+    call_modes = []
+    for alias, key in _iter_public_fields(cls):
+        if aliases is None or alias in aliases:
+            names.append(alias)
+            keys.append(key)
+            call_modes.append(_get_call_mode(cls, key))
+    fields_info = zip(names, call_modes)
+
+    if not keys:
+        getter = lambda obj: ()
+    elif len(keys) == 1:
+        getter = lambda obj, get=attrgetter(keys[0]): (get(obj),)
+    else:
+        getter = attrgetter(*keys)
+
+    def export(obj, fields=None):
+        try:
+            values = getter(obj)
+        except AttributeError:
+            values = [_recursive_getattr(obj, key) for key in keys]
+        result = {'#type': remote_object_type}
+        for (alias, call_mode), value in izip(fields_info, values):
+            if call_mode and (call_mode == _always_call or callable(value)):
+                value = value()
+            if type(value) not in _plain_types:
+                value = remote_export_primitive(value, fields is not None
+                                                and fields[alias] or None)
+            result[alias] = value
+        return result
+    return export
+
+
+def get_exporter(cls, fields=None):
+    """Returns the compiled exporter for the class and fields."""
+    if fields is None:
+        rv = _exporters.get(cls)
+        if rv is None:
+            rv = _exporters[cls] = compile_exporter(cls)
+        return rv
+    key = (cls, frozenset(fields))
+    rv = _field_exporters.get(key)
+    if rv is None:
+        rv = compile_exporter(cls, fields)
+        # the field names come from the request, don't grow forever
+        if len(_field_exporters) < _field_exporters_limit:
+            _field_exporters[key] = rv
+    return rv
+
+
+def _freeze_fields(fields):
+    if fields is not None:
+        return frozenset((key, _freeze_fields(value))
+                         for key, value in fields.iteritems())
+
+
+def _is_primary_key(mapper, prop):
+    """Is the property the primary key column of the mapper?"""
+    columns = getattr(prop, 'columns', None)
+    return bool(columns) and len(mapper.primary_key) == 1 and \
+        columns[0] is mapper.primary_key[0]
+
+
+class LoadPlan(object):
+    """Knows the relations that have to be loaded eagerly to export
+    objects of a remote object class with the given fields without a
+    query per object.  The plan is derived from the `public_fields` and
+    `remote_relations` of the class and of the remote objects exported
+    with it.  Use :func:`get_load_plan` to get the plan for a class.
+    """
+
+    def __init__(self, cls, fields=None):
+        self.cls = cls
+        #: the relations to load eagerly as dotted paths
+        self.paths = []
+        #: a list of ``(path, cls, fields)`` tuples for the objects that
+        #: are prepared with :meth:`RemoteObject.remote_prepare`.
+        self.prepares = []
+        self._add(cls, fields, ())
+
+    def _add_path(self, path):
+        if path not in self.paths:
+            self.paths.append(path)
+
+    def _add(self, cls, fields, path):
+        self.prepares.append((path, cls, fields))
+        prefix = ''.join(x + '.' for x in path)
+        for alias, key in _iter_public_fields(cls):
+            if fields is not None and alias not in fields:
+                continue
+            for name in cls.remote_relations.get(alias, ()):
+                self._add_path(prefix + name)
+            mapper = class_mapper(cls)
+            target = None
+            relation_path = path
+            parts = key.split('.')
+            for idx, name in enumerate(parts):
+                prop = mapper.get_property(name, raiseerr=False)
+                if not isinstance(prop, RelationProperty):
+                    # if only the primary key of the related object is
+                    # exported the relation does not have to be loaded,
+                    # the object is in the session already or fetched
+                    # by its key without a join
+                    if relation_path != path and idx == len(parts) - 1 \
+                       and _is_primary_key(mapper, prop):
+                        relation_path = relation_path[:-1]
+                    target = None
+                    break
+                relation_path += (name,)
+                mapper = prop.mapper
+                target = mapper.class_
+            # eagerload('a.b') only loads b, so every step is added
+            for idx in xrange(len(path), len(relation_path)):
+                self._add_path('.'.join(relation_path[:idx + 1]))
+            if target is not None and issubclass(target, RemoteObject):
+                self._add(target, fields is not None and fields[alias]
+                          or None, relation_path)
+
+    def options(self, prefix=''):
+        """Returns the eager loading options for a query of the class.
+        If the objects are loaded by a relation of the queried class the
+        name of the relation and a dot is the `prefix`.
+        """
+        return [eagerload(prefix + path) for path in self.paths]
+
+    def prepare(self, objects):
+        """Prepares loaded objects of the class and the objects exported
+        with them for the export.
+        """
+        for path, cls, fields in self.prepares:
+            items = objects
+            for name in path:
+                values = []
+                for item in items:
+                    value = getattr(item, name)
+                    if isinstance(value, RemoteObject):
+                        values.append(value)
+                    elif value is not None:
+                        values.extend(value)
+                items = values
+            if items:
+                cls.remote_prepare(items, fields)
+
+
+def get_load_plan(cls, fields=None):
+    """Returns the :class:`LoadPlan` for the class and fields."""
+    key = (cls, _freeze_fields(fields))
+    rv = _load_plans.get(key)
+    if rv is None:
+        rv = LoadPlan(cls, fields)
+        if len(_load_plans) < _field_exporters_limit:
+            _load_plans[key] = rv
+    return rv
+
+
+def parse_fields(value):
+    """Parses a comma separated list of field names into the format the
+    `fields` argument of :meth:`RemoteObject.remote_export` expects.
+    Fields of nested objects are separated with dots::
+
+        >>> parse_fields('id,title,author.username')
+        {'id': None, 'title': None, 'author': {'username': None}}
+    """
+    result = {}
+    for name in value.split(','):
+        parts = [x.strip() for x in name.split('.') if x.strip()]
+        node = result
+        for part in parts[:-1]:
+            if part in node and node[part] is None:
+                # all fields of that object were requested already
+                break
+            node = node.setdefault(part, {})
+        else:
+            if parts:
+                node[parts[-1]] = None
+    return result
+
+
 class RemoteObject(object):
     """Baseclass for remote objects."""
 
@@ -51,22 +355,28 @@ class RemoteObject(object):
     #: subclasses have to provide this as a list
     public_fields = None
 
-    def remote_export(self):
+    #: maps the aliases of public fields that are computed from relations
+    #: to the names of these relations, so that they are loaded eagerly.
+    #: Relations in the public fields themselves are found automatically.
+    remote_relations = {}
+
+    @classmethod
+    def remote_prepare(cls, objects, fields=None):
+        """Called with the loaded objects before they are exported with
+        the fields.  Subclasses can load data for all the objects at once
+        here that is not loaded by a relation.
+        """
+
+    def remote_export(self, fields=None):
         """Exports the object into a data structure ready to be
         serialized.  This is always a dict with string keys and
         the values are safe for pickeling.
+
+        If `fields` is given only the fields in that dict are exported
+        (and computed).  The values are the fields for nested objects or
+        `None` for all fields, see :func:`parse_fields`.
         """
-        result = {'#type': self.remote_object_type}
-        for key in self.public_fields:
-            if isinstance(key, tuple):
-                alias, key = key
-            else:
-                alias = key.rsplit('.', 1)[-1]
-            value = _recursive_getattr(self, key)
-            if callable(value):
-                value = value()
-            result[alias] = remote_export_primitive(value)
-        return result
+        return get_exporter(self.__class__, fields)(self, fields)
 
     def remote_export_field(self, name):
         """Remote-exports a field only."""
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+    solace.utils.timing
+    ~~~~~~~~~~~~~~~~~~~
+
+    Measures the phases of a request (URL matching, session and user
+    loading, the view, SQL, template rendering, serialization and the
+    ETag calculation) and sends them as `Server-Timing` header so that
+    they show up in the developer tools of the browser.  The phases can
+    also be logged to the ``solace.timing`` logger.
+
+    The phases are not exclusive, the view for example includes the time
+    spent for SQL and template rendering.
+
+    :copyright: (c) 2010 by the Solace Team, see AUTHORS for more details.
+    :license: BSD, see LICENSE for more details.
+"""
+from __future__ import with_statement
+import sys
+import time
+import logging
+from contextlib import contextmanager
+
+
+logger = logging.getLogger('solace.timing')
+
+
+# the best timer for the platform. on windows systems we're using clock
+# for timing which has a higher resolution.
+if sys.platform == 'win32':
+    _timer = time.clock
+else:
+    _timer = time.time
+
+
+class RequestTimings(object):
+    """Collects the time spent in the phases of a request."""
+
+    def __init__(self, start):
+        self.start = start
+        self.phases = {}
+        self.order = []
+        self._running = {}
+
+    def add(self, name, seconds):
+        """Adds `seconds` to the phase."""
+        if name not in self.phases:
+            self.order.append(name)
+            self.phases[name] = 0.0
+        self.phases[name] += seconds
+
+    def begin(self, name):
+        """Starts measuring a phase that is ended by :meth:`end`."""
+        self._running[name] = _timer()
+
+    def end(self, name):
+        """Ends a phase started with :meth:`begin`."""
+        start = self._running.pop(name, None)
+        if start is not None:
+            self.add(name, _timer() - start)
+
+    def items(self):
+        """Returns ``(name, seconds)`` tuples in the order the phases were
+        first recorded.
+        """
+        return [(name, self.phases[name]) for name in self.order]
+
+    def to_header(self):
+        """Returns the value for the `Server-Timing` header."""
+        return ', '.join('%s;dur=%.2f' % (name, seconds * 1000)
+                         for name, seconds in self.items())
+
+
+@contextmanager
+def timed(name):
+    """Adds the time spent in the block to the phase of the current
+    request.  Outside of requests or if timing is disabled this does
+    nothing::
+
+        with timed('template'):
+            rv = template.render(context)
+    """
+    request = Request.current
+    timings = request is not None and request.timings or None
+    if timings is None:
+        yield
+        return
+    start = _timer()
+    try:
+        yield
+    finally:
+        timings.add(name, _timer() - start)
+
+
+def _timing_enabled():
+    return settings.SERVER_TIMING or settings.SERVER_TIMING_LOG
+
+
+def _start_request():
+    if _timing_enabled():
+        local.request_start = _timer()
+
+
+def _track_request_init(request):
+    start = getattr(local, 'request_start', None)
+    if start is not None:
+        request.timings = RequestTimings(start)
+        request.timings.add('match', _timer() - start)
+
+
+def _begin_view(request):
+    if request.timings is not None:
+        request.timings.begin('view')
+
+
+def _end_view(request, response):
+    if request.timings is not None:
+        request.timings.end('view')
+
+
+def _send_timings(request, response):
+    timings = request.timings
+    if timings is None:
+        return
+    if settings.TRACK_QUERIES:
+        timings.add('sql', sum(x[2] for x in request.sql_queries))
+    timings.add('total', _timer() - timings.start)
+    if settings.SERVER_TIMING:
+        response.headers['Server-Timing'] = timings.to_header()
+    if settings.SERVER_TIMING_LOG:
+        logger.info('%s %s [%s] %s', request.method, request.path,
+                    request.endpoint, ' '.join('%s=%.2fms' % (name, seconds
+                    * 1000) for name, seconds in timings.items()))
+
+
+# circular dependencies
+from solace import settings
+from solace.application import Request
+from solace.utils.ctxlocal import local
+from solace.signals import before_request_init, after_request_init, \
+     before_request_dispatch, after_request_dispatch, before_response_sent
+before_request_init.connect(_start_request)
+after_request_init.connect(_track_request_init)
+before_request_dispatch.connect(_begin_view)
+after_request_dispatch.connect(_end_view)
+before_response_sent.connect(_send_timings)
@@ -9,6 +9,7 @@
     :license: BSD, see LICENSE for more details.
 """
 from werkzeug import redirect, Response
+from simplejson import dumps
 from werkzeug.exceptions import Forbidden, NotFound
 
 from solace.i18n import _
@@ -19,6 +20,10 @@ from solace.settings import describe_settings
 from solace.templating import render_template
 from solace.utils.pagination import Pagination
 from solace.utils.csrf import exchange_token_protected
+from solace.utils.caching import get_cache
+from solace.signals import get_profile, get_handler_stats
+from solace.utils.profiling import get_profiled_endpoints, \
+     get_top_functions, format_collapsed_stacks
 from solace.utils import admin as admin_utils
 
 
@@ -32,7 +37,38 @@ def overview(request):
 def status(request):
     """Displays system statistics such as the database settings."""
     return render_template('admin/status.html',
-                           active_settings=describe_settings())
+                           active_settings=describe_settings(),
+                           cache=get_cache(),
+                           signal_profile=get_profile(),
+                           handler_stats=get_handler_stats())
+
+
+@require_admin
+def signal_profile(request):
+    """Returns the signal handler timings and statistics as JSON."""
+    return Response(dumps(dict(profile=get_profile(),
+                               handlers=get_handler_stats())),
+                    mimetype='application/json')
+
+
+@require_admin
+def profiles(request):
+    """Lists the functions with the most samples per endpoint."""
+    endpoints = [(endpoint, samples, get_top_functions(endpoint))
+                 for endpoint, samples in get_profiled_endpoints()]
+    return render_template('admin/profiles.html', endpoints=endpoints)
+
+
+@require_admin
+def download_profile(request, name):
+    """Returns the stacks of an endpoint in the flamegraph format."""
+    data = format_collapsed_stacks(name)
+    if not data:
+        raise NotFound()
+    response = Response(data, mimetype='text/plain')
+    response.headers['Content-Disposition'] = \
+        'attachment; filename=%s.folded' % name
+    return response
 
 
 @require_admin
@@ -13,14 +13,26 @@
     :copyright: (c) 2010 by the Solace Team, see AUTHORS for more details.
     :license: BSD, see LICENSE for more details.
 """
-from werkzeug import redirect
-from werkzeug.exceptions import NotFound
+from werkzeug import Response, redirect
+from werkzeug.exceptions import NotFound, BadRequest
+from sqlalchemy.orm import eagerload
 
+from solace import settings
 from solace.application import url_for
+from solace.export import iter_export, get_export_names
+from solace.i18n import _
 from solace.templating import render_template
-from solace.utils.api import api_method, list_api_methods, XML_NS
+from solace.utils.api import api_method, list_api_methods, paginate, \
+     get_id_list, get_bool_arg, get_fields, XML_NS
 from solace.models import User, Topic, Post
 from solace.badges import badge_list, badges_by_id
+from solace.utils.remoting import get_load_plan
+
+
+def _sort_by_ids(items, ids):
+    """Sorts the items in the order of the requested IDs."""
+    by_id = dict((x.id, x) for x in items)
+    return [by_id[x] for x in ids if x in by_id]
 
 
 def default_redirect(request):
@@ -51,14 +63,30 @@ def list_users(request):
     * {{{limit}}} — the number of items to load at once.  Defaults to
                     10, maximum allowed number is 50.
     * {{{offset}}} — the offset of the returned list.  Defaults to 0
+    * {{{cursor}}} — instead of an offset the {{{next_cursor}}} of the
+                     previous page can be passed.  Unlike offsets this
+                     does not skip or repeat users if users are added
+                     in the meantime.
+    * {{{count}}} — set to {{{no}}} to omit the {{{total_count}}}.
+    * {{{ids}}} — a comma separated list of up to 50 user IDs.  If
+                  given, these users are returned instead of a page.
+    * {{{fields}}} — a comma separated list of the fields to return.
+                     Fields of nested objects are separated with a dot
+                     ({{{author.username}}}).  This works for all methods.
     """
-    offset = max(0, request.args.get('offset', type=int) or 0)
-    limit = max(0, min(50, request.args.get('limit', 10, type=int)))
-    q = User.query.order_by(User.username)
-    count = q.count()
-    q = q.limit(limit).offset(offset)
-    return dict(users=q.all(), total_count=count,
-                limit=limit, offset=offset)
+    fields = get_fields(request)
+    plan = get_load_plan(User, fields)
+    q = User.query.options(*plan.options())
+    ids = get_id_list(request)
+    if ids is not None:
+        users = ids and _sort_by_ids(q.filter(User.id.in_(ids)).all(),
+                                     ids) or []
+        result = {}
+    else:
+        users, result = paginate(request, q, [(User.username, False)])
+    plan.prepare(users)
+    result['users'] = users
+    return result
 
 
 @api_method()
@@ -94,25 +122,49 @@ def get_badge(request, identifier):
 
 @api_method()
 def list_questions(request):
-    """Lists all questions or all questions in a section."""
-    q = Topic.query.order_by(Topic.date.desc())
+    """Lists all questions or all questions in a section, newest first.
+    The parameters are the same as for "list users", {{{ids}}} are
+    question IDs.
+    """
+    fields = get_fields(request)
+    plan = get_load_plan(Topic, fields)
+    q = Topic.query.options(*plan.options())
     if request.view_lang is not None:
         q = q.filter_by(locale=request.view_lang)
-    offset = max(0, request.args.get('offset', type=int) or 0)
-    limit = max(0, min(50, request.args.get('limit', 10, type=int)))
-    count = q.count()
-    q = q.limit(limit).offset(offset)
-    return dict(questions=q.all(), total_count=count,
-                limit=limit, offset=offset)
+    ids = get_id_list(request)
+    if ids is not None:
+        questions = ids and _sort_by_ids(q.filter(Topic.id.in_(ids)).all(),
+                                         ids) or []
+        result = {}
+    else:
+        questions, result = paginate(request, q, [(Topic.date, True),
+                                                  (Topic.id, True)])
+    plan.prepare(questions)
+    result['questions'] = questions
+    return result
 
 
 @api_method()
 def get_question(request, question_id):
-    """Returns a single question and the replies."""
-    t = Topic.query.get(question_id)
+    """Returns a single question and the replies.  Pass {{{replies=no}}}
+    to only get the question.
+    """
+    fields = get_fields(request)
+    with_replies = get_bool_arg(request, 'replies')
+    plan = get_load_plan(Topic, fields)
+    q = Topic.query.options(*plan.options())
+    if with_replies:
+        reply_plan = get_load_plan(Post, fields)
+        q = q.options(eagerload('posts'), *reply_plan.options('posts.'))
+    t = q.get(question_id)
     if t is None:
         raise NotFound()
-    return dict(question=t, replies=t.replies)
+    plan.prepare([t])
+    if not with_replies:
+        return dict(question=t)
+    replies = t.replies
+    reply_plan.prepare(replies)
+    return dict(question=t, replies=replies)
 
 
 @api_method()
@@ -122,3 +174,39 @@ def get_reply(request, reply_id):
     if r is None or r.is_question:
         raise NotFound()
     return dict(reply=r)
+
+
+@api_method()
+def export(request):
+    """Streams the knowledge base as newline delimited JSON, one JSON
+    object per line.  The {{{#table}}} key of each object is the name
+    of the table the row comes from ({{{users}}}, {{{tags}}},
+    {{{topics}}}, {{{topic_tags}}}, {{{posts}}} and {{{comments}}}), the
+    other keys are the columns of the row.  The tables are exported in
+    that order.  Private data of the users, deleted topics and posts and
+    the individual votes are not part of the export.  The export is only
+    available if the site administrator enabled it.
+
+    ==== Parameters ====
+
+    * {{{tables}}} — a comma separated list of the tables to export.
+                     Defaults to all tables.
+    * {{{gzip}}} — set to {{{yes}}} to get a gzip compressed file.
+    """
+    if not settings.API_EXPORT_ENABLED:
+        raise NotFound()
+    try:
+        names = get_export_names(request.args.get('tables'))
+    except ValueError:
+        raise BadRequest(_(u'Unknown table'))
+    compress = get_bool_arg(request, 'gzip', False)
+    filename = 'solace-export.ndjson'
+    mimetype = 'application/x-ndjson'
+    if compress:
+        filename += '.gz'
+        mimetype = 'application/x-gzip'
+    response = Response(iter_export(names, compress), mimetype=mimetype,
+                        direct_passthrough=True)
+    response.headers['Content-Disposition'] = 'attachment; filename=' + \
+        filename
+    return response
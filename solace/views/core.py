@@ -11,12 +11,12 @@
 """
 from werkzeug import redirect, Response
 from werkzeug.exceptions import NotFound, MethodNotAllowed
-from babel import Locale, UnknownLocaleError
+from babel import UnknownLocaleError
 
 from solace.application import url_for, json_response
 from solace.auth import get_auth_system, LoginUnsucessful
 from solace.templating import render_template
-from solace.i18n import _, has_section, get_js_translations
+from solace.i18n import _, has_section, get_js_translations, intern_locale
 from solace.forms import RegistrationForm, ResetPasswordForm
 from solace.models import User
 from solace.database import session
@@ -94,6 +94,8 @@ def reset_password(request, email=None, key=None):
         send_email(_(u'Reset Password'),
                    render_template('mails/reset_password.txt', user=user,
                                    reset_url=reset_url), user.email)
+        # commit so that the mail is queued if the mail queue is enabled
+        session.commit()
         request.flash(_(u'A mail with a link to reset the password '
                         u'was sent to “%s”') % user.email)
         return redirect(url_for('kb.overview'))
@@ -132,7 +134,7 @@ def set_timezone_offset(request):
 def set_language(request, locale):
     """Sets the new locale."""
     try:
-        locale = Locale.parse(locale)
+        locale = intern_locale(locale)
         if not has_section(locale):
             raise UnknownLocaleError(str(locale))
     except UnknownLocaleError:
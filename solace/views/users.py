@@ -11,7 +11,6 @@
 from sqlalchemy.orm import eagerload
 from werkzeug import redirect
 from werkzeug.exceptions import NotFound
-from babel import Locale
 
 from solace import settings
 from solace.application import url_for, require_login
@@ -20,7 +19,7 @@ from solace.database import session
 from solace.models import User, Topic, Post
 from solace.templating import render_template
 from solace.utils.pagination import Pagination
-from solace.i18n import list_sections, _
+from solace.i18n import list_sections, intern_locale, _
 
 
 def userlist(request, locale=None):
@@ -35,7 +34,7 @@ def userlist(request, locale=None):
         # general user list.
         if len(settings.LANGUAGE_SECTIONS) == 1:
             return redirect(url_for('users.userlist'))
-        locale = Locale.parse(locale)
+        locale = intern_locale(locale)
         query = query.active_in(locale)
     query = query.order_by(User.reputation.desc())
     pagination = Pagination(request, query, request.args.get('page', type=int))